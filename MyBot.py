@@ -1,10 +1,9 @@
 from sklearn.externals import joblib
 
 from my.bot import Bot
-from my.estimator import Estimator, fight_expand
+from my.registry import load_estimator
 
 
-model = joblib.load("model/regressor.pkl")
-estimator = Estimator(model, fight_expand)
+estimator = load_estimator("linear", "model/regressor.pkl", joblib.load)
 
-Bot(estimator, "Regressor").play()
+Bot(estimator, "Regressor", fleet = True).play()
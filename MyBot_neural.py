@@ -1,13 +1,15 @@
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-from keras.models import load_model
-
 from my.bot import Bot
-from my.estimator import Estimator, identity
+from my.registry import load_estimator
+
+
+def load_keras(path):
+  from keras.models import load_model
+  return load_model(path)
 
 
-model = load_model("model/neural_net.h5")
-estimator = Estimator(model, identity)
+estimator = load_estimator("neural_net", "model/neural_net.h5", load_keras)
 
-Bot(estimator, "Neural Net").play()
+Bot(estimator, "Neural Net", fleet = True).play()
@@ -1,5 +1,6 @@
 import random
 import hlt
+from my.docking import PlanetIndex
 
 
 game = hlt.Game("Random")
@@ -8,24 +9,20 @@ while True:
   game_map = game.update_map()
   
   command_queue = []
+  
+  # Find planets where our undocked ships can dock, and hand out the free spots.
+  me = game_map.get_me()
+  undocked = [s for s in me.all_ships() if s.docking_status == s.DockingStatus.UNDOCKED]
+  docks = PlanetIndex(game_map).assign(undocked, me.id)
       
-  for ship in game_map.get_me().all_ships():
+  for ship in me.all_ships():
     
     # Fighter line of decision.
     if ship.docking_status == ship.DockingStatus.UNDOCKED:
       
-      # Find planets where we can dock.
-      dock_targets = []
-      for p in game_map.all_planets():
-        if p.is_full() or not ship.can_dock(p):
-          continue
-        if p.is_owned() and ship.owner is not p.owner:
-          continue
-        dock_targets.append(p)
-      
-      # If possible, dock to a randomly chosen planet from those where we can dock.
-      if len(dock_targets) > 0:
-        target = random.choice(dock_targets)
+      # If possible, dock to the planet chosen for us.
+      target = docks.get(ship.id)
+      if target is not None:
         command_queue.append(ship.dock(target))
         continue
       
@@ -0,0 +1,6 @@
+from my.zygote import shim
+
+
+# Plays a game through the zygote server (python3 -m my.zygote), which must
+# be running already; HALITE_ZYGOTE_SOCKET selects its socket.
+shim()
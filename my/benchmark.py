@@ -0,0 +1,238 @@
+import argparse
+import contextlib, io
+import json
+import os.path
+import random, time
+import numpy as np
+
+import hlt
+from hlt.game_map import Map
+from my.bot import Bot
+from my.clustering import all_clusters
+from my.data import frame_string, to_table, get_Xy, extract, relabel
+from my.estimator import Estimator, fight_expand, identity
+from my.features import my_ships_features
+
+
+# Benchmarks of a bot's turn, stage by stage, and of the training pipeline.
+# They run on fixtures: frames and games taken from recorded replays (see
+# <make_fixtures>), so neither the halite binary nor a trained model is
+# needed. Results are printed as JSON.
+
+FIXTURE_DIR = os.path.join("bench", "fixtures")
+
+"""Which part of the game each frame fixture comes from (as a fraction of
+the game's length)."""
+PHASES = {"early": 0.05, "mid": 0.5, "late": 0.9}
+
+"""The horizon the pipeline fixture is labeled with."""
+MAX_LEN = 50
+
+########################################################################
+#### FIXTURES ##########################################################
+
+def frame_fixture(data, fid):
+  """Returns a replay consisting of the single frame <fid> of <data>."""
+  res = {key: data[key] for key in ["num_players", "width", "height", "planets"]}
+  res["num_frames"] = 1
+  res["frames"] = [data["frames"][fid]]
+  res["moves"] = []
+  return res
+
+
+def make_fixtures(raw_data, directory = FIXTURE_DIR, max_len = MAX_LEN):
+  """Stores the fixtures into <directory>: the longest of the games in
+  <raw_data> as the training-pipeline fixture, and an early, a mid and
+  a late frame of it as the turn fixtures. The game must be long enough
+  for <to_table> (with <max_len>) not to skip it."""
+  game = max(raw_data, key = lambda data: data["num_frames"])
+  # <to_table> skips games with num_frames - max_len <= 2 * max_len.
+  min_frames = 3 * max_len + 1
+  if game["num_frames"] < min_frames:
+    raise Exception("The longest game has only {} frames, need at least {}.".format(game["num_frames"], min_frames))
+  
+  os.makedirs(directory, exist_ok = True)
+  with open(os.path.join(directory, "game.json"), "w") as f:
+    json.dump(game, f)
+  for phase, ratio in PHASES.items():
+    fid = int(ratio * (game["num_frames"] - 1))
+    with open(os.path.join(directory, "frame-{}.json".format(phase)), "w") as f:
+      json.dump(frame_fixture(game, fid), f)
+
+
+def load_fixture(directory, name):
+  with open(os.path.join(directory, name)) as f:
+    return json.load(f)
+
+########################################################################
+#### MEASUREMENTS ######################################################
+
+class RandomModel:
+  """A stand-in for a trained model: a linear function with random
+  coefficients. Costs about the same to evaluate as a linear regressor."""
+  
+  def __init__(self, seed = 0):
+    self.rng = np.random.RandomState(seed)
+    self.weights = None
+  
+  def predict(self, X):
+    if self.weights is None or len(self.weights) != X.shape[1]:
+      self.weights = self.rng.normal(size = X.shape[1])
+    return X.dot(self.weights)
+
+
+def percentiles(times):
+  """Summary of a list of durations (in seconds)."""
+  times = np.array(times)
+  return {
+    "n": len(times),
+    "mean": float(times.mean()),
+    "p50": float(np.percentile(times, 50)),
+    "p95": float(np.percentile(times, 95)),
+    "p99": float(np.percentile(times, 99))
+  }
+
+
+def timed(times, stage, func, *args):
+  """Calls func(*args), and appends its duration to times[stage]."""
+  start = time.perf_counter()
+  res = func(*args)
+  times.setdefault(stage, []).append(time.perf_counter() - start)
+  return res
+
+
+def send(command_queue):
+  """Serializes the commands the same way the bot does, into a buffer."""
+  with contextlib.redirect_stdout(io.StringIO()):
+    hlt.Game.send_command_queue(command_queue)
+
+
+def bench_turn(data, bot, repeats = 20):
+  """Times the stages of <bot>'s turn in the single frame of <data>,
+  playing as the player with the most ships."""
+  string = frame_string(data, 0)
+  ships = data["frames"][0]["ships"]
+  my_id = int(max(ships, key = lambda pid: len(ships[pid])))
+  
+  times = {}
+  for r in range(repeats):
+    game_map = Map(my_id, data["width"], data["height"])
+    timed(times, "parse", game_map._parse, string)
+    clusters = timed(times, "cluster", all_clusters, game_map)
+    s_feats = timed(times, "features", my_ships_features, game_map, clusters)
+    command_queue = timed(times, "move_search", bot.decide, game_map, s_feats)
+    timed(times, "serialize", send, command_queue)
+    times.setdefault("total", []).append(sum(times[stage][-1] for stage in ["parse", "cluster", "features", "move_search", "serialize"]))
+  
+  res = {stage: percentiles(t) for stage, t in times.items()}
+  res["ships"] = len(ships[str(my_id)])
+  return res
+
+
+def bench_pipeline(data, learner = "linear", sample_ratio = 0.1, repeats = 3):
+  """Times the stages of the training pipeline: to_table, get_Xy and fitting
+  the model (with the learner my.train uses), on the game <data>."""
+  times = {}
+  rows = 0
+  for r in range(repeats):
+    table = timed(times, "to_table", to_table, data, sample_ratio, 0.95, MAX_LEN, True, True, r)
+    if learner == "linear":
+      from my.train import learn_regression
+      X, y = timed(times, "get_Xy", get_Xy, table, fight_expand)
+      timed(times, "fit", learn_regression, X, y, None, None, False)
+    else:
+      from my.train import learn_neural_net
+      X, y = timed(times, "get_Xy", get_Xy, table, identity)
+      timed(times, "fit", learn_neural_net, X, y, None, None, False)
+    rows += len(y)
+  
+  res = {stage: percentiles(t) for stage, t in times.items()}
+  res["rows"] = rows // repeats
+  return res
+
+
+def bench_dtypes(data, learner = "linear", sample_ratio = 0.1, repeats = 3):
+  """Compares the float32 data path (my.data.DTYPE) with float64, on the game
+  <data>: the memory taken by the table and by X, and the time of get_Xy
+  and of fitting the model. The linear learner (my.train.learn_regression)
+  solves the normal equations in float64 either way; the largest difference
+  between the predictions of the two models is reported too."""
+  game = extract(data, sample_ratio, seed = 0)
+  expander = (fight_expand if learner == "linear" else identity)
+  res = {}
+  models = {}
+  for dtype in [np.float32, np.float64]:
+    times = {}
+    table = relabel(game, 0.95, MAX_LEN, dtype = dtype)
+    for r in range(repeats):
+      X, y = timed(times, "get_Xy", get_Xy, table, expander, dtype)
+      if learner == "linear":
+        from my.train import learn_regression
+        model = timed(times, "fit", learn_regression, X, y, None, None, False)
+      else:
+        from my.train import learn_neural_net
+        model = timed(times, "fit", learn_neural_net, X, y, None, None, False)
+    name = np.dtype(dtype).name
+    models[name] = model
+    res[name] = {stage: percentiles(t) for stage, t in times.items()}
+    res[name].update(rows = len(y), table_bytes = table.nbytes, X_bytes = X.nbytes)
+  X64 = X
+  res["max_prediction_difference"] = float(np.max(np.abs(np.ravel(models["float32"].predict(X64)) - np.ravel(models["float64"].predict(X64))), initial = 0.0))
+  return res
+
+########################################################################
+#### MAIN ##############################################################
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks of turn latency and training throughput.")
+  parser.add_argument("--fixtures", help = "Directory with the fixtures", default = FIXTURE_DIR)
+  parser.add_argument("--make_fixtures", help = "Create the fixtures from the replays in this directory or zip file, then exit", default = None)
+  parser.add_argument("--games_limit", type = int, help = "Consider up to games_limit games when creating fixtures", default = 10)
+  parser.add_argument("--model", help = "Model used by the bot (random linear model if not given)", default = None)
+  parser.add_argument("--learner", help = "Which learner is timed in the pipeline (linear, neural_net)", default = "linear")
+  parser.add_argument("--turn_repeats", type = int, help = "How many times each frame fixture is played", default = 20)
+  parser.add_argument("--pipeline_repeats", type = int, help = "How many times the pipeline is run (0 skips it)", default = 3)
+  parser.add_argument("--seed", type = int, help = "Random seed", default = 0)
+  parser.add_argument("--dtypes", action = "store_true", help = "Only compare the float32 and float64 data paths on the game fixture")
+  args = parser.parse_args()
+  
+  if args.make_fixtures is not None:
+    from my.train import fetch_data_dir, fetch_data_zip
+    if args.make_fixtures.endswith(".zip"):
+      raw_data = fetch_data_zip(args.make_fixtures, args.games_limit)
+    else:
+      raw_data = fetch_data_dir(args.make_fixtures, args.games_limit)
+    make_fixtures(list(raw_data), args.fixtures)
+    return
+  
+  random.seed(args.seed)
+  np.random.seed(args.seed)
+  
+  if args.dtypes:
+    data = load_fixture(args.fixtures, "game.json")
+    print(json.dumps(bench_dtypes(data, args.learner, repeats = max(1, args.pipeline_repeats)), indent = 2))
+    return
+  
+  if args.model is None:
+    estimator = Estimator(RandomModel(args.seed), fight_expand)
+  elif args.model.endswith(".h5"):
+    from keras.models import load_model
+    estimator = Estimator(load_model(args.model), identity)
+  else:
+    from sklearn.externals import joblib
+    estimator = Estimator(joblib.load(args.model), fight_expand)
+  bot = Bot(estimator, "Benchmark", fleet = True)
+  
+  res = {"turn": {}}
+  for phase in PHASES:
+    data = load_fixture(args.fixtures, "frame-{}.json".format(phase))
+    res["turn"][phase] = bench_turn(data, bot, args.turn_repeats)
+  if args.pipeline_repeats > 0:
+    data = load_fixture(args.fixtures, "game.json")
+    res["pipeline"] = bench_pipeline(data, args.learner, repeats = args.pipeline_repeats)
+  
+  print(json.dumps(res, indent = 2))
+
+
+if __name__ == "__main__":
+  main()
@@ -1,19 +1,39 @@
 import numpy as np
 import math, random
 import hlt
+import logging
+import my.instrument as instrument
 from my.estimator import Estimator, fight
+from my.search import RandomSearch
 from my.clustering import all_clusters
+from my.docking import PlanetIndex
 from my.features import my_ships_features
+from my.fields import PlanetFields
+from my.speculate import Speculation
 
 
 class Bot:
   """Responsible for playing the game."""
   
-  def __init__(self, estimator, name):
+  def __init__(self, estimator, name, fleet = False, search = None, fields = False, theta = None, speculate = False):
     """Load estimators, in this case, they are all linear regressors. And
-    set the in-game name of the bot."""
+    set the in-game name of the bot. If <fleet>, moves of all ships are
+    planned together by the move search strategy <search> (random by
+    default), warm-started from each ship's previous move. If <fields>,
+    the planet sensors are read from precomputed PlanetFields. If <theta>
+    is given, ships are grouped by quadtrees (see my.quadtree) with that
+    tolerance instead of KMeans. If <speculate>, the next turn is prepared
+    for while we wait for the engine (see my.speculate)."""
     self.estimator = estimator
     self._name = name
+    self.fleet = fleet
+    self.search = (search if search is not None else RandomSearch())
+    self.fields = fields
+    self.theta = theta
+    self._fields = None
+    self._last_moves = {}
+    self.speculate = speculate
+    self._speculation = None
   
   def play(self):
     """Play a game using stdin/stdout."""
@@ -21,36 +41,84 @@ class Bot:
     
     while True:
       game_map = game.update_map()
-      clusters = all_clusters(game_map)
-      s_feats = my_ships_features(game_map, clusters)
-      command_queue = []
+      command_queue = self.turn(game_map)
+      game.send_command_queue(command_queue)
+      if self.speculate:
+        self._speculation = Speculation(game_map, command_queue, self)
+      instrument.end_turn()
+      if instrument.enabled():
+        logging.info(instrument.report())
+  
+  def planet_fields(self, game_map, prefetched = None):
+    """The PlanetFields of this game, updated for this turn (None if we
+    don't use them), taking over what is still right of <prefetched>. They
+    are built in the first turn of each game."""
+    if not self.fields:
+      return None
+    if self._fields is None or not self._fields.covers(game_map):
+      with instrument.timer("bot.fields"):
+        self._fields = PlanetFields(game_map)
+    self._fields.update(game_map, prefetched)
+    return self._fields
+  
+  def turn(self, game_map):
+    """Returns the commands for this turn."""
+    with instrument.timer("bot.turn"):
+      spec = (self._speculation.result() if self._speculation is not None else None)
+      self._speculation = None
+      with instrument.timer("bot.cluster"):
+        clusters = all_clusters(game_map, theta = self.theta, init = (spec.centroids if spec is not None else None))
+      with instrument.timer("bot.features"):
+        s_feats = my_ships_features(game_map, clusters, self.planet_fields(game_map, (spec.prefetched if spec is not None else None)))
+      with instrument.timer("bot.decide"):
+        return self.decide(game_map, s_feats, (spec.candidates if spec is not None else None))
+  
+  def decide(self, game_map, s_feats, candidates = None):
+    """Chooses the commands for our ships, given their features <s_feats>.
+    <candidates> optionally holds the move candidates drawn in advance for
+    some ships, by ship id."""
+    command_queue = []
+    fighters = []
+    
+    # Find planets where our undocked ships can dock, and hand out the free spots.
+    me = game_map.get_me()
+    undocked = [s for s in me.all_ships() if s.docking_status == s.DockingStatus.UNDOCKED]
+    with instrument.timer("bot.dock"):
+      docks = PlanetIndex(game_map).assign(undocked, me.id)
+    instrument.count("ships", len(s_feats))
+    
+    # Determine the course of action for each ship independently.
+    for feats, ship in zip(s_feats, me.all_ships()):
       
-      # Determine the course of action for each ship independently.
-      for feats, ship in zip(s_feats, game_map.get_me().all_ships()):
+      # Fighter line of decision.
+      if ship.docking_status == ship.DockingStatus.UNDOCKED:
         
-        # Fighter line of decision.
-        if ship.docking_status == ship.DockingStatus.UNDOCKED:
-          
-          # Find planets where we can dock.
-          dock_targets = []
-          for p in game_map.all_planets():
-            if p.is_full() or not ship.can_dock(p):
-              continue
-            if p.is_owned() and ship.owner is not p.owner:
-              continue
-            dock_targets.append(p)
-          
-          # If possible, dock to a randomly chosen planet from those where we can dock.
-          if len(dock_targets) > 0:
-            target = random.choice(dock_targets)
-            command_queue.append(ship.dock(target))
-            continue
-          
-          # Otherwise, move.
-          speed, angle = fight(feats, self.estimator)
-          command_queue.append(ship.thrust(speed, angle))
+        # If possible, dock to the planet chosen for us.
+        target = docks.get(ship.id)
+        if target is not None:
+          command_queue.append(ship.dock(target))
+          continue
         
-        # Miner line of decision.
-        # Do nothing (continue mining).
+        # Otherwise, move.
+        if self.fleet:
+          fighters.append((feats, ship))
+          continue
+        speed, angle = fight(feats, self.estimator)
+        command_queue.append(ship.thrust(speed, angle))
       
-      game.send_command_queue(command_queue)
+      # Miner line of decision.
+      # Do nothing (continue mining).
+    
+    # In fleet mode, the moves of all fighters are chosen at once.
+    instrument.count("fighters", len(fighters))
+    if len(fighters) > 0:
+      warm = [self._last_moves.get(ship.id) for feats, ship in fighters]
+      prepared = [(candidates or {}).get(ship.id) for feats, ship in fighters]
+      with instrument.timer("bot.search"):
+        moves, values = self.search.search([feats for feats, ship in fighters], self.estimator, warm, prepared)
+      self._last_moves = {}
+      for (feats, ship), (speed, angle) in zip(fighters, moves):
+        command_queue.append(ship.thrust(speed, angle))
+        self._last_moves[ship.id] = (speed, angle)
+    
+    return command_queue
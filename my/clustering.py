@@ -1,11 +1,14 @@
 import numpy as np
-from sklearn.cluster import KMeans
+import my.instrument as instrument
 from hlt.entity import Entity, Position
 
-from matplotlib import pyplot as plt
 import logging
 
 
+"""The default numbers of clusters per player, of fighters and of miners."""
+K_FIGHTERS = 60
+K_MINERS = 30
+
 class Cluster(Entity):
   """Class representing a cluster of ships."""
   
@@ -32,15 +35,21 @@ class Cluster(Entity):
     return len(self.ships)
 
 
-def get_clusters(ships, k = 60):
-  """Divide <ships> into <k> clusters and return a list of those clusters."""
+def get_clusters(ships, k = 60, init = None):
+  """Divide <ships> into <k> clusters and return a list of those clusters.
+  If <init> holds k centroids, KMeans is run once, starting from them."""
   k = min(k, len(ships))
   if k == 0:
     return []
   
   # Calculate the k clusters, divide ships based on their label.
+  from sklearn.cluster import KMeans
   ship_array = np.array([[s.x, s.y] for s in ships])
-  kmeans = KMeans(n_clusters = k).fit(ship_array)
+  with instrument.timer("clustering.kmeans"):
+    if init is not None and len(init) == k:
+      kmeans = KMeans(n_clusters = k, init = init, n_init = 1).fit(ship_array)
+    else:
+      kmeans = KMeans(n_clusters = k).fit(ship_array)
   followers = [[] for i in range(k)]
   for i, label in np.ndenumerate(kmeans.labels_):
     followers[label].append(ships[i[0]])
@@ -52,12 +61,24 @@ def get_clusters(ships, k = 60):
       continue
     cx, cy = kmeans.cluster_centers_[i]
     res.append(Cluster(cx, cy, followers[i]))
+  instrument.count("clusters", len(res))
   return res
 
 
-def all_clusters(game_map, k_fighters = 60, k_miners = 30):
+def get_quadtree(ships, theta):
+  """A QuadTree over <ships>, see my.quadtree."""
+  from my.quadtree import QuadTree
+  with instrument.timer("clustering.quadtree"):
+    return QuadTree(ships, theta)
+
+
+def all_clusters(game_map, k_fighters = K_FIGHTERS, k_miners = K_MINERS, theta = None, init = None):
   """Divide all ships into clusters based on their owner and whether they
-  are fighters (free to do stuff) or miners."""
+  are fighters (free to do stuff) or miners. If <theta> is given, the
+  ships are put into quadtrees with that opening tolerance instead of being
+  divided by KMeans. <init> optionally maps (player id, "fighters" or
+  "miners") to the centroids KMeans starts from."""
+  init = (init or {})
   clusters = []
   for player in game_map.all_players():
     fighters = []
@@ -67,7 +88,10 @@ def all_clusters(game_map, k_fighters = 60, k_miners = 30):
         fighters.append(ship)
       else:
         miners.append(ship)
-    pc = {"fighters": get_clusters(fighters, k_fighters), "miners": get_clusters(miners, k_miners)}
+    if theta is not None:
+      pc = {"fighters": get_quadtree(fighters, theta), "miners": get_quadtree(miners, theta)}
+    else:
+      pc = {"fighters": get_clusters(fighters, k_fighters, init.get((player.id, "fighters"))), "miners": get_clusters(miners, k_miners, init.get((player.id, "miners")))}
     clusters.append(pc)
   return clusters
 
@@ -78,6 +102,7 @@ def all_clusters(game_map, k_fighters = 60, k_miners = 30):
 curr_img_id = 0
 
 def snapshot(clusters, img_name):
+  from matplotlib import pyplot as plt
   global curr_img_id
   ships = []
   for i, cluster in enumerate(clusters):
@@ -1,72 +1,94 @@
 import math, random
 import numpy as np
+import my.instrument as instrument
 from hlt.entity import Planet, Ship
 from hlt.game_map import Map, Player
 from my.clustering import all_clusters
 from my.features import ship_features, FEATURES, INDICATORS
+from my.fields import PlanetFields
 from my.estimator import identity
 
 
+def frame_string(data, fid):
+  """Returns the string the Halite engine would send to describe frame
+  <fid> + 1 of <data> (which is in replay format)."""
+  num_players = data["num_players"]
+  frame = data["frames"][fid]
+  tokens = []
+  
+  # Generate tokens for players (their ships).
+  tokens.append(num_players)
+  for pid, ships in frame["ships"].items():
+    tokens.append(pid)
+    tokens.append(len(ships))
+    for sid, ship in ships.items():
+      docked = ship["docking"]["status"]
+      docked = {"undocked": 0, "docking": 1, "docked": 2, "undocking": 3}[docked]
+      planet = ship["docking"].get("planet_id", -1)
+      progress = ship["docking"].get("turns_left", -1)
+      cooldown = ship["cooldown"]
+      
+      tokens.extend(map(lambda key: ship[key], ["id", "x", "y", "health", "vel_x", "vel_y"]))
+      tokens.extend([docked, planet, progress, cooldown])
+  
+  # Generate tokens for planets.
+  tokens.append(len(frame["planets"]))
+  for curr in frame["planets"].values():
+    plid = curr["id"]
+    origin = data["planets"][plid]
+    x = origin["x"]
+    y = origin["y"]
+    hp = curr["health"]
+    r = origin["r"]
+    docking = origin["docking_spots"]
+    current = curr["current_production"]
+    remaining = curr["remaining_production"]
+    owner = curr["owner"]
+    owned = (1 if owner is not None else 0)
+    if not owned:
+      owner = 0
+    docked_ships = curr["docked_ships"]
+    num_docked_ships = len(docked_ships)
+    
+    tokens.extend([plid, x, y, hp, r, docking, current, remaining, owned, owner, num_docked_ships])
+    tokens.extend(docked_ships)
+  
+  return ' '.join(map(str, tokens))
+
+
+def get_map(data, fid):
+  """Constructs the hlt.Map object corresponding to the state of the game
+  in frame <fid> + 1 of <data> (which is in replay format)."""
+  game_map = Map(None, data["width"], data["height"])
+  game_map._parse(frame_string(data, fid))
+  return game_map
+
+
 def get_maps(data):
   """Constructs a list of hlt.Map objects (corresponding to
   the states of the game in frames 1, 2, ...) from <data>
   (which is in replay format)."""
-  res = []
-  
-  num_players = data["num_players"]
+  return [get_map(data, fid) for fid in range(data["num_frames"])]
+
+
+class LazyMaps:
+  """A read-only list of the hlt.Map objects of the game <data>, like the one
+  returned by <get_maps>, except that a Map is constructed only when it is
+  accessed (and then remembered)."""
   
-  num_frames = data["num_frames"]
-  width = data["width"]
-  height = data["height"]
+  def __init__(self, data):
+    self.data = data
+    self._maps = {}
   
-  for fid in range(num_frames):
-    game_map = Map(None, width, height)
-    frame = data["frames"][fid]
-    tokens = []
-    
-    # Generate tokens for players (their ships).
-    tokens.append(num_players)
-    for pid, ships in frame["ships"].items():
-      tokens.append(pid)
-      tokens.append(len(ships))
-      for sid, ship in ships.items():
-        docked = ship["docking"]["status"]
-        docked = {"undocked": 0, "docking": 1, "docked": 2, "undocking": 3}[docked]
-        planet = ship["docking"].get("planet_id", -1)
-        progress = ship["docking"].get("turns_left", -1)
-        cooldown = ship["cooldown"]
-        
-        tokens.extend(map(lambda key: ship[key], ["id", "x", "y", "health", "vel_x", "vel_y"]))
-        tokens.extend([docked, planet, progress, cooldown])
-    
-    # Generate tokens for planets.
-    tokens.append(len(frame["planets"]))
-    for curr in frame["planets"].values():
-      plid = curr["id"]
-      origin = data["planets"][plid]
-      x = origin["x"]
-      y = origin["y"]
-      hp = curr["health"]
-      r = origin["r"]
-      docking = origin["docking_spots"]
-      current = curr["current_production"]
-      remaining = curr["remaining_production"]
-      owner = curr["owner"]
-      owned = (1 if owner is not None else 0)
-      if not owned:
-        owner = 0
-      docked_ships = curr["docked_ships"]
-      num_docked_ships = len(docked_ships)
-      
-      tokens.extend([plid, x, y, hp, r, docking, current, remaining, owned, owner, num_docked_ships])
-      tokens.extend(docked_ships)
-    
-    # Create a string representation, and let it be parsed to create a Map.
-    tokens = map(str, tokens)
-    game_map._parse(' '.join(tokens))
-    res.append(game_map)
+  def __len__(self):
+    return self.data["num_frames"]
   
-  return res
+  def __getitem__(self, fid):
+    if fid < 0:
+      fid += len(self)
+    if fid not in self._maps:
+      self._maps[fid] = get_map(self.data, fid)
+    return self._maps[fid]
 
 #########################################################################
 #### DICT CONVENIENCE METHODS ###########################################
@@ -218,6 +240,19 @@ def get_utilities(rewards, num_frames, discount, max_len):
 
 SHIP_DESCRIPTION = FEATURES + ["dx", "dy"] + INDICATORS + ["thrust", "dock", "undock"]
 
+"""The dtype of the tables and of the training matrices (X, y). float32 is
+plenty for the features and the utilities, and takes half the memory;
+anything that accumulates over many rows (the utilities' returns, the
+normal equations of linear regression) is computed in float64."""
+DTYPE = np.float32
+
+"""Format of the tables stored as CSV: 9 significant digits are enough to
+read a float32 back exactly."""
+CSV_FORMAT = "%.9g"
+
+"""Column of the thrust indicator."""
+THRUST = SHIP_DESCRIPTION.index("thrust")
+
 def feats_to_list(feats):
   """Returns the features as a list of their values in the order defined by
   SHIP_DESCRIPTION."""
@@ -227,31 +262,57 @@ def feats_from_list(src):
   """Returns a dictionary of things that describe the ship given by the list <src>."""
   return {name: src[i] for i, name in enumerate(SHIP_DESCRIPTION)}
 
-def to_table(data, sample_ratio = 0.1, discount = 0.95, max_len = 50, skip_tail = True, skip_short_game = True):
-  """Returns a numpy array where all columns except for the last are
-  the (original) attributes, and the last column is the attribute to be
-  predicted: the utility."""
-  
-  max_frame = data["num_frames"] - (max_len if skip_tail else 1)
-  if skip_short_game and max_frame <= 2 * max_len:
-    print("Game too short, skipping...")
-    return np.zeros((0, len(SHIP_DESCRIPTION) + 1))
+def sample_frames(num_frames, sample_ratio, seed = None):
+  """Draws the ids of the frames (out of the first <num_frames>) that make it
+  into the table, each with probability <sample_ratio>."""
+  rng = random.Random(seed)
+  return [fid for fid in range(num_frames) if rng.random() < sample_ratio]
+
+def extract(data, sample_ratio = 0.1, max_frame = None, seed = None, progress = None, fields = False, theta = None):
+  """The part of <to_table> that doesn't depend on the labeling (<data> is a
+  replay, or a game of the frame store, see my.frame_store): the
+  descriptions of the undocked ships in the frames sampled (as in
+  <to_table>) out of the first <max_frame> (all but the last by default),
+  and the rewards of all ships in all frames. Returns a dict of arrays:
+    "rows": one row per ship and frame, the SHIP_DESCRIPTION attributes,
+    "sids", "fids": the ship and frame of each row,
+    "reward_sids", "rewards": the reward matrix (see <reward_matrix>),
+    "num_frames": the length of the game.
+  The frames are sampled so that those of a smaller <max_frame> are always
+  a subset, so any <max_len> can be labeled later (see <relabel>)."""
+  if max_frame is None:
+    max_frame = data["num_frames"] - 1
   
-  res = []
+  rows = []
+  sids = []
+  fids_ = []
   
-  frame_maps = get_maps(data)
-  events = get_events(data)
-  moves = get_moves(data)
-  rewards = get_rewards(frame_maps, events)
-  utilities = get_utilities(rewards, len(frame_maps), discount, max_len)
+  fids = sample_frames(max(0, max_frame), sample_ratio, seed)
+  with instrument.timer("data.labels"):
+    if isinstance(data, dict):
+      frame_maps = LazyMaps(data)
+      events = get_events(data)
+      moves = get_moves(data)
+    else:
+      frame_maps = data.maps()
+      events = data.events()
+      moves = data.moves()
+    rewards = get_rewards(frame_maps, events)
+    reward_sids, reward_values = reward_matrix(rewards, len(frame_maps))
   
-  for fid, game_map in enumerate(frame_maps[: max_frame]):
-    if random.random() >= sample_ratio:
-      continue
-    print("Frame {}".format(fid + 1))
+  planet_fields = None
+  for done, fid in enumerate(fids):
+    with instrument.timer("data.map"):
+      game_map = frame_maps[fid]
     
-    clusters = all_clusters(game_map)
+    with instrument.timer("data.cluster"):
+      clusters = all_clusters(game_map, theta = theta)
     planets = game_map.all_planets()
+    if fields:
+      if planet_fields is None:
+        with instrument.timer("data.fields"):
+          planet_fields = PlanetFields(frame_maps[0])
+      planet_fields.update(game_map)
     
     for ship in game_map._all_ships():
       if ship.docking_status != ship.DockingStatus.UNDOCKED:
@@ -260,7 +321,8 @@ def to_table(data, sample_ratio = 0.1, discount = 0.95, max_len = 50, skip_tail
       move = get_val([sid, fid], moves, default = ("thrust", 0.0, 0.0))
       
       # Get the description of the ship.
-      feats = ship_features(ship, clusters, planets)
+      with instrument.timer("data.features"):
+        feats = ship_features(ship, clusters, planets, planet_fields)
       feats["dock"] = (1 if move[0] == "dock" else 0)
       feats["undock"] = (1 if move[0] == "undock" else 0)
       feats["thrust"] = (1 if move[0] == "thrust" and not feats["docked"] else 0)
@@ -271,24 +333,103 @@ def to_table(data, sample_ratio = 0.1, discount = 0.95, max_len = 50, skip_tail
         feats["dx"] = 0.0
         feats["dy"] = 0.0
       
-      u = get_val([sid, fid], utilities, default = 0.0)
-      subres = feats_to_list(feats)
-      subres.append(u)
-      res.append(subres)
+      rows.append(feats_to_list(feats))
+      sids.append(sid)
+      fids_.append(fid)
+    instrument.count("data.frames")
+    
+    if progress is not None:
+      progress(done + 1, len(fids))
+  
+  return {
+    "rows": np.array(rows, dtype = DTYPE).reshape(len(rows), len(SHIP_DESCRIPTION)),
+    "sids": np.array(sids, dtype = np.int64),
+    "fids": np.array(fids_, dtype = np.int64),
+    "reward_sids": reward_sids,
+    "rewards": reward_values,
+    "num_frames": np.array(data["num_frames"])
+  }
+
+def reward_matrix(rewards, num_frames):
+  """The rewards (see <get_rewards>) as a matrix: returns the ids of the
+  ships, and an array (ships, <num_frames>) of their rewards in each frame."""
+  sids = sorted(rewards.keys())
+  res = np.zeros((len(sids), num_frames))
+  for i, sid in enumerate(sids):
+    for fid, r in rewards[sid].items():
+      res[i, fid] = r
+  return np.array(sids, dtype = np.int64), res
+
+def utility_matrix(rewards, discount, max_len):
+  """<get_utilities> on a reward matrix: all ships at once."""
+  num_frames = rewards.shape[1]
+  returns = np.zeros_like(rewards)
+  curr = np.zeros(len(rewards))
+  for fid in range(num_frames - 1, -1, -1):
+    curr = curr * discount + rewards[:, fid]
+    returns[:, fid] = curr
+  # As in <get_utilities>, the utilities of the later frames are already
+  # final when they are subtracted.
+  res = returns
+  for fid in range(num_frames - 1 - max_len, -1, -1):
+    res[:, fid] -= res[:, fid + max_len] * discount**max_len
+  return res
+
+def relabel(game, discount = 0.95, max_len = 50, skip_tail = True, skip_short_game = True, dtype = DTYPE):
+  """Turns the output of <extract> into a table (as returned by <to_table>)
+  labeled with the utilities for <discount> and <max_len>. Cheap, compared
+  to <extract>."""
+  num_frames = int(game["num_frames"])
+  max_frame = num_frames - (max_len if skip_tail else 1)
+  if skip_short_game and max_frame <= 2 * max_len:
+    print("Game too short, skipping...")
+    return np.zeros((0, len(SHIP_DESCRIPTION) + 1), dtype = dtype)
+  
+  with instrument.timer("data.labels"):
+    keep = game["fids"] < max_frame
+    utilities = utility_matrix(game["rewards"], discount, max_len)
+    index = {sid: i for i, sid in enumerate(game["reward_sids"])}
+    rows = [index.get(sid, -1) for sid in game["sids"][keep]]
+    u = np.array([utilities[i, fid] if i >= 0 else 0.0 for i, fid in zip(rows, game["fids"][keep])])
+  return np.hstack([game["rows"][keep].astype(dtype, copy = False), u.reshape(len(u), 1).astype(dtype)])
+
+def to_table(data, sample_ratio = 0.1, discount = 0.95, max_len = 50, skip_tail = True, skip_short_game = True, seed = None, progress = None, fields = False, theta = None, dtype = DTYPE):
+  """Returns a numpy array where all columns except for the last are
+  the (original) attributes, and the last column is the attribute to be
+  predicted: the utility. The frames are sampled (by a random generator
+  seeded with <seed>) before anything else is done, only the sampled ones
+  are turned into Maps and described. If given, <progress> is called as
+  progress(done, total) after each sampled frame. If <fields>, the planet
+  sensors are read from PlanetFields built once for the game. If <theta>
+  is given, ships are grouped by quadtrees instead of KMeans. The table
+  is of <dtype>."""
+  
+  max_frame = data["num_frames"] - (max_len if skip_tail else 1)
+  if skip_short_game and max_frame <= 2 * max_len:
+    print("Game too short, skipping...")
+    return np.zeros((0, len(SHIP_DESCRIPTION) + 1), dtype = dtype)
   
-  print("Framing done.")
-  return np.array(res)
-
-def get_Xy(table, expander = identity):
-  """Selects the appropriate rows from <table>."""
-  X = []
-  y = []
-  for row in table:
-    feats = feats_from_list(row)
-    if feats["thrust"] != 1:
-      continue
-    X.append(expander(feats))
-    y.append(row[-1])
-  X = np.array(X)
-  y = np.array(y)
+  game = extract(data, sample_ratio, max_frame, seed, progress, fields, theta)
+  return relabel(game, discount, max_len, skip_tail, skip_short_game, dtype)
+
+def get_Xy(table, expander = identity, dtype = DTYPE):
+  """Selects the appropriate rows from <table>. X and y are of <dtype>; X
+  is filled in place, row by row, so no wider copy of it is ever made.
+  The expander gets Python floats, whatever the dtype of <table>."""
+  rows = table[table[:, THRUST] == 1] if len(table) > 0 else table
+  y = np.array(rows[:, -1] if len(rows) > 0 else [], dtype = dtype)
+  if len(rows) == 0:
+    return np.zeros(0, dtype = dtype), y
+  first = expander(feats_from_list(rows[0].tolist()))
+  X = np.empty((len(rows), len(first)), dtype = dtype)
+  X[0] = first
+  for i in range(1, len(rows)):
+    X[i] = expander(feats_from_list(rows[i].tolist()))
   return X, y
+
+def load_csv(path, dtype = DTYPE):
+  """Loads a table stored by <save_csv>."""
+  return np.loadtxt(path, delimiter = ',', dtype = dtype, ndmin = 2)
+
+def save_csv(path, table):
+  np.savetxt(path, table, delimiter = ',', fmt = CSV_FORMAT)
@@ -0,0 +1,52 @@
+import random
+import numpy as np
+from hlt import constants
+
+
+class PlanetIndex:
+  """Per-turn index of the planets: their positions, the distance from
+  which ships can dock to them, their owners and free docking spots, all
+  as numpy arrays."""
+  
+  def __init__(self, game_map):
+    self.planets = game_map.all_planets()
+    self.x = np.array([p.x for p in self.planets], dtype = float)
+    self.y = np.array([p.y for p in self.planets], dtype = float)
+    self.reach = np.array([p.radius for p in self.planets], dtype = float) + constants.DOCK_RADIUS + constants.SHIP_RADIUS
+    self.free = np.array([p.num_docking_spots - len(p.all_docked_ships()) for p in self.planets], dtype = int)
+    self.owner = np.array([(p.owner.id if p.is_owned() else -1) for p in self.planets], dtype = int)
+  
+  def dockable(self, player_id):
+    """Mask of planets where the player <player_id> may dock: those that are
+    not full and not owned by somebody else."""
+    return (self.free > 0) & ((self.owner == -1) | (self.owner == player_id))
+  
+  def candidates(self, ships, player_id):
+    """Returns a boolean matrix, whose (i, j) entry tells whether the i-th
+    ship of <ships> (owned by <player_id>) can dock to the j-th planet."""
+    if len(ships) == 0 or len(self.planets) == 0:
+      return np.zeros((len(ships), len(self.planets)), dtype = bool)
+    sx = np.array([s.x for s in ships], dtype = float)
+    sy = np.array([s.y for s in ships], dtype = float)
+    dist2 = (sx[:, None] - self.x[None, :])**2 + (sy[:, None] - self.y[None, :])**2
+    return (dist2 <= self.reach[None, :]**2) & self.dockable(player_id)[None, :]
+  
+  def assign(self, ships, player_id, rng = random):
+    """Chooses a planet to dock to for those of <ships> (undocked ships of
+    <player_id>) that can dock somewhere, randomly among their candidates.
+    Free spots are handed out at most once, so no planet gets more ships than
+    it has room for. Returns a dict {ship id: planet}."""
+    cands = self.candidates(ships, player_id)
+    remaining = self.free.copy()
+    order = list(range(len(ships)))
+    rng.shuffle(order)
+    
+    res = {}
+    for i in order:
+      options = np.flatnonzero(cands[i] & (remaining > 0))
+      if len(options) == 0:
+        continue
+      j = options[rng.randrange(len(options))]
+      remaining[j] -= 1
+      res[ships[i].id] = self.planets[j]
+    return res
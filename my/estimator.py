@@ -1,7 +1,9 @@
 import random, math
+from collections import OrderedDict
 import numpy as np
 
 import my.features as ft
+import my.instrument as instrument
 from hlt.entity import Position
 
 
@@ -9,8 +11,8 @@ from hlt.entity import Position
 #### FEATURE EXPANSION #################################################
 
 def identity(feats):
-  """Returns only the basic feats, as a numpy array."""
-  return np.array(list(map(lambda x: feats[x], ft.FEATURES)))
+  """Returns the basic feats and the move (dx, dy), as a numpy array."""
+  return np.array(list(map(lambda x: feats[x], ft.FEATURES)) + [feats.get("dx", 0.0), feats.get("dy", 0.0)])
 
 
 def get_nonmoves(feats):
@@ -53,6 +55,51 @@ def fight_expand(feats):
   
   return np.array(res)
 
+
+def get_moves_batch(dx, dy):
+  """Vectorized <get_moves>: returns a (n, 4) array of movement features for
+  the arrays of moves <dx>, <dy>."""
+  dx = np.asarray(dx, dtype = float)
+  dy = np.asarray(dy, dtype = float)
+  res = {
+    "up": np.maximum(-dy, 0.0),
+    "down": np.maximum(dy, 0.0),
+    "right": np.maximum(dx, 0.0),
+    "left": np.maximum(-dx, 0.0)
+  }
+  return np.stack([res[d] for d in ft.DIRECTIONS], axis = 1)
+
+
+def identity_batch(feats, dx, dy):
+  """Batch version of <identity>: one row per move in <dx>, <dy>."""
+  res = np.tile(identity(feats), (len(dx), 1))
+  res[:, -2] = dx
+  res[:, -1] = dy
+  return res
+
+
+def fight_expand_batch(feats, dx, dy):
+  """Batch version of <fight_expand>: one row per move in <dx>, <dy>. Nonmoves
+  are computed only once, the moves are combined with them in one go."""
+  nonmoves = get_nonmoves(feats)
+  moves = get_moves_batch(dx, dy)
+  combined = (moves[:, None, :] * nonmoves[None, :, None]).reshape(len(moves), -1)
+  return np.hstack([np.tile(nonmoves, (len(moves), 1)), combined])
+
+
+"""Batch versions of the expanders, used when many moves of a single ship
+are evaluated at once."""
+BATCH_EXPANDERS = {identity: identity_batch, fight_expand: fight_expand_batch}
+
+
+"""The expanders by name, as models are stored with them (see my.registry)."""
+EXPANDERS = {"identity": identity, "fight_expand": fight_expand}
+
+
+def input_width(expander):
+  """The number of model inputs <expander> makes of a ship's features."""
+  return len(expander({f: 0.0 for f in ft.FEATURES}))
+
 ########################################################################
 #### MOVE MAKER ########################################################
 
@@ -77,15 +124,435 @@ def fight(feats, fight_estimator):
   
   return res
 
+
+def to_moves(speeds, angles):
+  """Converts arrays of (speed, angle) commands into arrays of (dx, dy) moves."""
+  phi = np.radians(angles)
+  return speeds * np.cos(phi), speeds * np.sin(phi)
+
+
+def random_candidates(n, rng = np.random):
+  """Draws <n> random (speed, angle) commands, distributed the same way
+  as in <fight>, from <rng> (a RandomState, the global one by default)."""
+  angles = rng.randint(0, 360, n)
+  speeds = rng.randint(rng.randint(0, 8, n), 8)
+  return speeds, angles
+
+
+def segment_argmax(values, counts):
+  """<values> is split into consecutive segments of lengths <counts> (all
+  positive). For each segment, returns the index (into <values>) of its
+  first maximum."""
+  counts = np.asarray(counts)
+  offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+  maxima = np.maximum.reduceat(values, offsets)
+  segments = np.repeat(np.arange(len(counts)), counts)
+  hits = np.flatnonzero(values == maxima[segments])
+  _, first = np.unique(segments[hits], return_index = True)
+  return hits[first]
+
 ########################################################################
 #### ESTIMATOR (wrapper for predictor) #################################
 
 class Estimator:
-  def __init__(self, model, expander = identity):
+  """Wraps a model (anything with a <predict> method) together with the
+  expander that turns ship features into the model's input. Values of expanded
+  inputs can be memoized: inputs are rounded to <cache_decimals> decimals,
+  and the <cache_size> most recently used ones are kept. The cache is off
+  (<cache_size> 0) by default: a fleet turn alone scores more distinct rows
+  than it could usefully keep.
+  
+  A linear model (one with <coef_> and <intercept_>) on <fight_expand> rows
+  is bilinear in the nonmoves and the moves:
+    value = a + nonmoves · w + nonmoves · W · moves,
+  where w is the first part of <coef_> and W the rest, reshaped. If
+  <closed_form>, such models skip the expansion (and the cache): moves are
+  scored from nonmoves · W, computed once per ship.
+  
+  Similarly, for a stack of dense layers on <identity> rows, only the last
+  two inputs (dx, dy) differ between the moves of a ship. The first layer's
+  pre-activation of the ship's features is computed once per ship, and
+  each move only adds dx · W[-2] + dy · W[-1]; the rest of the network is
+  then run on all moves at once."""
+  
+  def __init__(self, model, expander = identity, cache_size = 0, cache_decimals = 6, closed_form = True):
     self.expander = expander
+    self.closed_form = closed_form
+    self.cache_size = cache_size
+    self.cache_decimals = cache_decimals
+    self.hits = 0
+    self.misses = 0
+    self._cache = OrderedDict()
     self.model = model
   
+  @property
+  def model(self):
+    return self._model
+  
+  @model.setter
+  def model(self, model):
+    """Replacing the model invalidates the cache."""
+    self._model = model
+    self.invalidate()
+  
+  def bilinear(self):
+    """Returns (a, w, W) of the closed form (see above), or None if the model
+    doesn't have one."""
+    model = self._model
+    if not self.closed_form or self.expander is not fight_expand or not hasattr(model, "coef_"):
+      return None
+    coef = np.asarray(model.coef_, dtype = float).ravel()
+    n = len(ft.FEATURES) + len(ft.STAT_FEATURES) * len(ft.DIR_FEATURES)
+    if len(coef) != n * (1 + len(ft.DIRECTIONS)):
+      return None
+    return float(np.ravel(model.intercept_)[0]), coef[:n], coef[n:].reshape(n, len(ft.DIRECTIONS))
+  
+  def factored(self):
+    """Returns the layers [(W, b, activation), ...] of the model, for the
+    factored evaluation (see above), or None if it's not a stack of dense
+    layers on <identity> rows."""
+    from my.registry import export, ACTIVATIONS
+    
+    model = self._model
+    if not self.closed_form or self.expander is not identity or model is None or hasattr(model, "coef_"):
+      return None
+    try:
+      kind, arrays, activations = export(model)
+    except (AttributeError, KeyError, TypeError, ValueError):
+      return None
+    if kind != "dense" or any(a not in ACTIVATIONS for a in activations):
+      return None
+    layers = [(arrays["W{}".format(i)], arrays["b{}".format(i)], a) for i, a in enumerate(activations)]
+    if layers[0][0].shape[0] != len(ft.FEATURES) + 2:
+      return None
+    return layers
+  
+  def invalidate(self):
+    """Forgets all cached values. Happens automatically whenever the model is
+    replaced, call it explicitly if the model was changed in place."""
+    self._cache.clear()
+    self._bilinear = self.bilinear()
+    self._factored = self.factored()
+  
+  def cache_info(self):
+    """Returns the hit/miss counters and the current size of the cache."""
+    return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+  
+  def predict(self, X):
+    """Values of the already expanded rows of <X>. Rows not found in the cache
+    are scored by a single model call."""
+    instrument.count("estimator.rows", len(X))
+    if self.cache_size <= 0:
+      with instrument.timer("estimator.predict"):
+        return np.asarray(self.model.predict(X), dtype = float).ravel()
+    
+    # Round the rows (the +0.0 turns negative zeros into positive ones), and
+    # find the distinct ones by viewing each row as a single opaque value.
+    keys = np.ascontiguousarray(np.round(X, self.cache_decimals) + 0.0, dtype = float).reshape(len(X), -1)
+    rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+    distinct, first, inverse = np.unique(rows, return_index = True, return_inverse = True)
+    inverse = inverse.ravel()
+    vals = np.empty(len(distinct))
+    cached = np.zeros(len(distinct), dtype = bool)
+    for j, key in enumerate(distinct.tolist()):
+      val = self._cache.get(key)
+      if val is not None:
+        self._cache.move_to_end(key)
+        vals[j] = val
+        cached[j] = True
+    
+    # Score each distinct missing row once. Only rows that were in the cache
+    # before this call count as hits.
+    hits = int(np.count_nonzero(cached[inverse]))
+    self.hits += hits
+    self.misses += len(X) - hits
+    missing = np.flatnonzero(~cached)
+    instrument.count("estimator.cache_misses", len(missing))
+    if len(missing) > 0:
+      with instrument.timer("estimator.predict"):
+        vals[missing] = np.asarray(self.model.predict(X[first[missing]]), dtype = float).ravel()
+      for j in missing:
+        self._cache[distinct[j].tobytes()] = vals[j]
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last = False)
+    return vals[inverse]
+  
   def value_of(self, feats):
     x = self.expander(feats)
     x = x.reshape(1, x.shape[0])
-    return float(self.model.predict(x))
+    return float(self.predict(x)[0])
+  
+  def expand_moves(self, feats, dx, dy):
+    """Expands <feats> once for each of the moves <dx>, <dy>, and returns the
+    rows as a matrix."""
+    batch = BATCH_EXPANDERS.get(self.expander)
+    if batch is not None:
+      return batch(feats, dx, dy)
+    res = []
+    for mx, my in zip(dx, dy):
+      curr = dict(feats, dx = mx, dy = my)
+      res.append(self.expander(curr))
+    return np.array(res)
+  
+  def values_of_moves(self, s_feats, dx, dy, counts):
+    """Values of moves of several ships at once. The moves <dx>, <dy> are split
+    into consecutive segments of lengths <counts>, one for each ship in
+    <s_feats>. All rows are scored by a single call to <predict>."""
+    if self._bilinear is not None:
+      return self.values_of_moves_closed(s_feats, dx, dy, counts)
+    if self._factored is not None:
+      return self.values_of_moves_factored(s_feats, dx, dy, counts)
+    with instrument.timer("estimator.expand"):
+      rows = []
+      start = 0
+      for feats, count in zip(s_feats, counts):
+        rows.append(self.expand_moves(feats, dx[start: start + count], dy[start: start + count]))
+        start += count
+      X = np.vstack(rows)
+    return self.predict(X)
+  
+  def values_of_moves_closed(self, s_feats, dx, dy, counts):
+    """<values_of_moves> in the closed form: a 4-wide dot product per move."""
+    instrument.count("estimator.rows", len(dx))
+    a, w, W = self._bilinear
+    with instrument.timer("estimator.predict"):
+      nonmoves = np.array([get_nonmoves(feats) for feats in s_feats]).reshape(len(s_feats), len(w))
+      base = a + nonmoves.dot(w)
+      V = nonmoves.dot(W)
+      ships = np.repeat(np.arange(len(s_feats)), counts)
+      return base[ships] + np.einsum("ij,ij->i", get_moves_batch(dx, dy), V[ships])
+  
+  def values_of_moves_factored(self, s_feats, dx, dy, counts):
+    """<values_of_moves> for dense networks: the ships' features go through
+    the first layer once per ship, the moves add a rank-2 term."""
+    from my.registry import ACTIVATIONS
+    
+    instrument.count("estimator.rows", len(dx))
+    layers = self._factored
+    W, b, activation = layers[0]
+    with instrument.timer("estimator.predict"):
+      F = np.array([[feats[f] for f in ft.FEATURES] for feats in s_feats]).reshape(len(s_feats), len(ft.FEATURES))
+      base = F.dot(W[:-2]) + b
+      ships = np.repeat(np.arange(len(s_feats)), counts)
+      h = base[ships] + np.outer(dx, W[-2]) + np.outer(dy, W[-1])
+      h = ACTIVATIONS[activation](h)
+      for W, b, activation in layers[1:]:
+        h = ACTIVATIONS[activation](h.dot(W) + b)
+      return h.ravel()
+
+########################################################################
+#### INFERENCE SERVER ##################################################
+
+# Many bot processes on one machine can share one model: a server holds the
+# model, and the bots' Estimators get a RemoteModel, which sends the rows to
+# the server over a Unix socket. The server gathers the requests that come
+# in within a short window and scores them with a single model call, so the
+# model (and its framework) is loaded once per machine, and the batches get
+# larger. A bot uses the server if HALITE_INFERENCE_SOCKET is set (see
+# my.registry.load_estimator).
+#
+# Messages: a request is a byte b"P" followed by the number of rows and
+# columns (two unsigned 32-bit ints) and the float64 rows; the response is
+# the number of values and the float64 values. A request b"M" is answered
+# by the length of and the JSON with the model's description, which holds
+# the expander, the features the model was trained on and the number of
+# its inputs.
+#
+# The server reads each connection only when it is readable, once, into
+# the connection's buffer, and takes the complete requests out of it; so a
+# client that sends half a request doesn't hold up the others.
+
+INFERENCE_SOCKET = "HALITE_INFERENCE_SOCKET"
+
+
+def parse_request(buf):
+  """Takes the first request out of <buf> (a bytearray): returns (b"M", None)
+  or (b"P", rows), or None if the request is not complete yet."""
+  import struct
+  if len(buf) == 0:
+    return None
+  kind = bytes(buf[:1])
+  if kind == b"M":
+    del buf[:1]
+    return kind, None
+  if kind != b"P":
+    raise ValueError("Unknown request {!r}".format(kind))
+  if len(buf) < 9:
+    return None
+  n, m = struct.unpack("!II", bytes(buf[1:9]))
+  end = 9 + 8 * n * m
+  if len(buf) < end:
+    return None
+  X = np.frombuffer(bytes(buf[9:end]), dtype = np.float64).reshape(n, m)
+  del buf[:end]
+  return kind, X
+
+
+def recv_exactly(conn, n):
+  buf = bytearray()
+  while len(buf) < n:
+    chunk = conn.recv(n - len(buf))
+    if len(chunk) == 0:
+      raise EOFError("Connection closed")
+    buf += chunk
+  return bytes(buf)
+
+
+class RemoteModel:
+  """A model whose <predict> is computed by an InferenceServer listening at
+  <path>."""
+  
+  def __init__(self, path):
+    import socket
+    self.path = path
+    self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.conn.connect(path)
+  
+  def predict(self, X):
+    import struct
+    X = np.ascontiguousarray(X, dtype = np.float64)
+    X = X.reshape(len(X), -1)
+    self.conn.sendall(b"P" + struct.pack("!II", X.shape[0], X.shape[1]) + X.tobytes())
+    n, = struct.unpack("!I", recv_exactly(self.conn, 4))
+    return np.frombuffer(recv_exactly(self.conn, 8 * n), dtype = np.float64)
+  
+  def meta(self):
+    """The description the server was started with."""
+    import json, struct
+    self.conn.sendall(b"M")
+    n, = struct.unpack("!I", recv_exactly(self.conn, 4))
+    return json.loads(recv_exactly(self.conn, n).decode())
+
+
+class InferenceServer:
+  """Serves <model> at the Unix socket <path>. Once a request comes in, the
+  server waits up to <window> seconds (or until <max_rows> rows) for more,
+  then scores them all at once. <meta> is sent to clients who ask (the
+  name of the expander, the features and the number of inputs, see
+  my.registry.load_estimator)."""
+  
+  def __init__(self, model, path, meta = None, window = 0.002, max_rows = 10**5):
+    self.model = model
+    self.path = path
+    self.meta = dict(meta or {})
+    self.window = window
+    self.max_rows = max_rows
+    self.batches = 0
+    self.requests = 0
+  
+  def serve(self, stop = None):
+    """Serves until <stop> (a threading or multiprocessing Event) is set."""
+    import json, os, selectors, socket, struct, time
+    
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(self.path)
+    listener.listen(128)
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    meta = json.dumps(self.meta).encode()
+    buffers = {}
+    
+    def drop(conn):
+      sel.unregister(conn)
+      conn.close()
+      del buffers[conn]
+    
+    try:
+      while stop is None or not stop.is_set():
+        # Gather requests: block for the first one, then wait at most
+        # <window> for others.
+        pending = []
+        rows = 0
+        deadline = None
+        while rows < self.max_rows:
+          timeout = (0.1 if deadline is None else max(deadline - time.perf_counter(), 0))
+          events = sel.select(timeout)
+          if len(events) == 0:
+            break
+          for key, mask in events:
+            if key.fileobj is listener:
+              conn, _ = listener.accept()
+              sel.register(conn, selectors.EVENT_READ)
+              buffers[conn] = bytearray()
+              continue
+            conn = key.fileobj
+            try:
+              chunk = conn.recv(1 << 20)
+            except OSError:
+              chunk = b""
+            if len(chunk) == 0:
+              drop(conn)
+              continue
+            buf = buffers[conn]
+            buf += chunk
+            try:
+              while True:
+                request = parse_request(buf)
+                if request is None:
+                  break
+                kind, X = request
+                if kind == b"M":
+                  conn.sendall(struct.pack("!I", len(meta)) + meta)
+                  continue
+                pending.append((conn, X))
+                rows += len(X)
+                if deadline is None:
+                  deadline = time.perf_counter() + self.window
+            except (ValueError, OSError):
+              drop(conn)
+        self.reply(pending)
+    finally:
+      sel.close()
+      listener.close()
+      if os.path.exists(self.path):
+        os.remove(self.path)
+  
+  def reply(self, pending):
+    """Scores the rows of all <pending> requests with one call per input
+    width, and sends each its values."""
+    import struct
+    by_width = OrderedDict()
+    for conn, X in pending:
+      by_width.setdefault(X.shape[1], []).append((conn, X))
+    for group in by_width.values():
+      X = np.vstack([X for conn, X in group])
+      values = (np.asarray(self.model.predict(X), dtype = np.float64).ravel() if len(X) > 0 else np.zeros(0))
+      self.batches += 1
+      start = 0
+      for conn, X in group:
+        part = values[start: start + len(X)]
+        start += len(X)
+        self.requests += 1
+        try:
+          conn.sendall(struct.pack("!I", len(part)) + part.tobytes())
+        except OSError:
+          pass
+
+
+def main():
+  import argparse
+  from my.registry import load_estimator
+  
+  parser = argparse.ArgumentParser(description = "Serves a model to the bots on this machine over a Unix socket.")
+  parser.add_argument("--socket", help = "Path of the socket", default = "/tmp/halite-inference.sock")
+  parser.add_argument("--learner", help = "Which model to serve (linear, neural_net), as the bots would load it", default = "linear")
+  parser.add_argument("--window", type = float, help = "How long (in seconds) to wait for more requests to batch together", default = 0.002)
+  args = parser.parse_args()
+  
+  if args.learner == "linear":
+    from sklearn.externals import joblib
+    estimator = load_estimator("linear", "model/regressor.pkl", joblib.load, remote = False)
+  else:
+    def load_keras(path):
+      from keras.models import load_model
+      return load_model(path)
+    estimator = load_estimator("neural_net", "model/neural_net.h5", load_keras, remote = False)
+  server = InferenceServer(estimator.model, args.socket, {"expander": estimator.expander.__name__, "features": ft.FEATURES, "inputs": input_width(estimator.expander)}, args.window)
+  print("Serving at", args.socket)
+  server.serve()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,112 @@
+import argparse
+import itertools
+import multiprocessing
+import os.path
+import numpy as np
+
+from my.data import extract, relabel
+
+
+# Preprocessing in two stored parts: the expensive, label-independent
+# features (see <extract>) and the per-game reward matrix are stored once
+# per game, as an .npz file in the store directory. Tables for any discount
+# and horizon are then labeled from them cheaply (see <relabel>), so
+# trying other labels doesn't recompute any features. The sweep trains a
+# model for each of several label settings, in parallel.
+
+def game_path(directory, number):
+  return os.path.join(directory, "game-{:05d}.npz".format(number))
+
+
+def build(raw_data, directory, sample_ratio = 0.1, seed = None, progress = None, fields = False, theta = None):
+  """Extracts the features and rewards of each game of <raw_data> into
+  <directory> (game i is sampled with seed + i). Returns the number of
+  games stored."""
+  os.makedirs(directory, exist_ok = True)
+  seeds = (itertools.repeat(None) if seed is None else itertools.count(seed))
+  count = 0
+  for number, (data, game_seed) in enumerate(zip(raw_data, seeds)):
+    game = extract(data, sample_ratio, seed = game_seed, progress = progress, fields = fields, theta = theta)
+    np.savez(game_path(directory, number), **game)
+    count += 1
+  return count
+
+
+def load_game(path):
+  with np.load(path) as f:
+    return {key: f[key] for key in f.files}
+
+
+def load_table(directory, discount = 0.95, max_len = 50, skip_tail = True, skip_short_game = True):
+  """The table of all games in <directory>, labeled for <discount> and
+  <max_len> (the same as <to_table> would give)."""
+  paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.startswith("game-") and f.endswith(".npz"))
+  return np.concatenate([relabel(load_game(path), discount, max_len, skip_tail, skip_short_game) for path in paths])
+
+########################################################################
+#### SWEEP #############################################################
+
+def train_setting(job):
+  """Trains the model of one label setting, returns its summary."""
+  import my.train as train
+  from my.data import get_Xy
+  from my.estimator import fight_expand, identity
+  
+  table = load_table(job["store"], job["discount"], job["max_len"])
+  name = "{}-d{}-l{}".format(job["learner"], job["discount"], job["max_len"])
+  os.makedirs(job["out"], exist_ok = True)
+  if job["learner"] == "linear":
+    X, y = get_Xy(table, fight_expand)
+    train.learn_regression(X, y, save_location = os.path.join(job["out"], name + ".pkl"), verbose = False)
+  else:
+    X, y = get_Xy(table, identity)
+    train.learn_neural_net(X, y, save_location = os.path.join(job["out"], name + ".h5"), verbose = False)
+  return {"setting": name, "rows": len(y), "utility_mean": float(np.mean(y)) if len(y) > 0 else None, "utility_std": float(np.std(y)) if len(y) > 0 else None}
+
+
+def sweep(store, settings, learner = "linear", out = os.path.join("model", "sweep"), processes = None):
+  """Trains a model for each (discount, max_len) in <settings> on the
+  features in <store>, in a pool of <processes> processes."""
+  jobs = [{"store": store, "discount": d, "max_len": l, "learner": learner, "out": out} for d, l in settings]
+  if processes == 1:
+    return list(map(train_setting, jobs))
+  with multiprocessing.Pool(processes) as pool:
+    return pool.map(train_setting, jobs)
+
+
+def parse_settings(text):
+  """Parses "0.9:50,0.95:30" into [(0.9, 50), (0.95, 30)]."""
+  res = []
+  for item in text.split(','):
+    d, l = item.split(':')
+    res.append((float(d), int(l)))
+  return res
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Builds a feature store from replays, and trains models for several label settings on it.")
+  parser.add_argument("--store", help = "Directory of the feature store", default = "features")
+  parser.add_argument("--data", help = "Build the store from this data directory or zip file first", default = None)
+  parser.add_argument("--games_limit", type = int, help = "Use up to games_limit games", default = 100)
+  parser.add_argument("--sample_ratio", type = float, help = "Percentage of frames to take from each game", default = 0.1)
+  parser.add_argument("--seed", type = int, help = "Seed for sampling the frames (game i uses seed + i)", default = None)
+  parser.add_argument("--settings", help = "Comma-separated discount:max_len pairs to train on", default = "0.9:50")
+  parser.add_argument("--learner", help = "Which learner (linear, neural_net)", default = "linear")
+  parser.add_argument("--out", help = "Where the models are stored", default = os.path.join("model", "sweep"))
+  parser.add_argument("--processes", type = int, help = "Number of processes (all cores by default)", default = None)
+  args = parser.parse_args()
+  
+  if args.data is not None:
+    from my.train import fetch_data_dir, fetch_data_zip, report_progress
+    if args.data.endswith('.zip'):
+      raw_data = fetch_data_zip(args.data, args.games_limit)
+    else:
+      raw_data = fetch_data_dir(args.data, args.games_limit)
+    print("Stored {} games.".format(build(raw_data, args.store, args.sample_ratio, args.seed, report_progress)))
+  
+  for res in sweep(args.store, parse_settings(args.settings), args.learner, args.out, args.processes):
+    print(res)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,4 +1,6 @@
 import numpy as np
+import my.instrument as instrument
+from my.quadtree import sensed
 
 import logging
 
@@ -101,8 +103,9 @@ for what in planet_sensors.keys():
 FEATURES = STAT_FEATURES + DIR_FEATURES
 
 
-def ship_features(ship, clusters, planets):
-  """Calculate features for <ship>."""
+def ship_features(ship, clusters, planets, fields = None):
+  """Calculate features for <ship>. If <fields> (PlanetFields, updated for
+  this turn) are given, the planet sensors are read from them."""
   res = {
     "docked": (1 if ship.docking_status == ship.DockingStatus.DOCKED else 0),
     "health": ship.health / 255.0
@@ -111,17 +114,19 @@ def ship_features(ship, clusters, planets):
   # Number sense: how many ships are there in this direction?
   # Health sense: how healthy are ships in this direction?
   ship_data = []
-  for player_clusters in clusters:
-    by_ship_type = {}
-    for ship_type, sub_clusters in player_clusters.items():
-      by_sensor = {}
-      for sensor, sensor_func in ship_sensors.items():
-        by_direction = {}
-        for proj, proj_func in dir_projs.items():
-          by_direction[proj] = sum(map(lambda c: fire(ship, c, sensor_func, proj_func), sub_clusters))
-        by_sensor[sensor] = by_direction
-      by_ship_type[ship_type] = by_sensor
-    ship_data.append(by_ship_type)
+  with instrument.timer("features.ship_sensors"):
+    for player_clusters in clusters:
+      by_ship_type = {}
+      for ship_type, sub_clusters in player_clusters.items():
+        near = sensed(sub_clusters, ship)
+        by_sensor = {}
+        for sensor, sensor_func in ship_sensors.items():
+          by_direction = {}
+          for proj, proj_func in dir_projs.items():
+            by_direction[proj] = sum(map(lambda c: fire(ship, c, sensor_func, proj_func), near))
+          by_sensor[sensor] = by_direction
+        by_ship_type[ship_type] = by_sensor
+      ship_data.append(by_ship_type)
   
   # Put it into <res>.
   for who in ["ally", "enemy"]:
@@ -136,18 +141,22 @@ def ship_features(ship, clusters, planets):
   
   # Collision sense: don't crash into planet!
   # Objective sense: aim for nearby planets with many docking spots.
-  for sensor, sensor_func in planet_sensors.items():
-    for proj, proj_func in dir_projs.items():
-      res["{}_{}".format(sensor, proj)] = sum(map(lambda p: fire(ship, p, sensor_func, proj_func), planets))
+  with instrument.timer("features.planet_sensors"):
+    if fields is not None:
+      res.update(fields.planet_features(ship))
+      return res
+    for sensor, sensor_func in planet_sensors.items():
+      for proj, proj_func in dir_projs.items():
+        res["{}_{}".format(sensor, proj)] = sum(map(lambda p: fire(ship, p, sensor_func, proj_func), planets))
   
   return res
 
 
-def my_ships_features(game_map, clusters):
+def my_ships_features(game_map, clusters, fields = None):
   """Returns the features for each of our ships."""
   res = []
   for ship in game_map.get_me().all_ships():
-    res.append(ship_features(ship, clusters, game_map.all_planets()))
+    res.append(ship_features(ship, clusters, game_map.all_planets(), fields))
   return res
 
 #######################################################################
@@ -0,0 +1,168 @@
+import numpy as np
+
+import my.features as ft
+from hlt.constants import SHIP_RADIUS
+
+
+# Planets don't move, so the planet sensors (see my.features) of a ship
+# depend only on its position and on which planets are alive, whom they
+# belong to and how many free docking spots they have. We precompute,
+# once per game, for each planet the four directional projections of
+# <proximity> on a grid over the map: the basis. In each turn, the
+# "proximity" field is the sum of the bases of the living planets, and the
+# "docks" field of a player is the sum weighted by the free spots of the
+# planets the player may dock at. The planet features of any position are
+# then read off the fields by bilinear interpolation, in O(1).
+#
+# The fields are an approximation, good to within the change of the sensors
+# over one grid cell. The grid has a point every <resolution> units, the
+# basis takes 4 * planets * (width / resolution) * (height / resolution)
+# floats.
+
+
+def planet_basis(xs, ys, planet_x, planet_y, planet_radius):
+  """The four directional projections (in the order of ft.DIRECTIONS) of
+  the proximity of a ship at each point of the grid <xs> × <ys> to the
+  planet. Returns an array of shape (4, len(ys), len(xs))."""
+  dx = xs[None, :] - planet_x
+  dy = ys[:, None] - planet_y
+  dist = np.sqrt(dx**2 + dy**2)
+  prox = 1.0 / np.maximum(1.0, dist - SHIP_RADIUS - planet_radius)**2
+  # The projections of <ft.x_> and <ft.y_>, but seen from the ship.
+  safe = np.where(dist > 0.0, dist, 1.0)
+  rx = np.where(dist > 0.0, -dx / safe, 1.0)
+  ry = np.where(dist > 0.0, -dy / safe, 1.0)
+  res = {
+    "up": np.maximum(-prox * ry, 0.0),
+    "down": np.maximum(prox * ry, 0.0),
+    "right": np.maximum(prox * rx, 0.0),
+    "left": np.maximum(-prox * rx, 0.0)
+  }
+  return np.stack([res[d] for d in ft.DIRECTIONS])
+
+
+def field_key(sensor, player_id):
+  """Fields of "proximity" are the same for all players."""
+  return (sensor if sensor == "proximity" else (sensor, player_id))
+
+
+class PlanetFields:
+  """The planet sensor fields of a game, built from the planets of
+  <game_map> (one from the start of the game, when all of them are alive)."""
+  
+  def __init__(self, game_map, resolution = 1.0, dtype = np.float32):
+    self.width = game_map.width
+    self.height = game_map.height
+    self.resolution = resolution
+    self.xs = np.arange(0.0, self.width + resolution, resolution)
+    self.ys = np.arange(0.0, self.height + resolution, resolution)
+    planets = game_map.all_planets()
+    self.ids = [p.id for p in planets]
+    self.index = {pid: i for i, pid in enumerate(self.ids)}
+    self.basis = np.empty((len(planets), len(ft.DIRECTIONS), len(self.ys), len(self.xs)), dtype = dtype)
+    for i, p in enumerate(planets):
+      self.basis[i] = planet_basis(self.xs, self.ys, p.x, p.y, p.radius)
+    self.alive = np.zeros(len(planets))
+    self.free = np.zeros(len(planets))
+    self.owner = np.full(len(planets), -1)
+    self._fields = {}
+    self._ships = {}
+  
+  def covers(self, game_map):
+    """Whether these fields are for the game of <game_map>."""
+    return (game_map.width, game_map.height) == (self.width, self.height) and all(p.id in self.index for p in game_map.all_planets())
+  
+  def state(self, game_map):
+    """The state of the planets of <game_map>: arrays alive, free and owner."""
+    alive = np.zeros(len(self.ids))
+    free = np.zeros(len(self.ids))
+    owner = np.full(len(self.ids), -1)
+    for p in game_map.all_planets():
+      i = self.index[p.id]
+      alive[i] = 1.0
+      free[i] = p.num_docking_spots - len(p.all_docked_ships())
+      owner[i] = (p.owner.id if p.is_owned() else -1)
+    return alive, free, owner
+  
+  def update(self, game_map, prefetched = None):
+    """Takes the current state of the planets from <game_map>. If the planets
+    are in the state <prefetched> (see <prefetch>) was computed for, its
+    fields and ship features are taken over."""
+    self.alive, self.free, self.owner = self.state(game_map)
+    self._fields = {}
+    self._ships = {}
+    if prefetched is not None:
+      state, fields, ships = prefetched
+      if all(np.array_equal(a, b) for a, b in zip(state, (self.alive, self.free, self.owner))):
+        self._fields = fields
+        self._ships = ships
+  
+  def prefetch(self, state, positions, player_id):
+    """Computes, without changing these fields, the fields for the planets in
+    <state> (see <state>), and the planet features of the ships {ship id:
+    (x, y)} of <positions> (owned by <player_id>). Returns them for
+    <update>."""
+    fields = {field_key(sensor, player_id): self.compute(sensor, player_id, state) for sensor in ft.planet_sensors.keys()}
+    ships = {}
+    if len(positions) > 0:
+      sids = list(positions.keys())
+      xs, ys = np.array([positions[sid] for sid in sids]).T
+      values = {}
+      for sensor in ft.planet_sensors.keys():
+        values[sensor] = self.lookup(fields[field_key(sensor, player_id)], xs, ys)
+      for n, sid in enumerate(sids):
+        feats = {}
+        for sensor in ft.planet_sensors.keys():
+          for k, d in enumerate(ft.DIRECTIONS):
+            feats["{}_{}".format(sensor, d)] = float(values[sensor][n, k])
+        ships[sid] = (positions[sid], feats)
+    return state, fields, ships
+  
+  def field(self, sensor, player_id = None):
+    """The field (4, len(ys), len(xs)) of <sensor> ("proximity", or "docks"
+    for a ship of player <player_id>), for the current turn."""
+    key = field_key(sensor, player_id)
+    if key not in self._fields:
+      self._fields[key] = self.compute(sensor, player_id, (self.alive, self.free, self.owner))
+    return self._fields[key]
+  
+  def compute(self, sensor, player_id, state):
+    """The field of <sensor> for the planets in <state> (see <state>)."""
+    alive, free, owner = state
+    if sensor == "proximity":
+      weights = alive
+    else:
+      weights = alive * free * ((owner == -1) | (owner == player_id))
+    return np.tensordot(weights.astype(self.basis.dtype), self.basis, axes = 1)
+  
+  def lookup(self, field, x, y):
+    """Bilinear interpolation of <field> at the positions <x>, <y> (arrays).
+    Returns an array (len(x), 4)."""
+    gx = np.clip(np.asarray(x, dtype = float) / self.resolution, 0, len(self.xs) - 1)
+    gy = np.clip(np.asarray(y, dtype = float) / self.resolution, 0, len(self.ys) - 1)
+    i0 = np.minimum(gx.astype(int), len(self.xs) - 2)
+    j0 = np.minimum(gy.astype(int), len(self.ys) - 2)
+    fx = (gx - i0)[:, None]
+    fy = (gy - j0)[:, None]
+    res = (field[:, j0, i0].T * (1 - fx) * (1 - fy) + field[:, j0, i0 + 1].T * fx * (1 - fy)
+           + field[:, j0 + 1, i0].T * (1 - fx) * fy + field[:, j0 + 1, i0 + 1].T * fx * fy)
+    return res
+  
+  def features_at(self, x, y, player_id):
+    """The planet features ("<sensor>_<direction>") of ships of <player_id>
+    at positions <x>, <y>, as a dict of arrays."""
+    res = {}
+    for sensor in ft.planet_sensors.keys():
+      values = self.lookup(self.field(sensor, player_id), x, y)
+      for k, d in enumerate(ft.DIRECTIONS):
+        res["{}_{}".format(sensor, d)] = values[:, k]
+    return res
+  
+  def planet_features(self, ship):
+    """The planet features of <ship>, the same keys as in <ship_features>."""
+    if ship.id in self._ships:
+      (x, y), feats = self._ships[ship.id]
+      if abs(x - ship.x) < 1e-3 and abs(y - ship.y) < 1e-3:
+        return feats
+    res = self.features_at([ship.x], [ship.y], ship.owner.id)
+    return {key: float(values[0]) for key, values in res.items()}
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os.path
+import numpy as np
+from hlt.entity import Planet, Ship
+from hlt.game_map import Map, Player
+
+
+# Replays converted, once, into compact binary arrays, so that experiments
+# with the features read raw arrays instead of parsing the replay JSON
+# again. A game is a directory of .npy files (loaded memory-mapped) and a
+# meta.json with num_players, num_frames, width and height:
+#   - ships: one record per ship and frame (frames one after another, in
+#     the replay's order), with ship_start[fid] the first record of frame
+#     fid. Fields id, owner, x, y, health, vel_x, vel_y, docking status,
+#     planet, docking turns left and cooldown.
+#   - frame_players: the players listed in each frame (player_start).
+#   - planet_states: one record per planet and frame (planet_start), with
+#     the ids of the docked ships in docked (docked_start, per record).
+#   - planets: the planet table, x, y, r and docking spots.
+#   - events: attack, spawned and destroyed events (the ones <get_events>
+#     uses), with the targets of attacks in targets (target_start).
+#   - moves: one record per move.
+# FrameStore gives the same things the replay dict gives to my.data: the
+# Maps of the frames (see <maps>, built from the records of a frame with one
+# bulk conversion each, without going through the engine's text), the
+# moves and the events.
+
+DOCKING = ["undocked", "docking", "docked", "undocking"]
+EVENTS = ["attack", "spawned", "destroyed"]
+MOVES = ["thrust", "dock", "undock"]
+STATUSES = list(Ship.DockingStatus)
+
+SHIP_DTYPE = np.dtype([("id", np.int32), ("owner", np.int8), ("x", np.float64), ("y", np.float64), ("health", np.int32), ("vel_x", np.float64), ("vel_y", np.float64), ("docking", np.int8), ("planet", np.int16), ("turns_left", np.int16), ("cooldown", np.int16)])
+PLANET_STATE_DTYPE = np.dtype([("id", np.int16), ("health", np.int32), ("current_production", np.int32), ("remaining_production", np.int32), ("owner", np.int8)])
+PLANET_DTYPE = np.dtype([("id", np.int16), ("x", np.float64), ("y", np.float64), ("r", np.float64), ("docking_spots", np.int16)])
+EVENT_DTYPE = np.dtype([("frame", np.int32), ("kind", np.int8), ("entity", np.int32), ("planet", np.int16)])
+MOVE_DTYPE = np.dtype([("frame", np.int32), ("player", np.int8), ("ship", np.int32), ("kind", np.int8), ("magnitude", np.float32), ("angle", np.float32)])
+
+########################################################################
+#### CONVERSION ########################################################
+
+def offsets(counts):
+  return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def convert(data, directory):
+  """Converts the replay <data> into a game of the frame store at <directory>."""
+  ships, ship_counts = [], []
+  players, player_counts = [], []
+  states, state_counts = [], []
+  docked, docked_counts = [], []
+  events, targets, target_counts = [], [], []
+  for fid, frame in enumerate(data["frames"]):
+    player_counts.append(len(frame["ships"]))
+    count = 0
+    for pid, content in frame["ships"].items():
+      players.append(int(pid))
+      for ship in content.values():
+        d = ship["docking"]
+        ships.append((ship["id"], int(pid), ship["x"], ship["y"], ship["health"], ship["vel_x"], ship["vel_y"], DOCKING.index(d["status"]), d.get("planet_id", -1), d.get("turns_left", -1), ship["cooldown"]))
+        count += 1
+    ship_counts.append(count)
+    
+    state_counts.append(len(frame["planets"]))
+    for p in frame["planets"].values():
+      states.append((p["id"], p["health"], p["current_production"], p["remaining_production"], (-1 if p["owner"] is None else p["owner"])))
+      docked.extend(p["docked_ships"])
+      docked_counts.append(len(p["docked_ships"]))
+    
+    for ev in frame["events"]:
+      if ev["event"] not in EVENTS:
+        continue
+      planet = (ev["planet"]["id"] if "planet" in ev else -1)
+      events.append((fid, EVENTS.index(ev["event"]), ev["entity"]["id"], planet))
+      ids = [t["id"] for t in ev.get("targets", [])]
+      targets.extend(ids)
+      target_counts.append(len(ids))
+  
+  moves = []
+  for fid, frame in enumerate(data["moves"]):
+    for pid, content in frame.items():
+      for move in content[0].values():
+        moves.append((fid, int(pid), move["shipId"], MOVES.index(move["type"]), move.get("magnitude", 0), move.get("angle", 0)))
+  
+  planets = [(i, p["x"], p["y"], p["r"], p["docking_spots"]) for i, p in enumerate(data["planets"])]
+  
+  arrays = {
+    "ships": np.array(ships, dtype = SHIP_DTYPE),
+    "ship_start": offsets(ship_counts),
+    "frame_players": np.array(players, dtype = np.int8),
+    "player_start": offsets(player_counts),
+    "planet_states": np.array(states, dtype = PLANET_STATE_DTYPE),
+    "planet_start": offsets(state_counts),
+    "docked": np.array(docked, dtype = np.int32),
+    "docked_start": offsets(docked_counts),
+    "planets": np.array(planets, dtype = PLANET_DTYPE),
+    "events": np.array(events, dtype = EVENT_DTYPE),
+    "targets": np.array(targets, dtype = np.int32),
+    "target_start": offsets(target_counts),
+    "moves": np.array(moves, dtype = MOVE_DTYPE),
+  }
+  os.makedirs(directory, exist_ok = True)
+  for name, array in arrays.items():
+    np.save(os.path.join(directory, name + ".npy"), array)
+  with open(os.path.join(directory, "meta.json"), "w") as f:
+    meta = {key: data[key] for key in ["num_players", "num_frames", "width", "height"]}
+    json.dump(dict(meta, num_move_frames = len(data["moves"]), num_event_frames = len(data["frames"])), f)
+
+########################################################################
+#### LOADING ###########################################################
+
+class FrameStore:
+  """A game of the frame store. Indexing with the replay's keys
+  ("num_frames", "width", ...) gives its metadata."""
+  
+  def __init__(self, directory, mmap = True):
+    self.directory = directory
+    with open(os.path.join(directory, "meta.json")) as f:
+      self.meta = json.load(f)
+    self.arrays = {}
+    for name in os.listdir(directory):
+      if name.endswith(".npy"):
+        self.arrays[name[:-4]] = np.load(os.path.join(directory, name), mmap_mode = ("r" if mmap else None))
+    self._maps = {}
+    self._planets = None
+  
+  def __getitem__(self, key):
+    return self.meta[key]
+  
+  def __len__(self):
+    return self.meta["num_frames"]
+  
+  def get_map(self, fid):
+    """The hlt.Map of frame <fid>, the same as parsing the string the engine
+    would send, but built from the records directly."""
+    a = self.arrays
+    if self._planets is None:
+      self._planets = a["planets"].tolist()
+    players = {pid: {} for pid in a["frame_players"][a["player_start"][fid]: a["player_start"][fid + 1]].tolist()}
+    for sid, owner, x, y, health, vel_x, vel_y, docking, planet, turns_left, cooldown in a["ships"][a["ship_start"][fid]: a["ship_start"][fid + 1]].tolist():
+      players[owner][sid] = Ship(owner, sid, x, y, health, vel_x, vel_y, STATUSES[docking], planet, turns_left, cooldown)
+    
+    start, end = a["planet_start"][fid], a["planet_start"][fid + 1]
+    docked = a["docked"][a["docked_start"][start]: a["docked_start"][end]].tolist()
+    docked_start = (a["docked_start"][start: end + 1] - a["docked_start"][start]).tolist()
+    planets = {}
+    for i, (pid, health, current, remaining, owner) in enumerate(a["planet_states"][start: end].tolist()):
+      _, x, y, r, spots = self._planets[pid]
+      planets[pid] = Planet(pid, x, y, health, r, spots, current, remaining, owner >= 0, owner, docked[docked_start[i]: docked_start[i + 1]])
+    
+    game_map = Map(None, self.meta["width"], self.meta["height"])
+    game_map._players = {pid: Player(pid, ships) for pid, ships in players.items()}
+    game_map._planets = planets
+    game_map._link()
+    return game_map
+  
+  def maps(self):
+    """A lazy list of the Maps, like my.data.LazyMaps."""
+    return FrameMaps(self)
+  
+  def moves(self):
+    """The moves, as my.data.get_moves returns them."""
+    res = {}
+    phi = np.radians(self.arrays["moves"]["angle"].astype(float))
+    for m, angle in zip(self.arrays["moves"], phi):
+      fid = int(m["frame"])
+      if fid >= self.meta["num_move_frames"] - 1:
+        continue
+      kind = MOVES[m["kind"]]
+      if kind == "thrust":
+        speed = float(m["magnitude"])
+        res.setdefault(int(m["ship"]), {})[fid] = (kind, speed * np.cos(angle), speed * np.sin(angle))
+      else:
+        res.setdefault(int(m["ship"]), {})[fid] = (kind,)
+    return res
+  
+  def events(self):
+    """The events, as my.data.get_events returns them."""
+    from my.data import attack, spawn, destroy
+    res = {}
+    a = self.arrays
+    for i, ev in enumerate(a["events"]):
+      fid = int(ev["frame"])
+      if fid >= self.meta["num_event_frames"] - 1:
+        continue
+      sid = int(ev["entity"])
+      kind = EVENTS[ev["kind"]]
+      if kind == "attack":
+        attack(fid, sid, [int(t) for t in a["targets"][a["target_start"][i]: a["target_start"][i + 1]]], res)
+      elif kind == "spawned":
+        spawn(fid, sid, int(ev["planet"]), res)
+      else:
+        destroy(fid, sid, res)
+    return res
+
+
+class FrameMaps:
+  """Read-only lazy list of the Maps of a FrameStore game."""
+  
+  def __init__(self, store):
+    self.store = store
+  
+  def __len__(self):
+    return len(self.store)
+  
+  def __getitem__(self, fid):
+    if fid < 0:
+      fid += len(self)
+    if fid not in self.store._maps:
+      self.store._maps[fid] = self.store.get_map(fid)
+    return self.store._maps[fid]
+
+
+def open_games(directory):
+  """The FrameStores of all games in <directory>, in order."""
+  return [FrameStore(os.path.join(directory, name)) for name in sorted(os.listdir(directory)) if os.path.isfile(os.path.join(directory, name, "meta.json"))]
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Converts replays into the binary frame store.")
+  parser.add_argument("--data", help = "Data directory or zip file containing uncompressed games")
+  parser.add_argument("--games_limit", type = int, help = "Convert up to games_limit games", default = 100)
+  parser.add_argument("--out", help = "Directory of the frame store", default = "frames")
+  args = parser.parse_args()
+  
+  from my.train import fetch_data_dir, fetch_data_zip
+  if args.data.endswith('.zip'):
+    raw_data = fetch_data_zip(args.data, args.games_limit)
+  else:
+    raw_data = fetch_data_dir(args.data, args.games_limit)
+  for number, data in enumerate(raw_data):
+    convert(data, os.path.join(args.out, "game-{:05d}".format(number)))
+
+
+if __name__ == "__main__":
+  main()
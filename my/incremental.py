@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class RunningLinearRegression:
+  """Linear regression fitted from running sufficient statistics (the
+  weighted count, the means of x and y, and the centered sums of x xᵀ and
+  x y), so that it can learn from data in batches without keeping the data
+  around. Each call of <partial_fit> first multiplies the old weights by
+  <decay>, so older batches can be weighed down. The statistics are always
+  kept in float64; the data (which may be float32) is converted <chunk_rows>
+  rows at a time, and each chunk is centered on its own mean before it is
+  merged in (Chan et al.), so features with large means lose no precision.
+  A tiny ridge penalty keeps the normal equations solvable when some
+  feature is constant.
+  
+  Has the same <coef_>, <intercept_> and <predict> as sklearn's
+  LinearRegression."""
+  
+  def __init__(self, ridge = 1e-8, chunk_rows = 2**14):
+    self.ridge = ridge
+    self.chunk_rows = chunk_rows
+    self.n = 0.0
+    self.mean_x = None
+    self.mean_y = 0.0
+    self.cxx = None
+    self.cxy = None
+    self.coef_ = None
+    self.intercept_ = 0.0
+  
+  def partial_fit(self, X, y, decay = 1.0):
+    X = np.asarray(X)
+    y = np.asarray(y, dtype = np.float64).ravel()
+    if self.cxx is None:
+      self.mean_x = np.zeros(X.shape[1])
+      self.cxx = np.zeros((X.shape[1], X.shape[1]))
+      self.cxy = np.zeros(X.shape[1])
+    
+    # Decay weighs down all old rows alike: the means stay.
+    self.n *= decay
+    self.cxx *= decay
+    self.cxy *= decay
+    for start in range(0, len(y), self.chunk_rows):
+      self.merge(np.asarray(X[start: start + self.chunk_rows], dtype = np.float64), y[start: start + self.chunk_rows])
+    return self.solve()
+  
+  def merge(self, X, y):
+    """Merges the statistics of the rows <X>, <y> into the running ones."""
+    m = len(y)
+    if m == 0:
+      return
+    mean_x = X.mean(axis = 0)
+    mean_y = y.mean()
+    dx = X - mean_x
+    dy = y - mean_y
+    n = self.n + m
+    delta_x = mean_x - self.mean_x
+    delta_y = mean_y - self.mean_y
+    self.cxx += dx.T.dot(dx) + np.outer(delta_x, delta_x) * (self.n * m / n)
+    self.cxy += dx.T.dot(dy) + delta_x * delta_y * (self.n * m / n)
+    self.mean_x = self.mean_x + delta_x * (m / n)
+    self.mean_y = self.mean_y + delta_y * (m / n)
+    self.n = n
+  
+  def fit(self, X, y):
+    """Forgets everything, and fits on <X>, <y> only."""
+    self.__init__(self.ridge, self.chunk_rows)
+    return self.partial_fit(X, y)
+  
+  def solve(self):
+    """Recomputes the coefficients from the statistics."""
+    cov = self.cxx / self.n
+    cross = self.cxy / self.n
+    penalty = self.ridge * max(np.trace(cov) / len(cov), 1e-12)
+    self.coef_ = np.linalg.solve(cov + penalty * np.eye(len(cov)), cross)
+    self.intercept_ = self.mean_y - self.mean_x.dot(self.coef_)
+    return self
+  
+  def predict(self, X):
+    return np.asarray(X).dot(self.coef_) + self.intercept_
@@ -0,0 +1,112 @@
+import os, time
+from collections import deque
+
+
+# Lightweight instrumentation of the hot paths. Code is wrapped in
+#   with instrument.timer("stage"): ...
+# and counts things with instrument.count("what", n). Timings and counts
+# are gathered per turn; end_turn() closes the turn, and summary() reports
+# on the last <window> turns. Everything is off by default: then timer()
+# returns a shared do-nothing context manager and count() returns at once.
+# Setting the environment variable HALITE_INSTRUMENT=<window> enables it.
+
+
+class _NullTimer:
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, *exc):
+    return False
+
+
+class _Timer:
+  def __init__(self, turn, name):
+    self.turn = turn
+    self.name = name
+  
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+  
+  def __exit__(self, *exc):
+    elapsed = time.perf_counter() - self.start
+    self.turn[self.name] = self.turn.get(self.name, 0.0) + elapsed
+    return False
+
+
+NULL_TIMER = _NullTimer()
+
+_enabled = False
+_times = {}
+_counts = {}
+_history = deque(maxlen = 100)
+
+
+def enable(window = 100):
+  """Turns instrumentation on, summaries are over the last <window> turns."""
+  global _enabled, _history
+  _enabled = True
+  _history = deque(maxlen = window)
+  _times.clear()
+  _counts.clear()
+
+
+def disable():
+  global _enabled
+  _enabled = False
+
+
+def enabled():
+  return _enabled
+
+
+def timer(name):
+  """Context manager adding the time spent inside it to stage <name>."""
+  if not _enabled:
+    return NULL_TIMER
+  return _Timer(_times, name)
+
+
+def count(name, n = 1):
+  """Adds <n> to the counter <name>."""
+  if _enabled:
+    _counts[name] = _counts.get(name, 0) + n
+
+
+def end_turn():
+  """Closes the current turn, and returns its timings and counts."""
+  turn = {"times": dict(_times), "counts": dict(_counts)}
+  if _enabled:
+    _history.append(turn)
+  _times.clear()
+  _counts.clear()
+  return turn
+
+
+def summary():
+  """For each stage and counter, its value in the last turn, and the mean
+  and maximum over the turns in the window."""
+  res = {}
+  for kind in ["times", "counts"]:
+    names = sorted(set(name for turn in _history for name in turn[kind]))
+    res[kind] = {}
+    for name in names:
+      values = [turn[kind].get(name, 0) for turn in _history]
+      res[kind][name] = {"last": values[-1], "mean": sum(values) / len(values), "max": max(values)}
+  res["turns"] = len(_history)
+  return res
+
+
+def report():
+  """The summary as text, times in milliseconds."""
+  s = summary()
+  lines = ["Instrumentation over {} turns (last / mean / max):".format(s["turns"])]
+  for name, v in s["times"].items():
+    lines.append("  {}: {:.2f} / {:.2f} / {:.2f} ms".format(name, 1000 * v["last"], 1000 * v["mean"], 1000 * v["max"]))
+  for name, v in s["counts"].items():
+    lines.append("  {}: {} / {:.1f} / {}".format(name, v["last"], v["mean"], v["max"]))
+  return '\n'.join(lines)
+
+
+if os.environ.get("HALITE_INSTRUMENT"):
+  enable(int(os.environ["HALITE_INSTRUMENT"]))
@@ -0,0 +1,166 @@
+import argparse
+import json
+import multiprocessing
+import os.path
+import random, sys, time
+from collections import deque
+import numpy as np
+
+from my.data import frame_string
+
+
+# Plays a bot offline: instead of the halite binary, the frames of a
+# recorded replay are fed to the bot's hlt.Game through an in-process
+# stand-in for stdin/stdout. The bot's moves don't influence the following
+# frames, of course, but each turn sees a real game state, so the turns
+# can be timed reproducibly. Many (bot, replay, player) jobs can be run in
+# parallel, for tracking performance regressions.
+
+
+class ReplayExhausted(Exception):
+  """Raised when the bot asks for a frame after the last one."""
+  pass
+
+
+class ReplayPipe:
+  """Both ends of the bot's connection to the engine. The bot reads the
+  frames of <data> (in the order given by <fids>) as seen by player
+  <player_id>, and its output is collected: its name, and the command queue
+  of each turn. The time from handing out a frame to receiving the commands
+  is recorded for each turn."""
+  
+  def __init__(self, data, player_id, fids = None):
+    if fids is None:
+      fids = range(data["num_frames"])
+    fids = list(fids)
+    self.data = data
+    self.lines = deque([str(player_id), "{} {}".format(data["width"], data["height"])])
+    # The initial map comes before the bot sends its name, then the turns.
+    self.fids = deque(fids[:1] + fids)
+    self.name = None
+    self.commands = []
+    self.turn_times = []
+    self._buffer = []
+    self._sent_at = None
+  
+  def readline(self):
+    if len(self.lines) > 0:
+      return self.lines.popleft() + '\n'
+    if len(self.fids) == 0:
+      raise ReplayExhausted()
+    line = frame_string(self.data, self.fids.popleft())
+    self._sent_at = time.perf_counter()
+    return line + '\n'
+  
+  def write(self, s):
+    self._buffer.append(s)
+  
+  def flush(self):
+    text = ''.join(self._buffer)
+    self._buffer = []
+    for message in text.split('\n')[:-1]:
+      if self.name is None:
+        self.name = message
+        continue
+      self.commands.append(message)
+      if self._sent_at is not None:
+        self.turn_times.append(time.perf_counter() - self._sent_at)
+        self._sent_at = None
+
+
+def run_bot(bot, data, player_id, fids = None):
+  """Lets <bot> play the frames <fids> of the replay <data> as <player_id>.
+  Returns the pipe with the collected commands and turn times."""
+  pipe = ReplayPipe(data, player_id, fids)
+  stdin, stdout = sys.stdin, sys.stdout
+  sys.stdin = sys.stdout = pipe
+  try:
+    bot.play()
+  except ReplayExhausted:
+    pass
+  finally:
+    sys.stdin, sys.stdout = stdin, stdout
+  return pipe
+
+########################################################################
+#### MANY GAMES ########################################################
+
+def make_bot(kind, model = None, seed = 0):
+  """Creates a fleet bot. <kind> is one of "linear", "neural_net" (loading the
+  model from <model>), or "random" (a random linear model, no file needed)."""
+  from my.bot import Bot
+  from my.estimator import Estimator, fight_expand, identity
+  
+  if kind == "linear":
+    from sklearn.externals import joblib
+    estimator = Estimator(joblib.load(model), fight_expand)
+  elif kind == "neural_net":
+    from keras.models import load_model
+    estimator = Estimator(load_model(model), identity)
+  else:
+    from my.benchmark import RandomModel
+    estimator = Estimator(RandomModel(seed), fight_expand)
+  return Bot(estimator, "Offline", fleet = True)
+
+
+def run_job(job):
+  """Runs a single job (see <run_many>), returns its summary."""
+  from my.benchmark import percentiles
+  
+  random.seed(job["seed"])
+  np.random.seed(job["seed"])
+  with open(job["replay"]) as f:
+    data = json.load(f)
+  bot = make_bot(job["bot"], job.get("model"), job["seed"])
+  pipe = run_bot(bot, data, job["player"], job.get("fids"))
+  
+  res = dict(job)
+  res["turns"] = len(pipe.turn_times)
+  res["turn_times"] = (percentiles(pipe.turn_times) if len(pipe.turn_times) > 0 else None)
+  res["commands"] = pipe.commands
+  return res
+
+
+def run_many(jobs, processes = None):
+  """Runs the <jobs> in a pool of <processes> processes. A job is a dict with
+  keys "bot", "model" (see <make_bot>), "replay" (path to a replay file),
+  "player", "seed" and optionally "fids" (the frames to play)."""
+  if processes == 1:
+    return list(map(run_job, jobs))
+  with multiprocessing.Pool(processes) as pool:
+    return pool.map(run_job, jobs)
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Plays bots offline on recorded replays and times their turns.")
+  parser.add_argument("--data", help = "Directory with replays", default = ".")
+  parser.add_argument("--games_limit", type = int, help = "Use up to games_limit replays", default = 10)
+  parser.add_argument("--bot", help = "Which bot plays (linear, neural_net, random)", default = "random")
+  parser.add_argument("--model", help = "Model of the bot", default = None)
+  parser.add_argument("--frames", type = int, help = "Play only the first <frames> frames of each game", default = None)
+  parser.add_argument("--processes", type = int, help = "Number of processes (all cores by default)", default = None)
+  parser.add_argument("--seed", type = int, help = "Random seed", default = 0)
+  parser.add_argument("--out", help = "Store the full results (including commands) in this JSON file", default = None)
+  args = parser.parse_args()
+  
+  replays = sorted([os.path.join(args.data, f) for f in os.listdir(args.data) if f.startswith("replay-")])[:args.games_limit]
+  jobs = []
+  for replay in replays:
+    with open(replay) as f:
+      num_players = json.load(f)["num_players"]
+    for player in range(num_players):
+      job = {"bot": args.bot, "model": args.model, "replay": replay, "player": player, "seed": args.seed}
+      if args.frames is not None:
+        job["fids"] = list(range(args.frames))
+      jobs.append(job)
+  
+  results = run_many(jobs, args.processes)
+  if args.out is not None:
+    with open(args.out, "w") as f:
+      json.dump(results, f)
+  summary = [{key: r[key] for key in ["replay", "player", "turns", "turn_times"]} for r in results]
+  print(json.dumps(summary, indent = 2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,213 @@
+import argparse
+import json
+import multiprocessing, queue
+import os.path, subprocess
+import numpy as np
+
+from my.replay_buffer import ReplayBuffer
+
+
+# Self-play as a pipeline of processes, so that playing games, processing
+# replays and training overlap:
+#  - generators play games with the newest model of the model store (see
+#    my.registry), and push the paths of the replays onto a queue (in the
+#    simulator, the replays themselves, which never go to disk),
+#  - processors turn the replays into tables (with <to_table>),
+#  - the trainer (the main process) puts the tables into a replay buffer,
+#    and whenever enough new rows came in, learns on them and publishes
+#    a new version into the store.
+# The queues are bounded, so a slow stage holds the faster ones back
+# instead of letting work pile up. The store publishes atomically, so a
+# generator never sees a half-written model. If all generators or all
+# processors die, the trainer stops instead of waiting forever.
+
+"""For each learner: the bot script that plays with it (reading the model
+from HALITE_MODEL), and whether its features are expanded with
+<fight_expand> (else <identity>)."""
+LEARNERS = {
+  "linear": {"bot": "MyBot.py", "fight_expand": True},
+  "neural_net": {"bot": "MyBot_neural.py", "fight_expand": False},
+}
+
+"""How long (in seconds) the trainer waits for a table before it checks
+that the workers are still alive."""
+POLL = 5
+
+########################################################################
+#### MODELS ############################################################
+
+def store_dir(directory):
+  return os.path.join(directory, "store")
+
+
+def get_expander(learner):
+  from my.estimator import fight_expand, identity
+  return (fight_expand if LEARNERS[learner]["fight_expand"] else identity)
+
+
+def resume(store, learner):
+  """The model the trainer continues from: for the neural net, a network
+  with the weights of the store's latest version (None if there is none).
+  Linear models are always fitted anew (an incremental one starts over
+  its statistics)."""
+  if learner != "neural_net" or store.latest() is None:
+    return None
+  from my.train import new_neural_net
+  model, meta = store.load(mmap = False)
+  mlp = new_neural_net(model.layers[0][0].shape[0])
+  mlp.set_weights([w for W, b, a in model.layers for w in (W, b)])
+  return mlp
+
+########################################################################
+#### STAGES ############################################################
+
+def put(q, item, stop):
+  """Puts <item> onto <q>, waiting while it is full, unless we are stopping.
+  Returns whether the item was put."""
+  while not stop.is_set():
+    try:
+      q.put(item, timeout = 1)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+def generator(worker, learner, directory, replays, stop, simulate = False):
+  """Plays games until <stop>, each with the newest model of the store, and
+  pushes their replays onto <replays>: the paths of the replay files, or
+  the replays of simulated games."""
+  from my.estimator import Estimator
+  from my.registry import ModelStore
+  
+  # Whatever is left in the queue when stopping may be dropped.
+  replays.cancel_join_thread()
+  store = ModelStore(store_dir(directory))
+  estimator = Estimator(None, get_expander(learner))
+  version = None
+  game_num = 0
+  while not stop.is_set():
+    latest = store.latest()
+    if simulate:
+      from my.train import simulated_game
+      if latest != version:
+        estimator.model, meta = store.load(latest)
+        version = latest
+      replay = simulated_game(estimator)
+    else:
+      game_dir = os.path.join(directory, "games", "{}-{}".format(worker, game_num))
+      os.makedirs(game_dir, exist_ok = True)
+      game_num += 1
+      if latest is None:
+        bot = "MyBot_random.py"
+        env = dict(os.environ)
+      else:
+        bot = LEARNERS[learner]["bot"]
+        env = dict(os.environ, HALITE_MODEL = store.path(latest))
+      command = ["./halite", "--no-compression", "-t", "-i", game_dir] + ["python3 {}".format(bot)]*4
+      subprocess.run(command, env = env, stdout = subprocess.DEVNULL)
+      found = [f for f in os.listdir(game_dir) if f.startswith("replay-")]
+      if len(found) == 0:
+        continue
+      replay = os.path.join(game_dir, found[0])
+    
+    put(replays, replay, stop)
+
+
+def processor(replays, tables, stop, discount = 0.95, max_len = 50):
+  """Turns the replays from <replays> (paths of replay files, or replays)
+  into tables, pushes them onto <tables>."""
+  from my.data import to_table
+  
+  tables.cancel_join_thread()
+  while not stop.is_set():
+    try:
+      data = replays.get(timeout = 1)
+    except queue.Empty:
+      continue
+    if isinstance(data, str):
+      with open(data) as f:
+        data = json.load(f)
+    table = to_table(data, 1.0, discount, max_len)
+    if len(table) > 0:
+      put(tables, table, stop)
+
+########################################################################
+#### THE PIPELINE ######################################################
+
+def run_pipeline(learner = "linear", snapshots = 10, batch_rows = 4 * 10**4, generators = 2, processors = 1, directory = "pipeline", simulate = False, incremental = False, buffer_rows = 4 * 10**5, priority = None, queue_size = 8):
+  """Runs the pipeline until <snapshots> new versions are published into the
+  model store in <directory>. A version is learned whenever <batch_rows> new
+  rows came in: from those rows, or from <batch_rows> rows sampled from the
+  replay buffer with <priority>, if given. The model is fitted from
+  scratch, or continued if <incremental>. Returns the last model."""
+  if incremental and priority is not None and learner == "linear":
+    raise ValueError("The incremental linear learner already holds all rows it has seen, it can't learn on sampled rows")
+  from my.registry import ModelStore
+  store = ModelStore(store_dir(directory))
+  stop = multiprocessing.Event()
+  replays = multiprocessing.Queue(queue_size)
+  tables = multiprocessing.Queue(queue_size)
+  gens = [multiprocessing.Process(target = generator, args = (i, learner, directory, replays, stop, simulate)) for i in range(generators)]
+  procs = [multiprocessing.Process(target = processor, args = (replays, tables, stop)) for i in range(processors)]
+  workers = gens + procs
+  for w in workers:
+    w.start()
+  
+  # The learners are only imported after the workers are forked.
+  import my.train as train
+  from my.data import get_Xy
+  
+  if learner == "linear":
+    learn = (train.learn_regression_incremental if incremental else train.learn_regression)
+  else:
+    learn = (train.learn_neural_net_incremental if incremental else train.learn_neural_net)
+  expander = get_expander(learner)
+  model = (resume(store, learner) if incremental else None)
+  
+  buffer = ReplayBuffer(buffer_rows)
+  try:
+    for published in range(snapshots):
+      new_rows = 0
+      while new_rows < batch_rows:
+        try:
+          table = tables.get(timeout = POLL)
+        except queue.Empty:
+          if not any(w.is_alive() for w in gens) or not any(w.is_alive() for w in procs):
+            raise RuntimeError("The pipeline's workers died (exit codes {}), see their output".format([w.exitcode for w in workers]))
+          continue
+        buffer.add(table)
+        new_rows += len(table)
+        print("Version {}: {} / {} rows".format(published, new_rows, batch_rows))
+      
+      table = (buffer.latest(new_rows) if priority is None else buffer.sample(batch_rows, priority))
+      X, y = get_Xy(table, expander)
+      model = learn(X, y, (model if incremental else None), verbose = False)
+      version = store.publish(model, expander.__name__, rows = len(y))
+      print("Published version", version)
+  finally:
+    stop.set()
+    for w in workers:
+      w.join()
+  return model
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Self-play with game generation, replay processing and training overlapped.")
+  parser.add_argument("--learner", choices = list(LEARNERS), default = "linear")
+  parser.add_argument("--snapshots", type = int, help = "Number of model versions to publish", default = 10)
+  parser.add_argument("--batch_rows", type = int, help = "New rows needed for each version", default = 4 * 10**4)
+  parser.add_argument("--generators", type = int, help = "Number of game-generating processes", default = 2)
+  parser.add_argument("--processors", type = int, help = "Number of replay-processing processes", default = 1)
+  parser.add_argument("--directory", help = "Where the games and the model store are kept", default = "pipeline")
+  parser.add_argument("--simulate", action = "store_true", help = "Play in the in-process simulator instead of the halite binary")
+  parser.add_argument("--incremental", action = "store_true", help = "Continue from the previous version instead of starting over")
+  parser.add_argument("--buffer", type = int, help = "Capacity (in rows) of the replay buffer", default = 4 * 10**5)
+  parser.add_argument("--sample", choices = ["uniform", "utility", "recency"], help = "Learn on rows sampled from the replay buffer with this priority", default = None)
+  args = parser.parse_args()
+  
+  run_pipeline(args.learner, args.snapshots, args.batch_rows, args.generators, args.processors, args.directory, args.simulate, args.incremental, args.buffer, args.sample)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,90 @@
+import numpy as np
+
+from my.clustering import Cluster
+
+
+# A Barnes-Hut style alternative to the fixed KMeans clusters: the ships of
+# one kind (a player's fighters or miners) are put into a quadtree, and
+# each node is a Cluster of the ships inside it. A ship sensing the others
+# walks down the tree, and takes a node as a whole if it is small compared
+# to its distance (width / distance < theta), otherwise opens it. The
+# sensors (see my.features) then use their far-field approximation for the
+# nodes taken as a whole, and the exact sum over ships for nearby ones.
+# theta = 0 sums over all ships exactly, larger theta is cheaper and less
+# accurate.
+
+
+class Node(Cluster):
+  """A node of the quadtree: the Cluster of the ships in the square of side
+  <width> with the corner <x0>, <y0>, centered at their mean."""
+  
+  def __init__(self, ships, x0, y0, width):
+    x, y = np.mean([[s.x, s.y] for s in ships], axis = 0)
+    Cluster.__init__(self, float(x), float(y), ships)
+    self.x0 = x0
+    self.y0 = y0
+    self.width = width
+    self.children = []
+  
+  def contains(self, pos):
+    """Whether <pos> lies in the square of the node."""
+    return self.x0 <= pos.x <= self.x0 + self.width and self.y0 <= pos.y <= self.y0 + self.width
+
+
+class QuadTree:
+  """Quadtree over <ships>: a node is split into its four quadrants until it
+  has at most <leaf_size> ships (or is <max_depth> deep)."""
+  
+  def __init__(self, ships, theta = 0.5, leaf_size = 1, max_depth = 12):
+    self.theta = theta
+    self.leaf_size = leaf_size
+    self.max_depth = max_depth
+    self.root = None
+    if len(ships) > 0:
+      xs = [s.x for s in ships]
+      ys = [s.y for s in ships]
+      width = max(max(xs) - min(xs), max(ys) - min(ys))
+      self.root = self.build(ships, min(xs), min(ys), width, 0)
+  
+  def build(self, ships, x0, y0, width, depth):
+    node = Node(ships, x0, y0, width)
+    if len(ships) <= self.leaf_size or depth >= self.max_depth or width <= 0.0:
+      return node
+    half = width / 2.0
+    quadrants = [[], [], [], []]
+    for s in ships:
+      quadrants[(2 if s.y >= y0 + half else 0) + (1 if s.x >= x0 + half else 0)].append(s)
+    for q, sub in enumerate(quadrants):
+      if len(sub) > 0:
+        node.children.append(self.build(sub, x0 + half * (q % 2), y0 + half * (q // 2), half, depth + 1))
+    return node
+  
+  def open(self, pos):
+    """The clusters <pos> senses: the nodes that are far enough (by the
+    opening criterion), and the leaves. A node whose square holds <pos> is
+    always opened: for theta above about 0.7, the mean of its ships can be
+    far enough from <pos> for the criterion to take it whole."""
+    res = []
+    stack = ([self.root] if self.root is not None else [])
+    while len(stack) > 0:
+      node = stack.pop()
+      if len(node.children) == 0:
+        res.append(node)
+        continue
+      dist = node.calculate_distance_between(pos)
+      if dist > 0.0 and node.width < self.theta * dist and not node.contains(pos):
+        res.append(node)
+      else:
+        stack.extend(node.children)
+    return res
+  
+  def __len__(self):
+    return (0 if self.root is None else self.root.size)
+
+
+def sensed(clusters, pos):
+  """The clusters to sum the sensors of <pos> over: a list of clusters as
+  they are, or the opened nodes of a QuadTree."""
+  if isinstance(clusters, QuadTree):
+    return clusters.open(pos)
+  return clusters
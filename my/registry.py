@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os.path, shutil
+import tempfile, time
+import numpy as np
+
+import my.features as ft
+
+
+# A versioned store of models, for bots to load while self-play keeps
+# publishing new ones. Each version is a directory holding the weights as
+# plain .npy files and a meta.json with:
+#   - "features": the FEATURES the model was trained on, checked at load
+#     time against ft.FEATURES,
+#   - "expander": the name of the expander ("identity" or "fight_expand"),
+#   - "inputs": the number of inputs the expander made at publish time
+#     (the width of the model's input), checked at load time against what
+#     the expander makes now,
+#   - "kind" and the layers' activations, to rebuild the model,
+#   - "rows": the number of rows it was trained on (and whatever else was
+#     given),
+#   - "sha256": the hash of the weight files.
+# A version is written into a temporary directory and renamed into place,
+# then the LATEST file is replaced, so readers see either the old or the
+# new version, never a half-written one. The weights are loaded memory-mapped
+# and scored with numpy only, so loading needs neither sklearn nor keras.
+
+LATEST = "LATEST"
+META = "meta.json"
+
+
+class SchemaMismatch(Exception):
+  """Raised when a stored model was trained on different features, or on
+  inputs of a different width than its expander makes now."""
+  pass
+
+########################################################################
+#### PREDICTORS ########################################################
+
+class LinearModel:
+  """x · coef_ + intercept_, the same attributes as sklearn's models."""
+  
+  def __init__(self, coef, intercept):
+    self.coef_ = coef
+    self.intercept_ = float(intercept)
+  
+  def predict(self, X):
+    return np.asarray(X).dot(self.coef_) + self.intercept_
+
+
+ACTIVATIONS = {
+  "linear": lambda x: x,
+  "tanh": np.tanh,
+  "relu": lambda x: np.maximum(x, 0.0),
+  "sigmoid": lambda x: 1.0 / (1.0 + np.exp(-x)),
+}
+
+
+class DenseNet:
+  """A stack of dense layers, given as a list of (W, b, activation)."""
+  
+  def __init__(self, layers):
+    self.layers = layers
+  
+  def predict(self, X):
+    h = np.asarray(X)
+    for W, b, activation in self.layers:
+      h = ACTIVATIONS[activation](h.dot(W) + b)
+    return h
+
+
+def export(model):
+  """Returns (kind, arrays, activations) describing <model>: a linear model
+  (anything with coef_ and intercept_) or a keras stack of Dense layers."""
+  if hasattr(model, "coef_"):
+    coef = np.asarray(model.coef_, dtype = float).ravel()
+    intercept = np.asarray(model.intercept_, dtype = float).reshape(1)
+    return "linear", {"coef": coef, "intercept": intercept}, []
+  if isinstance(model, DenseNet):
+    layers = [(W, b, a) for W, b, a in model.layers]
+  else:
+    layers = [tuple(layer.get_weights()) + (layer.get_config()["activation"],) for layer in model.layers]
+  arrays = {}
+  for i, (W, b, activation) in enumerate(layers):
+    arrays["W{}".format(i)] = np.asarray(W, dtype = float)
+    arrays["b{}".format(i)] = np.asarray(b, dtype = float)
+  return "dense", arrays, [a for W, b, a in layers]
+
+
+def inputs(kind, arrays):
+  """The width of the input of the model (see <export>)."""
+  return (len(arrays["coef"]) if kind == "linear" else arrays["W0"].shape[0])
+
+
+def check_inputs(model, expander, source):
+  """Raises SchemaMismatch if <model> (from <source>) doesn't take the rows
+  that <expander> makes."""
+  from my.estimator import input_width
+  kind, arrays, activations = export(model)
+  if inputs(kind, arrays) != input_width(expander):
+    raise SchemaMismatch("{} takes {} inputs, {} makes {}".format(source, inputs(kind, arrays), expander.__name__, input_width(expander)))
+
+
+def build(kind, arrays, activations):
+  """Inverse of <export>."""
+  if kind == "linear":
+    return LinearModel(arrays["coef"], arrays["intercept"][0])
+  return DenseNet([(arrays["W{}".format(i)], arrays["b{}".format(i)], a) for i, a in enumerate(activations)])
+
+########################################################################
+#### THE STORE #########################################################
+
+def hash_files(paths):
+  h = hashlib.sha256()
+  for path in sorted(paths):
+    h.update(os.path.basename(path).encode())
+    with open(path, "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+
+class ModelStore:
+  """The versions are subdirectories "v<number>" of <directory>."""
+  
+  def __init__(self, directory):
+    self.directory = directory
+  
+  def versions(self):
+    if not os.path.isdir(self.directory):
+      return []
+    return sorted(int(name[1:]) for name in os.listdir(self.directory) if name.startswith("v") and name[1:].isdigit())
+  
+  def latest(self):
+    """The newest published version, or None."""
+    try:
+      with open(os.path.join(self.directory, LATEST)) as f:
+        return int(f.read())
+    except (IOError, ValueError):
+      return None
+  
+  def path(self, version):
+    return os.path.join(self.directory, "v{}".format(version))
+  
+  def publish(self, model, expander, **meta):
+    """Stores <model> (trained with the expander named <expander>) as a new
+    version, with the extra <meta> (for example rows = ...). Returns the
+    version."""
+    os.makedirs(self.directory, exist_ok = True)
+    kind, arrays, activations = export(model)
+    tmp = tempfile.mkdtemp(prefix = ".tmp-", dir = self.directory)
+    paths = []
+    for name, array in arrays.items():
+      paths.append(os.path.join(tmp, name + ".npy"))
+      np.save(paths[-1], array)
+    meta = dict(meta, kind = kind, activations = activations, arrays = sorted(arrays), features = ft.FEATURES, expander = expander, inputs = inputs(kind, arrays), created = time.time(), sha256 = hash_files(paths))
+    with open(os.path.join(tmp, META), "w") as f:
+      json.dump(meta, f, indent = 2)
+    
+    # Claim the next version by renaming, retry if someone was faster.
+    version = (max(self.versions()) + 1 if len(self.versions()) > 0 else 0)
+    while True:
+      try:
+        os.rename(tmp, self.path(version))
+        break
+      except OSError:
+        if not os.path.isdir(self.path(version)):
+          shutil.rmtree(tmp, ignore_errors = True)
+          raise
+        version += 1
+    
+    pointer = os.path.join(self.directory, ".{}-{}".format(LATEST, version))
+    with open(pointer, "w") as f:
+      f.write(str(version))
+    os.replace(pointer, os.path.join(self.directory, LATEST))
+    return version
+  
+  def meta(self, version = None):
+    version = (version if version is not None else self.latest())
+    with open(os.path.join(self.path(version), META)) as f:
+      return json.load(f)
+  
+  def load(self, version = None, verify = False, mmap = True):
+    """Loads the model of <version> (the latest by default), with the weights
+    memory-mapped if <mmap>. If <verify>, checks the hash of the weights.
+    Returns (model, meta). Raises SchemaMismatch if the model was trained
+    on features other than ft.FEATURES, or doesn't take as many inputs as
+    its expander makes (also for versions published without "inputs")."""
+    from my.estimator import EXPANDERS, input_width
+    version = (version if version is not None else self.latest())
+    if version is None:
+      raise IOError("No model in {}".format(self.directory))
+    meta = self.meta(version)
+    if meta["features"] != ft.FEATURES:
+      raise SchemaMismatch("Model {} of {} was trained on different features".format(version, self.directory))
+    paths = [os.path.join(self.path(version), name + ".npy") for name in meta["arrays"]]
+    if verify and hash_files(paths) != meta["sha256"]:
+      raise IOError("Model {} of {} is corrupted".format(version, self.directory))
+    arrays = {name: np.load(path, mmap_mode = ("r" if mmap else None)) for name, path in zip(meta["arrays"], paths)}
+    width = input_width(EXPANDERS[meta["expander"]])
+    if inputs(meta["kind"], arrays) != width or meta.get("inputs", width) != width:
+      raise SchemaMismatch("Model {} of {} takes other inputs than {} makes".format(version, self.directory, meta["expander"]))
+    return build(meta["kind"], arrays, meta["activations"]), meta
+
+
+def load_estimator(name, fallback, load_fallback, store_dir = os.path.join("model", "store"), remote = True):
+  """Returns the Estimator for a bot: with the model in HALITE_MODEL if set
+  (a version directory of a store, or a model file), otherwise the latest
+  model of the store <name>, otherwise the model file <fallback>. Model
+  files are loaded with <load_fallback> and use the expander their
+  learner uses (see LEARNERS in my.pipeline).
+  
+  If <remote> and HALITE_INFERENCE_SOCKET is set, the model is instead the
+  one of the inference server listening there, if it is up and its model
+  was trained on ft.FEATURES and takes the rows its expander makes.
+  
+  Raises SchemaMismatch if the model found (in the store or in a file)
+  doesn't fit the features or its expander."""
+  from my.estimator import Estimator, RemoteModel, INFERENCE_SOCKET, EXPANDERS, input_width
+  
+  if remote and os.environ.get(INFERENCE_SOCKET):
+    try:
+      model = RemoteModel(os.environ[INFERENCE_SOCKET])
+      meta = model.meta()
+      if meta.get("features") != ft.FEATURES or meta.get("inputs") != input_width(EXPANDERS[meta["expander"]]):
+        raise SchemaMismatch("The model served at {} was trained on different inputs".format(model.path))
+      return Estimator(model, EXPANDERS[meta["expander"]])
+    except (OSError, EOFError, SchemaMismatch):
+      pass
+  
+  path = os.environ.get("HALITE_MODEL")
+  if path is not None and os.path.isfile(os.path.join(path, META)):
+    store = ModelStore(os.path.dirname(os.path.normpath(path)))
+    model, meta = store.load(int(os.path.basename(os.path.normpath(path))[1:]))
+    return Estimator(model, EXPANDERS[meta["expander"]])
+  
+  store = ModelStore(os.path.join(store_dir, name))
+  if path is None and store.latest() is not None:
+    model, meta = store.load()
+    return Estimator(model, EXPANDERS[meta["expander"]])
+  
+  from my.pipeline import get_expander
+  path = (path if path is not None else fallback)
+  model = load_fallback(path)
+  check_inputs(model, get_expander(name), path)
+  return Estimator(model, get_expander(name))
@@ -0,0 +1,102 @@
+import os.path
+import numpy as np
+
+from my.data import SHIP_DESCRIPTION, DTYPE
+
+
+# A fixed-capacity dataset of table rows (the SHIP_DESCRIPTION attributes
+# and the utility, as produced by <to_table>), kept across self-play
+# epochs. It is a ring buffer: once full, the newest rows overwrite the
+# oldest, so memory stays constant. The rows can be kept in a memory-mapped
+# .npy file instead of memory; then the buffer also survives restarts.
+# Training data is drawn from it uniformly, or weighted by priority.
+
+PRIORITIES = ["uniform", "utility", "recency"]
+
+
+class ReplayBuffer:
+  """Ring buffer of <capacity> rows. If <path> is given, the rows are stored
+  in a memory-mapped file there (and its stamps next to it), reopened if it
+  already exists with the same shape."""
+  
+  def __init__(self, capacity, path = None):
+    width = len(SHIP_DESCRIPTION) + 1
+    if path is None:
+      self.data = np.empty((capacity, width), dtype = DTYPE)
+      self.stamps = np.full(capacity, -1, dtype = np.int64)
+    else:
+      stamps_path = path + ".stamps.npy"
+      if os.path.isfile(path) and os.path.isfile(stamps_path):
+        self.data = np.load(path, mmap_mode = "r+")
+        self.stamps = np.load(stamps_path, mmap_mode = "r+")
+        if self.data.shape != (capacity, width):
+          raise ValueError("Buffer in {} has shape {}, expected {}".format(path, self.data.shape, (capacity, width)))
+      else:
+        self.data = np.lib.format.open_memmap(path, mode = "w+", dtype = DTYPE, shape = (capacity, width))
+        self.stamps = np.lib.format.open_memmap(stamps_path, mode = "w+", dtype = np.int64, shape = (capacity,))
+        self.stamps[:] = -1
+    # The stamp of a row is the number of rows added before it, -1 if empty.
+    self.added = int(self.stamps.max()) + 1
+  
+  @property
+  def capacity(self):
+    return len(self.data)
+  
+  def __len__(self):
+    return min(self.added, self.capacity)
+  
+  def add(self, rows):
+    """Adds <rows>, overwriting the oldest ones if full."""
+    rows = np.asarray(rows)
+    if len(rows) > self.capacity:
+      self.added += len(rows) - self.capacity
+      rows = rows[-self.capacity:]
+    stamps = np.arange(self.added, self.added + len(rows))
+    indices = stamps % self.capacity
+    self.data[indices] = rows
+    self.stamps[indices] = stamps
+    self.added += len(rows)
+  
+  def table(self):
+    """All the stored rows, oldest first."""
+    return self.latest(len(self))
+  
+  def latest(self, n):
+    """The <n> newest rows, oldest first."""
+    n = min(n, len(self))
+    indices = np.arange(self.added - n, self.added) % self.capacity
+    return self.data[indices]
+  
+  def weights(self, priority = "uniform", alpha = 1.0, half_life = None):
+    """Sampling probabilities of the stored rows (in storage order).
+    "uniform": all the same. "utility": proportional to |utility|^<alpha>
+    (plus a little, so no row is left out). "recency": halves every
+    <half_life> rows (by default, the capacity) of age."""
+    valid = self.stamps[:len(self)]
+    if priority == "uniform":
+      w = np.ones(len(valid))
+    elif priority == "utility":
+      u = np.abs(self.data[:len(self), -1])
+      w = (u + 1e-3 * (u.mean() + 1e-9))**alpha
+    elif priority == "recency":
+      half_life = (half_life if half_life is not None else self.capacity)
+      w = 0.5**((self.added - 1 - valid) / half_life)
+    else:
+      raise ValueError("Unknown priority: {}".format(priority))
+    return w / w.sum()
+  
+  def sample(self, n, priority = "uniform", alpha = 1.0, half_life = None, rng = np.random):
+    """Draws <n> rows according to <priority> (see <weights>), without
+    replacement if there are enough rows."""
+    if len(self) == 0:
+      return self.data[:0]
+    p = self.weights(priority, alpha, half_life)
+    replace = n > len(self)
+    indices = rng.choice(len(self), n, replace = replace, p = p)
+    return self.data[np.sort(indices)]
+  
+  def flush(self):
+    """Writes the memory-mapped rows to disk."""
+    for a in [self.data, self.stamps]:
+      if isinstance(a, np.memmap):
+        a.flush()
@@ -0,0 +1,125 @@
+import json
+import os.path
+import struct
+import zipfile, zlib
+
+
+# An index of a replay archive (a directory of replay files, or a zip file
+# of uncompressed replays), so that games can be chosen by their metadata
+# without parsing all of them. The archive is scanned once; for each replay
+# the index records its name, num_players, num_frames, width and height,
+# and where its bytes are: for a zip member, the offset of its local header
+# and its compressed size. Readers then seek straight to the chosen replays.
+# The index is stored as JSON (next to the archive, unless given another
+# path), and rebuilt when the archive changes.
+
+INDEX_SUFFIX = ".index.json"
+META_KEYS = ["num_players", "num_frames", "width", "height"]
+
+
+def index_path(source):
+  """Where the index of <source> is stored by default: next to it."""
+  if os.path.isdir(source):
+    return os.path.join(source, "replays" + INDEX_SUFFIX)
+  return source + INDEX_SUFFIX
+
+
+def stamp(source):
+  """Identifies the state of the archive: its size and modification time
+  (for a directory, of all replays in it)."""
+  if os.path.isdir(source):
+    paths = [os.path.join(source, f) for f in os.listdir(source) if f.startswith("replay-")]
+    return [len(paths), max([os.path.getmtime(p) for p in paths], default = 0.0), sum(os.path.getsize(p) for p in paths)]
+  return [1, os.path.getmtime(source), os.path.getsize(source)]
+
+
+def describe(data):
+  return {key: data[key] for key in META_KEYS}
+
+
+def scan(source):
+  """Reads every replay of <source> once, returns the index entries."""
+  entries = []
+  if os.path.isdir(source):
+    for name in sorted(os.listdir(source)):
+      path = os.path.join(source, name)
+      if not (name.startswith("replay-") and os.path.isfile(path)):
+        continue
+      with open(path) as f:
+        entry = describe(json.load(f))
+      entry.update(name = name, size = os.path.getsize(path))
+      entries.append(entry)
+  else:
+    with zipfile.ZipFile(source) as z:
+      for info in z.infolist():
+        with z.open(info) as f:
+          entry = describe(json.loads(f.read().decode()))
+        entry.update(name = info.filename, offset = info.header_offset, size = info.compress_size, method = info.compress_type)
+        entries.append(entry)
+  return entries
+
+
+def load_index(source, rebuild = False, path = None):
+  """The index of <source>, built (and stored at <path>, see <index_path>
+  for the default) if there is none, if the archive changed since, or if
+  <rebuild>."""
+  path = (path if path is not None else index_path(source))
+  if not rebuild and os.path.isfile(path):
+    with open(path) as f:
+      index = json.load(f)
+    if index["stamp"] == stamp(source):
+      return index["entries"]
+  entries = scan(source)
+  tmp = path + ".tmp"
+  with open(tmp, "w") as f:
+    json.dump({"stamp": stamp(source), "entries": entries}, f, separators = (',', ':'))
+  os.replace(tmp, path)
+  return entries
+
+
+def select(entries, players = None, min_frames = None, max_frames = None, size = None):
+  """The entries with <players> players (a list of allowed counts), between
+  <min_frames> and <max_frames> frames, and maps of <size> (width, height)."""
+  res = []
+  for e in entries:
+    if players is not None and e["num_players"] not in players:
+      continue
+    if min_frames is not None and e["num_frames"] < min_frames:
+      continue
+    if max_frames is not None and e["num_frames"] > max_frames:
+      continue
+    if size is not None and (e["width"], e["height"]) != tuple(size):
+      continue
+    res.append(e)
+  return res
+
+
+def shard(entries, k, n):
+  """The <k>-th of <n> interleaved shards of <entries>."""
+  return entries[k::n]
+
+
+def read(source, entry):
+  """Reads the replay of <entry> straight from <source>."""
+  if os.path.isdir(source):
+    with open(os.path.join(source, entry["name"])) as f:
+      return json.load(f)
+  with open(source, "rb") as f:
+    # The local file header: 30 bytes, then the name and the extra field.
+    f.seek(entry["offset"])
+    header = f.read(30)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    f.seek(name_len + extra_len, os.SEEK_CUR)
+    raw = f.read(entry["size"])
+  if entry["method"] == zipfile.ZIP_DEFLATED:
+    raw = zlib.decompress(raw, -15)
+  elif entry["method"] != zipfile.ZIP_STORED:
+    with zipfile.ZipFile(source) as z:
+      raw = z.read(entry["name"])
+  return json.loads(raw.decode())
+
+
+def fetch(source, entries, limit = None):
+  """Yields the replays of <entries> (up to <limit> of them)."""
+  for e in entries[:limit]:
+    yield read(source, e)
@@ -0,0 +1,284 @@
+import argparse
+import math, random, time
+import numpy as np
+
+from hlt.constants import MAX_SPEED
+from my.estimator import to_moves, random_candidates, segment_argmax
+
+
+# Move search strategies. A strategy proposes candidate (speed, angle)
+# commands for each ship of the fleet, has them scored by the estimator
+# (one model call per round, for all ships at once), and returns the best
+# command for each ship. The number of candidates per ship is bounded by
+# the strategy's <budget>.
+
+
+class Search:
+  """Base class of move search strategies."""
+  
+  def __init__(self, budget = 99):
+    self.budget = budget
+    self.evaluations = 0
+  
+  def propose(self, n, warm = None, rng = np.random):
+    """Returns arrays of <n> candidate speeds and angles for a single ship,
+    drawn from <rng> if the strategy is random."""
+    raise NotImplementedError
+  
+  def score(self, s_feats, estimator, speeds, angles):
+    """Scores the candidates <speeds>, <angles> (one pair of arrays per ship)
+    with a single model call. Returns one array of values per ship."""
+    counts = [len(s) for s in speeds]
+    dx, dy = to_moves(np.concatenate(speeds), np.concatenate(angles))
+    values = estimator.values_of_moves(s_feats, dx, dy, counts)
+    self.evaluations += len(values)
+    return np.split(values, np.cumsum(counts)[:-1])
+  
+  def first(self, warm = None, rng = np.random):
+    """The candidates of the first round for a ship with the warm start <warm>."""
+    return self.propose(self.budget, warm, rng)
+  
+  def prepare(self, warm, candidates = None, rng = np.random):
+    """The candidates of the first round for each ship, given their warm
+    starts <warm>. Ships that have <candidates> (drawn in advance, or None)
+    keep them, the others get new ones drawn from <rng>."""
+    if candidates is None:
+      candidates = [None] * len(warm)
+    return [(c if c is not None else self.first(w, rng)) for w, c in zip(warm, candidates)]
+  
+  def search(self, s_feats, estimator, warm = None, candidates = None, rng = np.random):
+    """Finds the best (speed, angle) for each ship in <s_feats>. <warm>
+    optionally holds for each ship its previous best command (or None), which
+    is tried out as well. <candidates> optionally holds the first round's
+    candidates of the ships (see <prepare>). Random candidates are drawn
+    from <rng>. Returns the commands and their values."""
+    if len(s_feats) == 0:
+      return [], []
+    if warm is None:
+      warm = [None] * len(s_feats)
+    
+    speeds, angles = map(list, zip(*self.prepare(warm, candidates, rng)))
+    values = self.score(s_feats, estimator, speeds, angles)
+    return best_of(speeds, angles, values)
+
+
+def best_of(speeds, angles, values):
+  """Picks the best candidate of each ship, given the per-ship arrays of
+  candidates and their values."""
+  counts = [len(v) for v in values]
+  flat_speeds = np.concatenate(speeds)
+  flat_angles = np.concatenate(angles)
+  flat_values = np.concatenate(values)
+  best = segment_argmax(flat_values, counts)
+  moves = [(int(flat_speeds[i]), int(flat_angles[i])) for i in best]
+  return moves, [float(flat_values[i]) for i in best]
+
+
+def with_warm(speeds, angles, warm):
+  """Replaces the last candidate by the warm start <warm>, if there is one."""
+  if warm is not None and len(speeds) > 0:
+    speeds = np.append(speeds[:-1], warm[0])
+    angles = np.append(angles[:-1], warm[1])
+  return speeds, angles
+
+
+def canonical(speeds, angles):
+  """Rounds the commands the same way as hlt does, clips the speed and drops
+  the angle of zero-speed moves (it doesn't matter)."""
+  speeds = np.clip(np.floor(speeds), 0, MAX_SPEED).astype(int)
+  angles = np.round(angles).astype(int) % 360
+  angles[speeds == 0] = 0
+  return speeds, angles
+
+
+class RandomSearch(Search):
+  """Uniformly random candidates, the same as in <fight>."""
+  
+  def propose(self, n, warm = None, rng = np.random):
+    speeds, angles = random_candidates(n, rng)
+    return with_warm(speeds, angles, warm)
+
+
+class GridSearch(Search):
+  """A fixed lattice of candidates: standing still, and <budget> - 1 moves
+  spread over rings of different speeds (the faster rings get the leftover
+  candidates, if they don't divide evenly). Angles of neighbouring rings
+  are staggered, so that the lattice covers the plane evenly."""
+  
+  def propose(self, n, warm = None, rng = np.random):
+    return lattice(n, warm)
+
+
+def lattice(n, warm = None):
+  """Returns <n> commands forming a lattice (see <GridSearch>). If <warm> is
+  given, it takes the place of one of them."""
+  if warm is not None:
+    speeds, angles = lattice(n - 1)
+    return np.append(speeds, warm[0]), np.append(angles, warm[1])
+  if n <= 1:
+    return np.zeros(n, dtype = int), np.zeros(n, dtype = int)
+  rings = min(MAX_SPEED, n - 1)
+  per_ring, extra = divmod(n - 1, rings)
+  speeds = [0]
+  angles = [0]
+  for i, speed in enumerate(np.linspace(MAX_SPEED, 1, rings)):
+    count = per_ring + (1 if i < extra else 0)
+    offset = (i % 2) * 180.0 / count
+    speeds.extend([speed] * count)
+    angles.extend(offset + np.arange(count) * 360.0 / count)
+  return canonical(np.array(speeds), np.array(angles))
+
+
+class CrossEntropySearch(Search):
+  """Cross-entropy method. The first round evaluates a lattice, each of the
+  following rounds samples around the best candidates found so far: a normal
+  distribution over (dx, dy) is fitted to the <elite> fraction of them."""
+  
+  def __init__(self, budget = 99, rounds = 3, elite = 0.1):
+    super().__init__(budget)
+    self.rounds = rounds
+    self.elite = elite
+  
+  @property
+  def per_round(self):
+    return max(1, self.budget // self.rounds)
+  
+  def first(self, warm = None, rng = np.random):
+    """A lattice of what the later rounds leave of the budget, but at least
+    one candidate."""
+    return lattice(max(1, self.budget - self.per_round * (self.rounds - 1)), warm)
+  
+  def search(self, s_feats, estimator, warm = None, candidates = None, rng = np.random):
+    if len(s_feats) == 0:
+      return [], []
+    if warm is None:
+      warm = [None] * len(s_feats)
+    
+    per_round = self.per_round
+    speeds, angles = map(list, zip(*self.prepare(warm, candidates, rng)))
+    values = self.score(s_feats, estimator, speeds, angles)
+    
+    for r in range(1, self.rounds):
+      new_speeds = []
+      new_angles = []
+      for s, a, v in zip(speeds, angles, values):
+        ns, na = self.refine(s, a, v, per_round, rng)
+        new_speeds.append(ns)
+        new_angles.append(na)
+      new_values = self.score(s_feats, estimator, new_speeds, new_angles)
+      speeds = [np.concatenate(x) for x in zip(speeds, new_speeds)]
+      angles = [np.concatenate(x) for x in zip(angles, new_angles)]
+      values = [np.concatenate(x) for x in zip(values, new_values)]
+    
+    return best_of(speeds, angles, values)
+  
+  def refine(self, speeds, angles, values, n, rng = np.random):
+    """Samples <n> new candidates (from <rng>) around the elite of the
+    evaluated ones."""
+    k = max(2, int(math.ceil(self.elite * len(values))))
+    elite = np.argsort(-values)[:k]
+    dx, dy = to_moves(speeds[elite], angles[elite])
+    mean = np.array([dx.mean(), dy.mean()])
+    std = np.maximum(np.array([dx.std(), dy.std()]), 0.5)
+    sx, sy = rng.normal(mean, std, size = (n, 2)).T
+    new_speeds = np.minimum(np.hypot(sx, sy), MAX_SPEED)
+    new_angles = np.degrees(np.arctan2(sy, sx))
+    return canonical(new_speeds, new_angles)
+
+
+"""Strategies by name."""
+STRATEGIES = {"random": RandomSearch, "grid": GridSearch, "cem": CrossEntropySearch}
+
+########################################################################
+#### BENCHMARK #########################################################
+
+def recorded_fleets(raw_data, frames_per_game = 5):
+  """For a few frames of each game, yields the features of one player's fleet
+  (its undocked ships), along with the ids of those ships. Frames of a game
+  are yielded in order, so that warm starts can be tested."""
+  from my.data import get_maps
+  from my.clustering import all_clusters
+  from my.features import my_ships_features
+  
+  for data in raw_data:
+    frame_maps = get_maps(data)
+    if len(frame_maps) == 0:
+      continue
+    start = random.randrange(len(frame_maps))
+    for game_map in frame_maps[start: start + frames_per_game]:
+      players = [p for p in game_map.all_players() if len(p.all_ships()) > 0]
+      if len(players) == 0:
+        continue
+      game_map.my_id = players[0].id
+      clusters = all_clusters(game_map)
+      ships = game_map.get_me().all_ships()
+      s_feats = my_ships_features(game_map, clusters)
+      fleet = [(f, s.id) for f, s in zip(s_feats, ships) if s.docking_status == s.DockingStatus.UNDOCKED]
+      if len(fleet) > 0:
+        yield [f for f, sid in fleet], [sid for f, sid in fleet]
+
+
+def benchmark(fleets, estimator, strategies, warm_start = True):
+  """Runs each of <strategies> on the recorded <fleets>, and measures the
+  value found and the number of model evaluations. The value is reported
+  relative to a reference search that evaluates a dense lattice."""
+  reference = GridSearch(8 * 360)
+  stats = {name: {"value": 0.0, "gap": 0.0, "evaluations": 0, "time": 0.0} for name in strategies}
+  last_moves = {name: {} for name in strategies}
+  num_ships = 0
+  
+  for s_feats, sids in fleets:
+    best_values = [reference.search([feats], estimator)[1][0] for feats in s_feats]
+    num_ships += len(s_feats)
+    for name, strategy in strategies.items():
+      warm = [last_moves[name].get(sid) for sid in sids] if warm_start else None
+      strategy.evaluations = 0
+      start = time.perf_counter()
+      moves, values = strategy.search(s_feats, estimator, warm)
+      stats[name]["time"] += time.perf_counter() - start
+      stats[name]["evaluations"] += strategy.evaluations
+      stats[name]["value"] += sum(values)
+      stats[name]["gap"] += sum(b - v for b, v in zip(best_values, values))
+      last_moves[name] = dict(zip(sids, moves))
+  
+  print("{:>8} {:>12} {:>12} {:>12} {:>10}".format("strategy", "mean value", "mean gap", "evals/ship", "time (s)"))
+  for name, s in stats.items():
+    print("{:>8} {:>12.4f} {:>12.4f} {:>12.1f} {:>10.3f}".format(
+      name, s["value"] / max(1, num_ships), s["gap"] / max(1, num_ships), s["evaluations"] / max(1, num_ships), s["time"]))
+  return stats
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Compares move search strategies on recorded frames.")
+  parser.add_argument("--data", required = True, help = "Data directory or zip file containing uncompressed games")
+  parser.add_argument("--games_limit", type = int, help = "Use up to games_limit games", default = 10)
+  parser.add_argument("--model", help = "Model to score moves with", default = "model/regressor.pkl")
+  parser.add_argument("--budget", type = int, help = "Number of candidates per ship", default = 99)
+  parser.add_argument("--seed", type = int, help = "Random seed", default = 0)
+  args = parser.parse_args()
+  
+  from my.train import fetch_data_dir, fetch_data_zip
+  from my.estimator import Estimator, fight_expand, identity
+  
+  random.seed(args.seed)
+  np.random.seed(args.seed)
+  
+  if args.model.endswith(".h5"):
+    from keras.models import load_model
+    estimator = Estimator(load_model(args.model), identity)
+  else:
+    from sklearn.externals import joblib
+    estimator = Estimator(joblib.load(args.model), fight_expand)
+  
+  if args.data.endswith(".zip"):
+    raw_data = fetch_data_zip(args.data, args.games_limit)
+  else:
+    raw_data = fetch_data_dir(args.data, args.games_limit)
+  
+  fleets = list(recorded_fleets(raw_data))
+  strategies = {name: cls(args.budget) for name, cls in STRATEGIES.items()}
+  benchmark(fleets, estimator, strategies)
+
+
+if __name__ == "__main__":
+  main()
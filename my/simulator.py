@@ -0,0 +1,447 @@
+import math, random
+import numpy as np
+
+from hlt import constants
+from hlt.game_map import Map
+from my.data import frame_string
+from my.docking import PlanetIndex
+
+
+# An in-process simulator of (a simplified version of) the Halite II rules,
+# so that self-play doesn't have to run the halite binary and parse its
+# replays. The state of all ships and planets is kept in numpy arrays, and
+# movement, collisions, combat, docking and production are computed on the
+# whole arrays at once. Every ship and planet belongs to one of possibly
+# many independent games (the "game" column); ships only ever interact with
+# ships and planets of their own game.
+#
+# The game is recorded in the replay format (the same dicts the halite
+# binary writes as JSON), so it can be turned into a table by <to_table>
+# directly, without any replay files.
+#
+# Simplifications with respect to the real engine: ships move to their
+# destination in one step and only collide where they end up, explosions
+# don't chain, and maps are random rather than symmetric.
+
+"""Production needed to spawn a new ship (not in hlt.constants, as bots
+never need it)."""
+SHIP_COST = 72
+
+"""Planet health per unit of radius."""
+PLANET_HEALTH_PER_RADIUS = 255
+
+UNDOCKED, DOCKING, DOCKED, UNDOCKING = 0, 1, 2, 3
+STATUS_NAMES = ["undocked", "docking", "docked", "undocking"]
+
+SHIP_COLUMNS = {
+  "id": int, "game": int, "owner": int, "x": float, "y": float, "vx": float, "vy": float,
+  "health": float, "docking": int, "planet": int, "progress": int, "cooldown": int
+}
+PLANET_COLUMNS = {
+  "id": int, "game": int, "x": float, "y": float, "r": float, "health": float, "spots": int,
+  "production": int, "remaining": int, "owner": int, "alive": bool
+}
+
+
+def empty(columns):
+  return {name: np.zeros(0, dtype = dtype) for name, dtype in columns.items()}
+
+
+def append(table, rows, columns):
+  """Appends the list of dicts <rows> to the column <table>."""
+  for name, dtype in columns.items():
+    table[name] = np.concatenate([table[name], np.array([row[name] for row in rows], dtype = dtype)])
+
+
+def select(table, mask):
+  return {name: col[mask] for name, col in table.items()}
+
+
+def pair_distances(x1, y1, x2, y2):
+  return np.hypot(x1[:, None] - x2[None, :], y1[:, None] - y2[None, :])
+
+
+class Simulator:
+  """Holds the state of a batch of games, and steps all of them at once."""
+  
+  def __init__(self, seed = None):
+    self.rng = np.random.RandomState(seed)
+    self.ships = empty(SHIP_COLUMNS)
+    self.planets = empty(PLANET_COLUMNS)
+    self.games = []
+  
+  ######################################################################
+  #### GAME CREATION ###################################################
+  
+  def new_game(self, num_players = 4, width = None, height = None, num_planets = None, max_turns = None):
+    """Creates a random game, and returns its index."""
+    rng = self.rng
+    g = len(self.games)
+    if width is None:
+      width = int(rng.choice([240, 264, 288, 312, 336, 360, 384]))
+      height = width * 2 // 3
+    if num_planets is None:
+      num_planets = int(rng.randint(8, 25))
+    if max_turns is None:
+      max_turns = int(100 + math.sqrt(width * height))
+    
+    # Players start in the corners of the map, planets are placed randomly
+    # so that they don't overlap with each other nor with the starting ships.
+    corners = [(0.15, 0.15), (0.85, 0.85), (0.85, 0.15), (0.15, 0.85)]
+    starts = [(cx * width, cy * height) for cx, cy in corners[:num_players]]
+    placed = [(x, y, 12.0) for x, y in starts]
+    planets = []
+    for attempt in range(50 * num_planets):
+      if len(planets) >= num_planets:
+        break
+      r = rng.uniform(3.0, 8.0)
+      x = rng.uniform(r + 10, width - r - 10)
+      y = rng.uniform(r + 10, height - r - 10)
+      if any(math.hypot(x - px, y - py) < r + pr + 10 for px, py, pr in placed):
+        continue
+      placed.append((x, y, r))
+      spots = int(np.clip(round(r / 2), 2, 6))
+      planets.append({
+        "id": len(planets), "game": g, "x": x, "y": y, "r": r,
+        "health": PLANET_HEALTH_PER_RADIUS * r, "spots": spots,
+        "production": 0, "remaining": int(SHIP_COST * spots * rng.randint(10, 20)), "owner": -1, "alive": True
+      })
+    append(self.planets, planets, PLANET_COLUMNS)
+    
+    ships = []
+    for pid, (x, y) in enumerate(starts):
+      for k in range(3):
+        ships.append({
+          "id": len(ships), "game": g, "owner": pid, "x": x, "y": y + 2.0 * (k - 1), "vx": 0.0, "vy": 0.0,
+          "health": constants.BASE_SHIP_HEALTH, "docking": UNDOCKED, "planet": -1, "progress": 0, "cooldown": 0
+        })
+    append(self.ships, ships, SHIP_COLUMNS)
+    
+    self.games.append({
+      "num_players": num_players, "width": width, "height": height, "max_turns": max_turns,
+      "next_ship_id": len(ships), "turn": 0, "over": False,
+      "planets": [{key: p[key] for key in ["id", "x", "y", "r"]} for p in planets],
+      "frames": [], "moves": []
+    })
+    for p, info in zip(planets, self.games[g]["planets"]):
+      info["docking_spots"] = p["spots"]
+      info["health"] = p["health"]
+      info["production"] = p["remaining"]
+    self.games[g]["frames"].append(self.frame(g))
+    return g
+  
+  ######################################################################
+  #### OBSERVATION #####################################################
+  
+  def frame(self, g, events = None):
+    """Describes the current state of game <g> in the replay format."""
+    info = self.games[g]
+    s = select(self.ships, self.ships["game"] == g)
+    p = select(self.planets, (self.planets["game"] == g) & self.planets["alive"])
+    
+    ships = {str(pid): {} for pid in range(info["num_players"])}
+    for i in range(len(s["id"])):
+      docking = {"status": STATUS_NAMES[s["docking"][i]]}
+      if s["docking"][i] != UNDOCKED:
+        docking["planet_id"] = int(s["planet"][i])
+        docking["turns_left"] = int(s["progress"][i])
+      ships[str(s["owner"][i])][str(s["id"][i])] = {
+        "id": int(s["id"][i]), "x": float(s["x"][i]), "y": float(s["y"][i]), "health": int(s["health"][i]),
+        "vel_x": float(s["vx"][i]), "vel_y": float(s["vy"][i]), "cooldown": int(s["cooldown"][i]), "docking": docking
+      }
+    
+    planets = {}
+    for j in range(len(p["id"])):
+      plid = int(p["id"][j])
+      docked = s["id"][(s["docking"] != UNDOCKED) & (s["planet"] == plid)]
+      planets[str(plid)] = {
+        "id": plid, "health": int(p["health"][j]), "current_production": int(p["production"][j]),
+        "remaining_production": int(p["remaining"][j]), "owner": (int(p["owner"][j]) if p["owner"][j] >= 0 else None),
+        "docked_ships": [int(sid) for sid in docked]
+      }
+    return {"ships": ships, "planets": planets, "events": ([] if events is None else events)}
+  
+  def game_map(self, g, player_id):
+    """The current state of game <g> as seen by <player_id>, as a hlt.Map."""
+    info = self.games[g]
+    game_map = Map(player_id, info["width"], info["height"])
+    game_map._parse(frame_string(info, len(info["frames"]) - 1))
+    return game_map
+  
+  def replay(self, g):
+    """Game <g> in the replay format, as accepted by <to_table>."""
+    info = self.games[g]
+    return {
+      "num_players": info["num_players"], "num_frames": len(info["frames"]),
+      "width": info["width"], "height": info["height"], "planets": info["planets"],
+      "frames": info["frames"], "moves": info["moves"] + [{}],
+      "player_names": ["Player {}".format(pid) for pid in range(info["num_players"])]
+    }
+  
+  def drop_game(self, g):
+    """Forgets the ships, planets and recorded frames of game <g>."""
+    self.ships = select(self.ships, self.ships["game"] != g)
+    self.planets = select(self.planets, self.planets["game"] != g)
+    info = self.games[g]
+    info["over"] = True
+    info["frames"] = []
+    info["moves"] = []
+  
+  def players_alive(self, g):
+    """Number of players of game <g> that still have ships."""
+    return len(np.unique(self.ships["owner"][self.ships["game"] == g]))
+  
+  ######################################################################
+  #### STEPPING ########################################################
+  
+  def step(self, commands):
+    """Plays one turn of every game that is not over. <commands> maps the
+    index of a game to a dict {player id: list of command strings}. Returns
+    the list of games that ended in this turn."""
+    active = [g for g, info in enumerate(self.games) if not info["over"]]
+    events = {g: [] for g in active}
+    moves = {g: {} for g in active}
+    in_play = np.isin(self.ships["game"], active)
+    
+    self._progress_docking(in_play)
+    self._apply_commands(commands, active, moves)
+    self._move(in_play)
+    self._collide(in_play, events)
+    self._fight(in_play, events)
+    self._remove_dead(events)
+    self._produce(active, events)
+    
+    ended = []
+    for g in active:
+      info = self.games[g]
+      info["turn"] += 1
+      info["frames"][-1]["events"] = events[g]
+      info["moves"].append(moves[g])
+      self.ships["vx"][self.ships["game"] == g] = 0.0
+      self.ships["vy"][self.ships["game"] == g] = 0.0
+      info["frames"].append(self.frame(g))
+      if info["turn"] >= info["max_turns"] or self.players_alive(g) <= 1:
+        info["over"] = True
+        ended.append(g)
+    return ended
+  
+  def _progress_docking(self, in_play):
+    s = self.ships
+    s["cooldown"] = np.where(in_play, np.maximum(s["cooldown"] - 1, 0), s["cooldown"])
+    changing = in_play & ((s["docking"] == DOCKING) | (s["docking"] == UNDOCKING))
+    s["progress"][changing] -= 1
+    done = changing & (s["progress"] <= 0)
+    docked = done & (s["docking"] == DOCKING)
+    undocked = done & (s["docking"] == UNDOCKING)
+    s["docking"][docked] = DOCKED
+    s["docking"][undocked] = UNDOCKED
+    s["planet"][undocked] = -1
+    s["progress"][done] = 0
+    self._update_owners()
+  
+  def _update_owners(self):
+    """Planets without any ship on them lose their owner."""
+    p = self.planets
+    s = self.ships
+    on_planet = s["docking"] != UNDOCKED
+    for j in np.flatnonzero(p["owner"] >= 0):
+      if not np.any(on_planet & (s["game"] == p["game"][j]) & (s["planet"] == p["id"][j])):
+        p["owner"][j] = -1
+  
+  def _apply_commands(self, commands, active, moves):
+    s = self.ships
+    p = self.planets
+    index = {(g, sid): i for i, (g, sid) in enumerate(zip(s["game"], s["id"]))}
+    planet_index = {(g, plid): j for j, (g, plid) in enumerate(zip(p["game"], p["id"]))}
+    requests = {}
+    
+    for g in active:
+      for pid, queue in commands.get(g, {}).items():
+        player_moves = {}
+        for command in queue:
+          tokens = command.split()
+          if len(tokens) < 2:
+            continue
+          i = index.get((g, int(tokens[1])))
+          if i is None or s["owner"][i] != pid:
+            continue
+          sid = int(s["id"][i])
+          if tokens[0] == "t" and s["docking"][i] == UNDOCKED:
+            magnitude = min(int(tokens[2]), constants.MAX_SPEED)
+            angle = int(tokens[3])
+            s["vx"][i] = magnitude * math.cos(math.radians(angle))
+            s["vy"][i] = magnitude * math.sin(math.radians(angle))
+            player_moves[str(sid)] = {"shipId": sid, "type": "thrust", "magnitude": magnitude, "angle": angle}
+          elif tokens[0] == "d" and s["docking"][i] == UNDOCKED:
+            j = planet_index.get((g, int(tokens[2])))
+            if j is not None and p["alive"][j]:
+              requests.setdefault(j, []).append(i)
+              player_moves[str(sid)] = {"shipId": sid, "type": "dock", "planet_id": int(p["id"][j])}
+          elif tokens[0] == "u" and s["docking"][i] == DOCKED:
+            s["docking"][i] = UNDOCKING
+            s["progress"][i] = constants.DOCK_TURNS
+            player_moves[str(sid)] = {"shipId": sid, "type": "undock"}
+        moves[g][str(pid)] = [player_moves]
+    
+    # Docking requests: the ship has to be close enough, the planet must not
+    # belong to anybody else, and needs a free spot. If several players want
+    # to dock to a free planet in the same turn, nobody succeeds.
+    for j, ships in requests.items():
+      owners = set(int(s["owner"][i]) for i in ships)
+      if p["owner"][j] < 0 and len(owners) > 1:
+        continue
+      occupied = np.sum((s["docking"] != UNDOCKED) & (s["game"] == p["game"][j]) & (s["planet"] == p["id"][j]))
+      free = p["spots"][j] - occupied
+      for i in ships:
+        if free <= 0 or (p["owner"][j] >= 0 and p["owner"][j] != s["owner"][i]):
+          continue
+        dist = math.hypot(s["x"][i] - p["x"][j], s["y"][i] - p["y"][j])
+        if dist > p["r"][j] + constants.DOCK_RADIUS + constants.SHIP_RADIUS:
+          continue
+        s["docking"][i] = DOCKING
+        s["planet"][i] = p["id"][j]
+        s["progress"][i] = constants.DOCK_TURNS
+        p["owner"][j] = s["owner"][i]
+        free -= 1
+  
+  def _move(self, in_play):
+    s = self.ships
+    s["x"] = np.where(in_play, s["x"] + s["vx"], s["x"])
+    s["y"] = np.where(in_play, s["y"] + s["vy"], s["y"])
+  
+  def _collide(self, in_play, events):
+    s = self.ships
+    p = self.planets
+    widths = np.array([info["width"] for info in self.games])
+    heights = np.array([info["height"] for info in self.games])
+    
+    # Leaving the map destroys the ship.
+    w = widths[s["game"]]
+    h = heights[s["game"]]
+    outside = in_play & ((s["x"] < 0) | (s["x"] >= w) | (s["y"] < 0) | (s["y"] >= h))
+    
+    # Crashing into a planet destroys the ship, and damages the planet.
+    same = (s["game"][:, None] == p["game"][None, :]) & p["alive"][None, :]
+    dist = pair_distances(s["x"], s["y"], p["x"], p["y"])
+    crash = in_play[:, None] & same & (dist < p["r"][None, :] + constants.SHIP_RADIUS) & (s["docking"] == UNDOCKED)[:, None]
+    crashed = crash.any(axis = 1)
+    if np.any(crashed):
+      np.add.at(p["health"], np.argmax(crash[crashed], axis = 1), -s["health"][crashed])
+    
+    # Colliding ships damage each other by their health.
+    same = (s["game"][:, None] == s["game"][None, :]) & in_play[:, None] & in_play[None, :]
+    dist = pair_distances(s["x"], s["y"], s["x"], s["y"])
+    collide = same & (dist < 2 * constants.SHIP_RADIUS)
+    np.fill_diagonal(collide, False)
+    damage = collide.astype(float).dot(s["health"])
+    
+    s["health"] = s["health"] - damage
+    s["health"][outside | crashed] = 0.0
+  
+  def _fight(self, in_play, events):
+    s = self.ships
+    alive = in_play & (s["health"] > 0)
+    attackers = alive & (s["docking"] == UNDOCKED) & (s["cooldown"] == 0)
+    same = (s["game"][:, None] == s["game"][None, :]) & (s["owner"][:, None] != s["owner"][None, :])
+    dist = pair_distances(s["x"], s["y"], s["x"], s["y"])
+    targets = attackers[:, None] & alive[None, :] & same & (dist <= constants.WEAPON_RADIUS + 2 * constants.SHIP_RADIUS)
+    
+    num_targets = targets.sum(axis = 1)
+    firing = num_targets > 0
+    share = np.where(firing, constants.WEAPON_DAMAGE / np.maximum(num_targets, 1), 0.0)
+    s["health"] = s["health"] - share.dot(targets)
+    s["cooldown"][firing] = constants.WEAPON_COOLDOWN
+    
+    for i in np.flatnonzero(firing):
+      events[s["game"][i]].append({
+        "event": "attack", "entity": {"id": int(s["id"][i])},
+        "targets": [{"id": int(sid)} for sid in s["id"][targets[i]]]
+      })
+  
+  def _remove_dead(self, events):
+    s = self.ships
+    p = self.planets
+    
+    # Destroyed planets explode, taking their docked ships with them, and
+    # damaging everything nearby.
+    exploding = p["alive"] & (p["health"] <= 0)
+    for j in np.flatnonzero(exploding):
+      p["alive"][j] = False
+      mine = s["game"] == p["game"][j]
+      docked = mine & (s["docking"] != UNDOCKED) & (s["planet"] == p["id"][j])
+      dist = np.hypot(s["x"] - p["x"][j], s["y"] - p["y"][j]) - p["r"][j]
+      falloff = np.clip(1.0 - dist / constants.EXPLOSION_RADIUS, 0.0, 1.0)
+      s["health"] = s["health"] - np.where(mine, falloff * constants.MAX_SHIP_HEALTH, 0.0)
+      s["health"][docked] = 0.0
+    
+    dead = s["health"] <= 0
+    for i in np.flatnonzero(dead):
+      events[s["game"][i]].append({"event": "destroyed", "entity": {"id": int(s["id"][i])}})
+    self.ships = select(s, ~dead)
+    self._update_owners()
+  
+  def _produce(self, active, events):
+    s = self.ships
+    p = self.planets
+    for j in np.flatnonzero(p["alive"] & (p["owner"] >= 0) & np.isin(p["game"], active)):
+      g = int(p["game"][j])
+      docked = np.sum((s["game"] == g) & (s["docking"] == DOCKED) & (s["planet"] == p["id"][j]))
+      made = min(docked * constants.BASE_PRODUCTIVITY, p["remaining"][j])
+      p["production"][j] += made
+      p["remaining"][j] -= made
+      if p["production"][j] < SHIP_COST:
+        continue
+      p["production"][j] -= SHIP_COST
+      
+      # The new ship appears next to the planet, on the side facing the
+      # centre of the map.
+      info = self.games[g]
+      dx = info["width"] / 2 - p["x"][j]
+      dy = info["height"] / 2 - p["y"][j]
+      norm = max(math.hypot(dx, dy), 1e-9)
+      dist = p["r"][j] + constants.SPAWN_RADIUS
+      sid = info["next_ship_id"]
+      info["next_ship_id"] += 1
+      append(self.ships, [{
+        "id": sid, "game": g, "owner": int(p["owner"][j]),
+        "x": p["x"][j] + dx / norm * dist, "y": p["y"][j] + dy / norm * dist, "vx": 0.0, "vy": 0.0,
+        "health": constants.BASE_SHIP_HEALTH, "docking": UNDOCKED, "planet": -1, "progress": 0, "cooldown": 0
+      }], SHIP_COLUMNS)
+      events[g].append({"event": "spawned", "entity": {"id": sid}, "planet": {"id": int(p["id"][j])}})
+
+########################################################################
+#### PLAYING ###########################################################
+
+def random_policy(game_map):
+  """The same as MyBot_random.py: dock where possible, otherwise move
+  randomly."""
+  me = game_map.get_me()
+  undocked = [s for s in me.all_ships() if s.docking_status == s.DockingStatus.UNDOCKED]
+  docks = PlanetIndex(game_map).assign(undocked, me.id)
+  command_queue = []
+  for ship in undocked:
+    target = docks.get(ship.id)
+    if target is not None:
+      command_queue.append(ship.dock(target))
+      continue
+    speed = random.randint(random.randint(0, 7), 7)
+    angle = random.randint(0, 359)
+    command_queue.append(ship.thrust(speed, angle))
+  return command_queue
+
+
+def play_game(policies, seed = None, **game_args):
+  """Plays a game, in which player i is controlled by policies[i] (a function
+  that takes the hlt.Map of the current turn and returns the command queue,
+  for example Bot.turn). Returns the game in the replay format."""
+  sim = Simulator(seed)
+  g = sim.new_game(num_players = len(policies), **game_args)
+  while not sim.games[g]["over"]:
+    commands = {}
+    for pid, policy in enumerate(policies):
+      game_map = sim.game_map(g, pid)
+      if game_map.get_me() is None or len(game_map.get_me().all_ships()) == 0:
+        continue
+      commands[pid] = policy(game_map)
+    sim.step({g: commands})
+  return sim.replay(g)
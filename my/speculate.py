@@ -0,0 +1,167 @@
+import math
+import threading
+import numpy as np
+import my.instrument as instrument
+from my.clustering import K_FIGHTERS, K_MINERS
+
+
+# Speculative work for the next turn, done while we wait for the engine.
+# After the commands are sent, the bot would only block on stdin; instead a
+# background thread predicts where the ships will be next turn (ours moved
+# by the thrusts we just sent, docking ones turned miners, everyone else
+# where they are), and prepares from that:
+#   - the KMeans centroids of the predicted clusters, which the next turn's
+#     KMeans starts from (a single run from good centroids, instead of ten
+#     from random ones),
+#   - the planet fields and the planet features of our ships at their
+#     predicted positions,
+#   - the move candidates of the ships that will be free to move.
+# When the real frame comes, the bot reconciles: the centroids are only a
+# starting point anyway, the planet features are used for ships that are
+# where we predicted and only if the planets are as we predicted, and the
+# candidates for the ships they were drawn for. If the thread hasn't
+# finished by then, the bot waits for it a little, then tells it to stop
+# and uses nothing of it. The thread draws its random numbers (for KMeans
+# and the candidates) from its own generator, seeded from the global one
+# when it starts, so a seeded run stays reproducible however the threads
+# interleave.
+#
+# hlt parses the next frame into the same Map objects, so the thread never
+# looks at the map: everything it needs (the predicted ships, the state of
+# the planets, the warm starts) is copied into plain arrays before it
+# starts. Its KMeans is a numpy one, which checks for cancellation in each
+# iteration, so a late thread doesn't keep running into the next turn. If
+# it fails, nothing of it is used.
+
+class Cancelled(Exception):
+  pass
+
+
+class Speculation:
+  """The speculative work for the turn after <game_map>, in which we sent
+  <commands>. <bot> gives the settings (clustering, fields, search)."""
+  
+  def __init__(self, game_map, commands, bot):
+    self.centroids = None
+    self.prefetched = None
+    self.candidates = None
+    self.rng = np.random.RandomState(np.random.randint(2**31))
+    self.me = game_map.get_me().id
+    self.ships = predict(game_map, commands)
+    self.cluster = (bot.theta is None)
+    self.fields = bot._fields
+    self.planets = (self.fields.state(game_map) if self.fields is not None else None)
+    self.search = bot.search
+    free = self.ships["id"][(self.ships["owner"] == self.me) & self.ships["fighter"]].tolist()
+    self.warm = [bot._last_moves.get(sid) for sid in free]
+    self._cancel = threading.Event()
+    self._thread = threading.Thread(target = self.run, daemon = True)
+    self._thread.start()
+  
+  def run(self):
+    try:
+      with instrument.timer("speculate"):
+        ships = self.ships
+        if self.cluster:
+          self.centroids = predicted_centroids(ships, self.check, self.rng)
+        self.check()
+        mine = (ships["owner"] == self.me)
+        if self.fields is not None:
+          positions = dict(zip(ships["id"][mine].tolist(), zip(ships["x"][mine].tolist(), ships["y"][mine].tolist())))
+          self.prefetched = self.fields.prefetch(self.planets, positions, self.me)
+        self.check()
+        free = ships["id"][mine & ships["fighter"]].tolist()
+        self.candidates = dict(zip(free, self.search.prepare(self.warm, rng = self.rng)))
+    except Cancelled:
+      pass
+    except Exception:
+      instrument.count("speculate.failed", 1)
+      self.centroids = None
+      self.prefetched = None
+      self.candidates = None
+  
+  def check(self):
+    if self._cancel.is_set():
+      raise Cancelled()
+  
+  def result(self, wait = 0.01):
+    """The speculation, if it is done within <wait> seconds (otherwise
+    cancels it and returns None)."""
+    self._thread.join(wait)
+    if self._thread.is_alive():
+      self._cancel.set()
+      instrument.count("speculate.late", 1)
+      return None
+    return self
+
+
+def parse_commands(commands):
+  """The thrusts {ship id: (dx, dy)} and the ids of the docking ships in <commands>."""
+  thrusts = {}
+  docking = set()
+  for command in commands:
+    tokens = command.split()
+    if tokens[0] == "t":
+      phi = math.radians(int(tokens[3]))
+      speed = int(tokens[2])
+      thrusts[int(tokens[1])] = (speed * math.cos(phi), speed * math.sin(phi))
+    elif tokens[0] == "d":
+      docking.add(int(tokens[1]))
+  return thrusts, docking
+
+
+def predict(game_map, commands):
+  """The ships of <game_map> as they will be next turn, given our <commands>:
+  arrays "id", "owner", "x", "y" and "fighter" (whether the ship will be
+  undocked)."""
+  thrusts, docking = parse_commands(commands)
+  rows = []
+  for player in game_map.all_players():
+    for ship in player.all_ships():
+      dx, dy = thrusts.get(ship.id, (0.0, 0.0))
+      fighter = (ship.docking_status == ship.DockingStatus.UNDOCKED and ship.id not in docking)
+      rows.append((ship.id, player.id, ship.x + dx, ship.y + dy, fighter))
+  columns = (list(zip(*rows)) if len(rows) > 0 else [()] * 5)
+  return {
+    "id": np.array(columns[0], dtype = int),
+    "owner": np.array(columns[1], dtype = int),
+    "x": np.array(columns[2], dtype = float),
+    "y": np.array(columns[3], dtype = float),
+    "fighter": np.array(columns[4], dtype = bool)
+  }
+
+
+def predicted_centroids(ships, check, rng = np.random, k_fighters = K_FIGHTERS, k_miners = K_MINERS):
+  """The KMeans centroids of the predicted <ships> (see <predict>), divided
+  as my.clustering.all_clusters divides them, keyed by (player id,
+  "fighters" or "miners"). <check> is called before each iteration, to stop
+  if cancelled."""
+  res = {}
+  for owner in np.unique(ships["owner"]).tolist():
+    for ship_type, k, fighter in [("fighters", k_fighters, True), ("miners", k_miners, False)]:
+      mask = (ships["owner"] == owner) & (ships["fighter"] == fighter)
+      k = min(k, int(mask.sum()))
+      if k > 0:
+        points = np.column_stack([ships["x"][mask], ships["y"][mask]])
+        res[(owner, ship_type)] = lloyd(points, k, check, rng)
+  return res
+
+
+def lloyd(points, k, check, rng = np.random, iterations = 10):
+  """<k> centroids of <points> by Lloyd's algorithm, starting from <k> of the
+  points drawn by <rng>. <check> is called before each iteration. The
+  centroids are only a starting point for the next turn's KMeans, so a few
+  iterations are enough."""
+  centroids = points[rng.choice(len(points), k, replace = False)]
+  for i in range(iterations):
+    check()
+    labels = ((points[:, None, :] - centroids[None, :, :])**2).sum(axis = 2).argmin(axis = 1)
+    counts = np.bincount(labels, minlength = k)
+    sums = np.column_stack([np.bincount(labels, points[:, j], minlength = k) for j in range(2)])
+    new = centroids.copy()
+    used = (counts > 0)
+    new[used] = sums[used] / counts[used, None]
+    if np.array_equal(new, centroids):
+      break
+    centroids = new
+  return centroids
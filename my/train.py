@@ -5,14 +5,15 @@ import zipfile
 import itertools
 
 import numpy as np
-from sklearn.linear_model import LinearRegression
 from sklearn.externals import joblib
-from keras.models import Sequential
-from keras.layers import Dense
-from keras.optimizers import SGD, Adam
 
-from my.data import to_table, get_Xy
+from my.data import to_table, get_Xy, load_csv, save_csv, SHIP_DESCRIPTION, DTYPE
 from my.estimator import fight_expand, identity, Estimator
+from my.incremental import RunningLinearRegression
+from my.replay_buffer import ReplayBuffer
+from my.registry import ModelStore
+import my.instrument as instrument
+import my.replay_index as replay_index
 
 
 ########################################################################
@@ -60,6 +61,26 @@ def fetch_data_zip(zipfilename, limit):
                 d = json.loads(lines[0].decode())
                 yield(d)
 
+def fetch_data_index(args):
+  """Loads up to args.games_limit games, chosen through the index of args.data
+  (see my.replay_index) by the filter and shard arguments, and yields them
+  one by one."""
+  entries = replay_index.load_index(args.data, path = args.index_path)
+  print("Found {} games.".format(len(entries)))
+  players = (None if args.players is None else [int(p) for p in args.players.split(',')])
+  size = (None if args.map_size is None else [int(v) for v in args.map_size.split('x')])
+  entries = replay_index.select(entries, players, args.min_frames, args.max_frames, size)
+  if args.shard is not None:
+    k, n = map(int, args.shard.split('/'))
+    entries = replay_index.shard(entries, k, n)
+  print("Selected {} games, loading up to {} of them ...".format(len(entries), args.games_limit))
+  return replay_index.fetch(args.data, entries, args.games_limit)
+
+def report_progress(done, total):
+  """Progress callback for <to_table>: reports every 10th frame."""
+  if done % 10 == 0 or done == total:
+    print("Frame {}/{}".format(done, total))
+
 ########################################################################
 #### ML HELPERS ########################################################
 
@@ -101,9 +122,11 @@ def validate(X, y, fitter, k = 10):
 def learn_regression(X, y, src = None, save_location = None, verbose = True):
   """Fits linear regression on the given data, saves the model into <save_location>.
   If <verbose>, computes training and validation errors. If <src> is given,
-  instead of starting from scratch starts from there."""
-  if src is None:
-    src = LinearRegression(normalize = True)
+  instead of starting from scratch starts from there. The least squares are
+  solved in float64 by RunningLinearRegression, which converts <X> a chunk
+  at a time, so a float32 <X> is never copied whole."""
+  if not isinstance(src, RunningLinearRegression):
+    src = RunningLinearRegression()
   if verbose:
     validate(X, y, src)
   model = src.fit(X, y)
@@ -112,26 +135,122 @@ def learn_regression(X, y, src = None, save_location = None, verbose = True):
   return model
 
 
+def new_neural_net(input_dim):
+  """The network we learn: one hidden tanh layer of 100 units. keras is
+  imported only here and by the other neural net learners, so playing
+  and the linear learners don't need it."""
+  from keras.models import Sequential
+  from keras.layers import Dense
+  from keras.optimizers import SGD
+  mlp = Sequential()
+  mlp.add(Dense(100, activation="tanh", input_dim = input_dim))
+  mlp.add(Dense(1, activation="linear"))
+  mlp.compile(loss = "mse", optimizer = SGD(lr = 0.000004))
+  return mlp
+
+
 def learn_neural_net(X, y, src = None, save_location = None, verbose = True):
   """Fits neural network on the given data, saves the model into <save_location>.
   If <verbose>, the training process will print some info. If <src> is given,
   instead of starting from scratch starts from there."""
   mlp = src
   if mlp is None:
-    mlp = Sequential()
-    mlp.add(Dense(100, activation="tanh", input_dim = X.shape[1]))
-    mlp.add(Dense(1, activation="linear"))
-    mlp.compile(loss = "mse", optimizer = SGD(lr = 0.000004))
+    mlp = new_neural_net(X.shape[1])
   mlp.fit(X, y, epochs = 100, validation_split = 0.1, verbose = verbose)
   if save_location is not None:
     mlp.save(save_location)
   return mlp
 
 
-def self_play(estimator, learn, save_location = None, epochs = 10, min_rows = 4 * 10**4):
+def learn_regression_incremental(X, y, src = None, save_location = None, verbose = True, holdout = None, decay = 1.0):
+  """Incremental version of <learn_regression>: the running statistics of <src>
+  (a RunningLinearRegression) are multiplied by <decay> and updated by the new
+  data, so the model is fitted on all data seen so far, while the cost only
+  depends on the new data. If <verbose> and a <holdout> set (X, y) is given,
+  prints the error on it."""
+  if not isinstance(src, RunningLinearRegression):
+    src = RunningLinearRegression()
+  model = src.partial_fit(X, y, decay)
+  if verbose:
+    print("Training error:", np.mean((model.predict(X) - y)**2))
+    if holdout is not None and len(holdout[1]) > 0:
+      print("Holdout error:", np.mean((model.predict(holdout[0]) - holdout[1])**2))
+  if save_location is not None:
+    joblib.dump(model, save_location)
+  return model
+
+
+def learn_neural_net_incremental(X, y, src = None, save_location = None, verbose = True, holdout = None, max_epochs = 100, patience = 5):
+  """Incremental version of <learn_neural_net>: fine-tunes the weights of <src>
+  on the new data, stopping as soon as the error on the <holdout> set (X, y)
+  stops improving for <patience> epochs."""
+  from keras.callbacks import EarlyStopping
+  mlp = src
+  if mlp is None:
+    mlp = new_neural_net(X.shape[1])
+  stop = EarlyStopping(monitor = "val_loss", patience = patience)
+  if holdout is not None and len(holdout[1]) > 0:
+    mlp.fit(X, y, epochs = max_epochs, validation_data = holdout, callbacks = [stop], verbose = verbose)
+  else:
+    mlp.fit(X, y, epochs = max_epochs, validation_split = 0.1, callbacks = [stop], verbose = verbose)
+  if save_location is not None:
+    mlp.save(save_location)
+  return mlp
+
+
+def simulated_game(estimator):
+  """Plays a game of 4 players in the simulator, without the halite binary.
+  The players are our bot, or random bots while there is no model yet."""
+  from my.simulator import play_game, random_policy
+  from my.bot import Bot
+  
+  if estimator.model is None:
+    policies = [random_policy] * 4
+  else:
+    policies = [Bot(estimator, "Self-play", fleet = True).turn for i in range(4)]
+  return play_game(policies)
+
+
+def self_play(estimator, learn, save_location = None, epochs = 10, min_rows = 4 * 10**4, simulate = False, num_envs = 1, incremental = False, holdout_ratio = 0.1, holdout_rows = 2 * 10**4, buffer_rows = 4 * 10**5, buffer_path = None, priority = None, store = None, zygote = False):
   """Runs <epochs> training sessions. In each one, we let the bot play
   with itself until enough data is gathered, and then we have him learn
-  on that data."""
+  on that data. If <simulate>, the games are played in the in-process
+  simulator instead of the halite binary, <num_envs> of them at once.
+  
+  If <incremental>, <learn> continues from the previous epoch's model (see
+  learn_*_incremental), and gets a holdout set: <holdout_ratio> of each
+  epoch's rows are held out, the most recent <holdout_rows> of them kept.
+  
+  All rows go into a replay buffer of <buffer_rows> rows (memory-mapped
+  at <buffer_path>, if given). If <priority> is None, each epoch learns on
+  its own rows only, otherwise on <min_rows> rows sampled from the buffer
+  with that priority (see ReplayBuffer.weights). Don't combine <priority>
+  with an <incremental> linear learner: its statistics already hold all the
+  rows it has seen, sampled rows would be counted again.
+  
+  If <store> (a ModelStore) is given, each epoch's model is published
+  there as a new version.
+  
+  If <zygote>, the halite binary's bots are forked from a zygote server of
+  random bots (see my.zygote), started for the duration of self-play,
+  instead of each starting its own python."""
+  holdout = np.zeros((0, len(SHIP_DESCRIPTION) + 1), dtype = DTYPE)
+  buffer = ReplayBuffer(buffer_rows, buffer_path)
+  env = None
+  if simulate and num_envs > 1:
+    from my.vec_env import VecEnv
+    env = VecEnv(num_envs)
+  bots = ["python3 MyBot_random.py"] * 4
+  bot_env = None
+  server = None
+  if zygote and not simulate:
+    import atexit
+    from my.zygote import start, ZYGOTE_SOCKET
+    path = "/tmp/halite-zygote-{}.sock".format(os.getpid())
+    server = start("random", path)
+    atexit.register(server.terminate)
+    bots = ["python3 MyBot_zygote.py"] * 4
+    bot_env = dict(os.environ, **{ZYGOTE_SOCKET: path})
   
   # Get the next directory for self_play.
   directory = "self_play"
@@ -143,42 +262,69 @@ def self_play(estimator, learn, save_location = None, epochs = 10, min_rows = 4
     print("Epoch", epoch)
     print("------------------------------------------------------")
     num_rows = 0
-    subtables = []
     
     epoch_dir = os.path.join(directory, str(epoch))
     subprocess.run("mkdir {}".format(epoch_dir), shell = True)
     
-    # Have a few games until our table is large enough.    
-    for game_num in itertools.count():
-      print("Epoch", epoch, "game", game_num)
-      print("---------------------------")
-      
-      game_dir = os.path.join(epoch_dir, str(game_num))
-      subprocess.run("mkdir {}".format(game_dir), shell = True)
-      
-      command = ["./halite", "--no-compression", "-t", "-i {}".format(game_dir)] + ["python3 MyBot_random.py"]*4
-      subprocess.run(command)
-      
-      # Process the created replay.
-      for data in fetch_data_dir(game_dir, 1):
-        sub = to_table(data, 1.0)
-        num_rows += sub.shape[0]
-        subtables.append(sub)
-      
-      # Break if we have enough data.
-      if num_rows >= min_rows:
-        print("Enough data: {}".format(num_rows))
-        break
-      else:
-        print("Not enough data: {}".format(num_rows))
+    if env is not None:
+      # All games are played together, in the vectorized environment.
+      table = env.collect(min_rows, estimator)
+      num_rows = table.shape[0]
+      buffer.add(table)
+      del table
+      print("Enough data: {}".format(num_rows))
+    else:
+      # Have a few games until our table is large enough.    
+      for game_num in itertools.count():
+        print("Epoch", epoch, "game", game_num)
+        print("---------------------------")
+        
+        if simulate:
+          games = [simulated_game(estimator)]
+        else:
+          game_dir = os.path.join(epoch_dir, str(game_num))
+          subprocess.run("mkdir {}".format(game_dir), shell = True)
+          
+          command = ["./halite", "--no-compression", "-t", "-i {}".format(game_dir)] + bots
+          subprocess.run(command, env = bot_env)
+          games = fetch_data_dir(game_dir, 1)
+        
+        # Process the created replay.
+        for data in games:
+          sub = to_table(data, 1.0, progress = report_progress)
+          num_rows += sub.shape[0]
+          buffer.add(sub)
+        
+        # Break if we have enough data.
+        if num_rows >= min_rows:
+          print("Enough data: {}".format(num_rows))
+          break
+        else:
+          print("Not enough data: {}".format(num_rows))
     
-    table = np.concatenate(subtables)
+    buffer.flush()
+    table = buffer.latest(num_rows)
     csv_loc = os.path.join(epoch_dir, "dump.csv")
-    np.savetxt(csv_loc, table, delimiter = ',')
+    save_csv(csv_loc, table)
+    if priority is not None:
+      table = buffer.sample(min_rows, priority)
     
-    X, y = get_Xy(table, estimator.expander)
-    estimator.model = learn(X, y, estimator.model, save_location)
+    if incremental:
+      # Hold some of the rows out, for early stopping and validation.
+      table = table[np.random.permutation(len(table))]
+      num_held = int(holdout_ratio * len(table))
+      holdout = np.concatenate([holdout, table[:num_held]])[-holdout_rows:]
+      X, y = get_Xy(table[num_held:], estimator.expander)
+      estimator.model = learn(X, y, estimator.model, save_location, holdout = get_Xy(holdout, estimator.expander))
+    else:
+      X, y = get_Xy(table, estimator.expander)
+      estimator.model = learn(X, y, estimator.model, save_location)
+    if store is not None:
+      version = store.publish(estimator.model, estimator.expander.__name__, rows = len(y), epoch = epoch)
+      print("Published version", version)
   
+  if server is not None:
+    server.terminate()
   return estimator
 
 ########################################################################
@@ -188,40 +334,77 @@ def main():
   parser = argparse.ArgumentParser(description="ML-Individual training")
   parser.add_argument("--data", help = "Data directory or zip file containing uncompressed games")
   parser.add_argument("--games_limit", type=int, help="Train on up to games_limit games", default = 100)
+  parser.add_argument("--frames", action="store_true", help="The data directory is a frame store (see my.frame_store) instead of replays.")
+  parser.add_argument("--index", action="store_true", help="Load the games through the index of the data (built on first use).")
+  parser.add_argument("--index_path", help="Store the index of the data in this file instead of next to the data, uses the index.", default = None)
+  parser.add_argument("--players", help="Only games with these numbers of players (comma-separated), uses the index.", default = None)
+  parser.add_argument("--min_frames", type=int, help="Only games with at least this many frames, uses the index.", default = None)
+  parser.add_argument("--max_frames", type=int, help="Only games with at most this many frames, uses the index.", default = None)
+  parser.add_argument("--map_size", help="Only games on maps of this size (WIDTHxHEIGHT), uses the index.", default = None)
+  parser.add_argument("--shard", help="Only the k-th of n shards of the selected games (k/n), uses the index.", default = None)
   parser.add_argument("--dump_location", help="Location where processed data should be stored", default = "dump.csv")
   parser.add_argument("--model_location", help="Directory where model should be stored", default = "model")
   parser.add_argument("--sample_ratio", type=float, help="Percentage of frames should we take from each game.", default = 0.1)
+  parser.add_argument("--seed", type=int, help="Seed for sampling the frames (game i uses seed + i). Random if not given.", default = None)
+  parser.add_argument("--fields", action="store_true", help="Read the planet features from fields precomputed once per game (an approximation, but faster).")
+  parser.add_argument("--theta", type=float, help="Group ships by quadtrees with this opening tolerance (0 is exact, larger is faster) instead of KMeans.", default = None)
   parser.add_argument("--discount", type=float, help="MDP model: discount factor.", default = 0.9)
   parser.add_argument("--max_len", type=int, help="MDP model: how far into the future do we see when calculating utilities.", default = 50)
   parser.add_argument("--sp_eps", type=int, help="Number of epochs in self_play. If 0 (default), instead learns from given data.", default = 0)
   parser.add_argument("--sp_rows", type=int, help="The number of rows in the table during self-play that is considered 'enough'.", default = 4 * 10**4)
+  parser.add_argument("--sp_sim", action="store_true", help="Play the self-play games in the in-process simulator instead of the halite binary.")
+  parser.add_argument("--sp_envs", type=int, help="With --sp_sim, the number of games played at once in a vectorized environment.", default = 1)
+  parser.add_argument("--sp_incremental", action="store_true", help="In self-play, continue learning from the previous epoch's model instead of starting over.")
+  parser.add_argument("--decay", type=float, help="With --sp_incremental and the linear learner, how much the data of each previous epoch is weighed down.", default = 1.0)
+  parser.add_argument("--sp_buffer", type=int, help="Capacity (in rows) of the self-play replay buffer, kept across epochs.", default = 4 * 10**5)
+  parser.add_argument("--sp_buffer_file", help="Keep the self-play replay buffer memory-mapped in this .npy file.", default = None)
+  parser.add_argument("--sp_zygote", action="store_true", help="Fork the self-play bots from a zygote server (see my/zygote.py) instead of starting a python for each.")
+  parser.add_argument("--sp_sample", choices=["uniform", "utility", "recency"], help="Learn on rows sampled from the whole replay buffer with this priority, instead of only the epoch's new rows.", default = None)
   parser.add_argument("--learner", help="Which learner do we employ? (0: linear, 1: neural_net)", default = "neural_net")
   
   args = parser.parse_args()
+  if args.sp_incremental and args.sp_sample is not None and args.learner == "linear":
+    # The running statistics already hold every row seen; resampled rows
+    # would be counted again.
+    parser.error("--sp_sample can't be used with --sp_incremental and the linear learner")
   
   if args.sp_eps > 0:
     # Self play.
+    store = ModelStore(os.path.join(args.model_location, "store", args.learner))
     if args.learner == "linear":
       estimator = Estimator(None, fight_expand)
-      estimator = self_play(estimator, learn_regression, "model/regressor.pkl", args.sp_eps, args.sp_rows)
+      learn = learn_regression
+      if args.sp_incremental:
+        learn = lambda *a, **kw: learn_regression_incremental(*a, decay = args.decay, **kw)
+      estimator = self_play(estimator, learn, "model/regressor.pkl", args.sp_eps, args.sp_rows, args.sp_sim, args.sp_envs, args.sp_incremental, buffer_rows = args.sp_buffer, buffer_path = args.sp_buffer_file, priority = args.sp_sample, store = store, zygote = args.sp_zygote)
     elif args.learner == "neural_net":
       estimator = Estimator(None, identity)
-      estimator = self_play(estimator, learn_neural_net, "model/neural_net.h5", args.sp_eps, args.sp_rows)
+      learn = (learn_neural_net_incremental if args.sp_incremental else learn_neural_net)
+      estimator = self_play(estimator, learn, "model/neural_net.h5", args.sp_eps, args.sp_rows, args.sp_sim, args.sp_envs, args.sp_incremental, buffer_rows = args.sp_buffer, buffer_path = args.sp_buffer_file, priority = args.sp_sample, store = store, zygote = args.sp_zygote)
   
   else:
     if args.data.endswith('.csv'):
       # Load the stored data.
-      table = np.loadtxt(args.data, delimiter = ',')
+      table = load_csv(args.data)
     else:
       # Load the raw game data.
-      if args.data.endswith('.zip'):
+      if args.frames:
+        from my.frame_store import open_games
+        raw_data = open_games(args.data)[:args.games_limit]
+      elif args.index or any(arg is not None for arg in [args.index_path, args.players, args.min_frames, args.max_frames, args.map_size, args.shard]):
+        raw_data = fetch_data_index(args)
+      elif args.data.endswith('.zip'):
         raw_data = fetch_data_zip(args.data, args.games_limit)
       else:
         raw_data = fetch_data_dir(args.data, args.games_limit)
       
       # Process all the data and store it somewhere.
-      table = np.concatenate(tuple(map(lambda x: to_table(x, args.sample_ratio, args.discount, args.max_len), raw_data)))
-      np.savetxt(args.dump_location, table, delimiter = ',')
+      seeds = (itertools.repeat(None) if args.seed is None else itertools.count(args.seed))
+      table = np.concatenate(tuple(map(lambda x, seed: to_table(x, args.sample_ratio, args.discount, args.max_len, seed = seed, progress = report_progress, fields = args.fields, theta = args.theta), raw_data, seeds)))
+      save_csv(args.dump_location, table)
+      instrument.end_turn()
+      if instrument.enabled():
+        print(instrument.report())
     
     if args.learner == "linear":
       X, y = get_Xy(table, fight_expand)
@@ -0,0 +1,194 @@
+import random
+import numpy as np
+
+import my.features as ft
+from my.clustering import all_clusters
+from my.data import SHIP_DESCRIPTION, DTYPE, LazyMaps, feats_to_list, get_events, get_rewards, get_utilities
+from my.docking import PlanetIndex
+from my.estimator import to_moves, random_candidates
+from my.search import RandomSearch
+from my.simulator import Simulator
+
+
+# A vectorized environment for collecting self-play data: B games are held
+# by one simulator and stepped together. In each step, the features of all
+# ships of all games are gathered, and the moves of all fighters (of every
+# player in every game) are chosen with batched model calls. The ships' descriptions go straight into a preallocated table, and
+# get their utilities once their game is over.
+
+
+class RowBuffer:
+  """A preallocated table of <capacity> rows in the <to_table> format: the
+  SHIP_DESCRIPTION attributes and the utility. Rows are added without their
+  utility (NaN), which is filled in later."""
+  
+  def __init__(self, capacity):
+    # NaN until added, so that rows labeled by mistake show.
+    self.data = np.full((capacity, len(SHIP_DESCRIPTION) + 1), np.nan, dtype = DTYPE)
+    self.size = 0
+    self.valid = np.zeros(capacity, dtype = bool)
+  
+  @property
+  def capacity(self):
+    return len(self.data)
+  
+  def add(self, rows):
+    """Adds <rows> (as many as fit), returns their indices."""
+    n = min(len(rows), self.capacity - self.size)
+    indices = np.arange(self.size, self.size + n)
+    if n > 0:
+      self.data[indices] = rows[:n]
+      self.data[indices, -1] = np.nan
+      self.size += n
+    return indices
+  
+  def label(self, indices, utilities):
+    self.data[indices, -1] = utilities
+    self.valid[indices] = True
+  
+  def num_labeled(self):
+    return int(self.valid.sum())
+  
+  def table(self):
+    """The labeled rows."""
+    return self.data[self.valid]
+
+
+class VecEnv:
+  """<num_games> games of <num_players> players, played by the same bot. When
+  a game ends, its rows are labeled and a new game takes its place."""
+  
+  def __init__(self, num_games, num_players = 4, discount = 0.95, max_len = 50, seed = None, **game_args):
+    self.sim = Simulator(seed)
+    self.num_players = num_players
+    self.discount = discount
+    self.max_len = max_len
+    self.game_args = game_args
+    self.slots = [self.sim.new_game(num_players, **game_args) for b in range(num_games)]
+    self.pending = {g: [] for g in self.slots}
+    self.finished = 0
+    self.buffer = None
+  
+  def observe(self):
+    """Returns the observation: the list of (game, game_map, ship, feats) of
+    all undocked ships of all games."""
+    ships = []
+    for g in self.slots:
+      game_map = self.sim.game_map(g, 0)
+      clusters = all_clusters(game_map)
+      planets = game_map.all_planets()
+      for ship in game_map._all_ships():
+        if ship.docking_status != ship.DockingStatus.UNDOCKED:
+          continue
+        ships.append((g, game_map, ship, ft.ship_features(ship, clusters, planets)))
+    return ships
+  
+  def act(self, ships, estimator = None, search = None):
+    """Chooses a command for each ship of the observation: dock if possible,
+    otherwise the move found by <search> (random if there is no model).
+    The moves of all fighters are chosen together, with one model call
+    per round of the search. Returns the commands and the moves taken."""
+    # Dock targets, per game and player.
+    docks = {}
+    groups = {}
+    for g, game_map, ship, feats in ships:
+      groups.setdefault((g, ship.owner.id), (game_map, []))[1].append(ship)
+    for (g, pid), (game_map, group) in groups.items():
+      docks.update({(g, sid): p for sid, p in PlanetIndex(game_map).assign(group, pid).items()})
+    
+    fighters = [i for i, (g, m, ship, f) in enumerate(ships) if (g, ship.id) not in docks]
+    if estimator is None or estimator.model is None:
+      speeds, angles = random_candidates(len(fighters))
+      moves = list(zip(speeds, angles))
+    else:
+      search = (search if search is not None else RandomSearch())
+      moves, values = search.search([ships[i][3] for i in fighters], estimator)
+    fighter_moves = dict(zip(fighters, moves))
+    
+    commands = {g: {} for g in self.slots}
+    taken = []
+    for i, (g, game_map, ship, feats) in enumerate(ships):
+      queue = commands[g].setdefault(ship.owner.id, [])
+      if i in fighter_moves:
+        speed, angle = fighter_moves[i]
+        queue.append(ship.thrust(speed, angle))
+        dx, dy = to_moves(np.array([speed]), np.array([angle]))
+        taken.append(("thrust", float(dx[0]), float(dy[0])))
+      else:
+        queue.append(ship.dock(docks[(g, ship.id)]))
+        taken.append(("dock",))
+    return commands, taken
+  
+  def step(self, buffer, estimator = None, search = None):
+    """Plays one turn of all games, and adds the ships' descriptions into
+    <buffer>. Finished games are labeled and replaced by new ones."""
+    ships = self.observe()
+    commands, taken = self.act(ships, estimator, search)
+    
+    rows = []
+    for (g, game_map, ship, feats), move in zip(ships, taken):
+      feats = dict(feats)
+      feats["dock"] = (1 if move[0] == "dock" else 0)
+      feats["undock"] = 0
+      feats["thrust"] = (1 if move[0] == "thrust" else 0)
+      feats["dx"] = (move[1] if feats["thrust"] else 0.0)
+      feats["dy"] = (move[2] if feats["thrust"] else 0.0)
+      rows.append(feats_to_list(feats) + [0.0])
+    indices = buffer.add(np.array(rows).reshape(len(rows), len(SHIP_DESCRIPTION) + 1))
+    ships = ships[:len(indices)]
+    for i, (g, game_map, ship, feats) in zip(indices, ships):
+      self.pending[g].append((i, ship.id, len(self.sim.games[g]["frames"]) - 1))
+    
+    for g in self.sim.step(commands):
+      self.finish(g, buffer)
+  
+  def finish(self, g, buffer):
+    """Labels the rows of the finished game <g> (with the same rules as
+    <to_table>: rows from the last <max_len> frames, and all rows of short
+    games are dropped), and starts a new game in its place."""
+    replay = self.sim.replay(g)
+    max_frame = replay["num_frames"] - self.max_len
+    if max_frame > 2 * self.max_len:
+      events = get_events(replay)
+      rewards = get_rewards(LazyMaps(replay), events)
+      utilities = get_utilities(rewards, replay["num_frames"], self.discount, self.max_len)
+      kept = [(i, sid, fid) for i, sid, fid in self.pending[g] if fid < max_frame]
+      values = [utilities.get(sid, {}).get(fid, 0.0) for i, sid, fid in kept]
+      buffer.label([i for i, sid, fid in kept], values)
+    
+    # Forget the finished game, and start a new one.
+    del self.pending[g]
+    self.sim.drop_game(g)
+    self.finished += 1
+    new = self.sim.new_game(self.num_players, **self.game_args)
+    self.slots[self.slots.index(g)] = new
+    self.pending[new] = []
+  
+  def collect(self, min_rows, estimator = None, search = None, capacity = None):
+    """Plays until at least <min_rows> labeled rows are gathered, and returns
+    them as a table. Rows go into a buffer of <capacity> rows (by default
+    10 times <min_rows>) more than the rows carried over, once it is full, the games in progress are only
+    played to their end, so that their rows get labeled. Games still in
+    progress at the end carry their rows over to the next <collect>."""
+    buffer = self.carry_over(capacity if capacity is not None else 10 * min_rows)
+    while buffer.num_labeled() < min_rows:
+      if buffer.size >= buffer.capacity and not any(self.pending.values()):
+        break
+      self.step(buffer, estimator, search)
+    return buffer.table()
+  
+  def carry_over(self, capacity):
+    """Starts a new RowBuffer for the next <collect>, with room for <capacity>
+    rows besides the rows of the games in progress. Those are moved into
+    it, so that they are labeled there, and not in the buffer of a table
+    already returned."""
+    carried = (sum(len(pending) for pending in self.pending.values()) if self.buffer is not None else 0)
+    buffer = RowBuffer(capacity + carried)
+    if self.buffer is not None:
+      for g, pending in self.pending.items():
+        if len(pending) == 0:
+          continue
+        indices = buffer.add(self.buffer.data[[i for i, sid, fid in pending]])
+        self.pending[g] = [(j, sid, fid) for j, (i, sid, fid) in zip(indices, pending)]
+    self.buffer = buffer
+    return buffer
@@ -0,0 +1,250 @@
+import array
+import os, sys
+import socket, struct, threading
+
+
+# A zygote for bot processes: the server imports everything and loads the
+# model once, then forks a warm child for each game a bot is needed in.
+# The halite binary starts the shim (MyBot_zygote.py), which imports nothing
+# heavy: it connects to the server, hands over its stdin and stdout, and
+# waits. The forked child plays through hlt.Game on those, and when it is
+# done the server sends its exit status to the shim, which exits with it.
+#
+# The model is reloaded (before forking) whenever the model store has a
+# newer version. Models from the store are plain numpy arrays, which are
+# safe to share with forked children; a keras model loaded in the server
+# may not be, so a keras model (from a model file) is converted into the
+# numpy DenseNet of my.registry before any child is forked.
+#
+# Only this module's light imports happen in the shim, everything else is
+# imported inside <serve>.
+#
+# A child that crashes exits with status 1 and writes its traceback to the
+# stderr it got from the shim. A game ends by the engine closing the bot's
+# stdin (the engine can't kill a forked child), which is not a crash.
+
+ZYGOTE_SOCKET = "HALITE_ZYGOTE_SOCKET"
+DEFAULT_SOCKET = "/tmp/halite-zygote.sock"
+
+
+def send_fds(conn, fds):
+  conn.sendmsg([b"F"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+
+
+def recv_fds(conn, maxfds = 3):
+  fds = array.array("i")
+  msg, ancdata, flags, addr = conn.recvmsg(1, socket.CMSG_LEN(maxfds * fds.itemsize))
+  for level, kind, data in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+  return list(fds)
+
+########################################################################
+#### SHIM ##############################################################
+
+def shim(path = None):
+  """Plays a game through the zygote at <path>: hands it our stdin, stdout
+  and stderr, and exits with the status of the bot it forked."""
+  path = (path or os.environ.get(ZYGOTE_SOCKET) or DEFAULT_SOCKET)
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  conn.connect(path)
+  send_fds(conn, [0, 1, 2])
+  data = b""
+  while len(data) < 4:
+    chunk = conn.recv(4 - len(data))
+    if len(chunk) == 0:
+      sys.exit(1)
+    data += chunk
+  sys.exit(struct.unpack("!i", data)[0])
+
+########################################################################
+#### SERVER ############################################################
+
+"""The bots a zygote can serve, and their names."""
+BOTS = {"linear": "Regressor", "neural_net": "Neural Net", "random": "Random"}
+
+
+def make_estimator(kind):
+  """The Estimator of the bot <kind> ("linear" or "neural_net"), loaded as
+  MyBot.py and MyBot_neural.py load it, but with a keras model converted to
+  numpy. The random bot has none."""
+  import my.registry as registry
+  if kind == "random":
+    return None
+  if kind == "linear":
+    def load_joblib(path):
+      from sklearn.externals import joblib
+      return joblib.load(path)
+    return registry.load_estimator("linear", "model/regressor.pkl", load_joblib, remote = False)
+  def load_keras(path):
+    from keras.models import load_model
+    return registry.build(*registry.export(load_model(path)))
+  return registry.load_estimator("neural_net", "model/neural_net.h5", load_keras, remote = False)
+
+
+def at_eof():
+  """Whether the engine has closed our stdin, that is, the game is over."""
+  import select
+  readable, _, _ = select.select([0], [], [], 0)
+  return len(readable) > 0 and os.read(0, 1) == b""
+
+
+def play_policy(policy, name):
+  """Plays a game using stdin/stdout, with the commands of <policy> (a
+  function of the hlt.Map of the turn)."""
+  import hlt
+  game = hlt.Game(name)
+  while True:
+    game_map = game.update_map()
+    game.send_command_queue(policy(game_map))
+
+
+def play_child(fds, estimator, name):
+  """In the forked child: becomes a bot playing on <fds>, the random one
+  if <estimator> is None."""
+  import random
+  import numpy as np
+  from my.bot import Bot
+  
+  for target, fd in zip([0, 1, 2], fds):
+    os.dup2(fd, target)
+  for fd in fds:
+    os.close(fd)
+  sys.stdin = os.fdopen(0, "r")
+  sys.stdout = os.fdopen(1, "w")
+  # The children must not share the server's random state.
+  seed = int.from_bytes(os.urandom(4), "little")
+  random.seed(seed)
+  np.random.seed(seed)
+  try:
+    if estimator is None:
+      from my.simulator import random_policy
+      play_policy(random_policy, name)
+    else:
+      Bot(estimator, name, fleet = True).play()
+  except Exception:
+    if not at_eof():
+      raise
+  finally:
+    sys.stdout.flush()
+
+
+def watch(pid, conn):
+  """Sends the exit status of the child <pid> to its shim."""
+  _, status = os.waitpid(pid, 0)
+  code = (os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
+  try:
+    conn.sendall(struct.pack("!i", code))
+  except OSError:
+    pass
+  conn.close()
+
+
+def serve(kind = "linear", path = DEFAULT_SOCKET, name = None):
+  """Loads the bot <kind> and forks a child playing a game for each shim
+  that connects to <path>."""
+  import my.registry as registry
+  # Imported here, so that the children start with them already imported.
+  import random
+  import numpy as np
+  import hlt
+  from my.bot import Bot
+  
+  store = registry.ModelStore(os.path.join("model", "store", kind))
+  version = store.latest()
+  estimator = make_estimator(kind)
+  name = (name or BOTS[kind])
+  
+  if os.path.exists(path):
+    os.remove(path)
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  listener.bind(path)
+  listener.listen(64)
+  print("Zygote for {} bots at {}".format(kind, path))
+  try:
+    while True:
+      conn, _ = listener.accept()
+      fds = recv_fds(conn)
+      if len(fds) < 2:
+        conn.close()
+        continue
+      if store.latest() != version:
+        version = store.latest()
+        estimator = make_estimator(kind)
+      
+      pid = os.fork()
+      if pid == 0:
+        listener.close()
+        conn.close()
+        code = 0
+        try:
+          play_child(fds, estimator, name)
+        except BaseException:
+          import traceback
+          traceback.print_exc()
+          code = 1
+        os._exit(code)
+      for fd in fds:
+        os.close(fd)
+      threading.Thread(target = watch, args = (pid, conn), daemon = True).start()
+  finally:
+    listener.close()
+    if os.path.exists(path):
+      os.remove(path)
+
+
+def wait(path, process = None, timeout = 60.0):
+  """Waits until a zygote server listens at <path>: the socket file exists
+  before the server listens, so we try to connect. Raises RuntimeError if
+  the server's <process> exits first, or after <timeout> seconds."""
+  import time
+  deadline = time.time() + timeout
+  while True:
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      conn.connect(path)
+      return
+    except OSError:
+      pass
+    finally:
+      conn.close()
+    if process is not None and process.poll() is not None:
+      raise RuntimeError("The zygote server exited with status {}".format(process.returncode))
+    if time.time() > deadline:
+      raise RuntimeError("No zygote server at {}".format(path))
+    time.sleep(0.1)
+
+
+def start(kind, path):
+  """Starts a zygote server for the bot <kind> at <path> in a new process,
+  and waits until it listens. Returns the process."""
+  import subprocess
+  if os.path.exists(path):
+    os.remove(path)
+  process = subprocess.Popen([sys.executable, "-m", "my.zygote", "--bot", kind, "--socket", path])
+  try:
+    wait(path, process)
+  except RuntimeError:
+    process.terminate()
+    raise
+  return process
+
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description = "Serves pre-warmed bots to the MyBot_zygote.py shim.")
+  parser.add_argument("--bot", choices = sorted(BOTS), help = "Which bot to serve", default = "linear")
+  parser.add_argument("--socket", help = "Path of the socket", default = DEFAULT_SOCKET)
+  parser.add_argument("--wait", action = "store_true", help = "Instead of serving, wait until a server listens at the socket (exits with 1 if none does within a minute)")
+  args = parser.parse_args()
+  if args.wait:
+    try:
+      wait(args.socket)
+    except RuntimeError as e:
+      sys.exit(str(e))
+  else:
+    serve(args.bot, args.socket)
+
+
+if __name__ == "__main__":
+  main()
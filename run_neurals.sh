@@ -1,3 +1,17 @@
 #!/bin/sh
 
-./halite -t "python3 MyBot_neural.py" "python3 MyBot_neural.py" "python3 MyBot_neural.py" "python3 MyBot_neural.py"
+# With --zygote, the bots are forked from a zygote server (see my/zygote.py),
+# which loads the model once for all of them.
+if [ "$1" = "--zygote" ]; then
+  export HALITE_ZYGOTE_SOCKET=/tmp/halite-zygote-$$.sock
+  python3 -m my.zygote --bot neural_net --socket "$HALITE_ZYGOTE_SOCKET" &
+  server=$!
+  if ! python3 -m my.zygote --wait --socket "$HALITE_ZYGOTE_SOCKET"; then
+    kill $server 2> /dev/null
+    exit 1
+  fi
+  ./halite -t "python3 MyBot_zygote.py" "python3 MyBot_zygote.py" "python3 MyBot_zygote.py" "python3 MyBot_zygote.py"
+  kill $server
+else
+  ./halite -t "python3 MyBot_neural.py" "python3 MyBot_neural.py" "python3 MyBot_neural.py" "python3 MyBot_neural.py"
+fi
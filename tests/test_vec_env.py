@@ -0,0 +1,40 @@
+import numpy as np
+
+from my.data import SHIP_DESCRIPTION
+from my.vec_env import VecEnv
+
+
+def check_table(table):
+  thrust = table[:, SHIP_DESCRIPTION.index("thrust")]
+  dock = table[:, SHIP_DESCRIPTION.index("dock")]
+  undock = table[:, SHIP_DESCRIPTION.index("undock")]
+  assert not np.isnan(table).any()
+  assert np.all((thrust == 1) != (dock == 1))
+  assert np.all(undock == 0)
+
+
+def test_collect_twice():
+  """Games still running when the first <collect> returns are labeled in the
+  second one, at their rows of the second buffer."""
+  np.random.seed(0)
+  env = VecEnv(2, seed = 0)
+  first = env.collect(200)
+  assert len(first) >= 200
+  check_table(first)
+  assert any(env.pending.values())
+  second = env.collect(200)
+  assert len(second) >= 200
+  check_table(second)
+
+
+def test_carry_over_keeps_all_rows():
+  """The rows of the games in progress are all carried over, even if they
+  are more than the capacity asked for."""
+  np.random.seed(0)
+  env = VecEnv(2, seed = 0)
+  env.collect(200)
+  carried = sum(len(pending) for pending in env.pending.values())
+  assert carried > 1
+  buffer = env.carry_over(1)
+  assert buffer.size == carried
+  assert sorted(i for pending in env.pending.values() for i, sid, fid in pending) == list(range(carried))